@@ -0,0 +1,80 @@
+"""Compressed, content-addressed storage for revision texts.
+
+Each text is addressed by its sha256 hash, which is the same hash as the
+`migration_hash` or `schema_hash` of the revisions it belongs to, so identical texts
+are only stored once. It's stored zlib-compressed, either whole or as a line-based
+delta against another text (usually the previous revision's schema), whichever is
+smaller."""
+from __future__ import annotations
+
+import difflib
+import hashlib
+import json
+import zlib
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Union
+
+# The longest chain of deltas we'll need to apply to reconstruct a text. Bounds the
+# cost of reading a revision, at the price of storing a whole text now and then.
+MAX_DEPTH = 16
+
+# Either a [start, end) range of lines to copy from the base text, or new text
+Delta = List[Union[List[int], str]]
+
+
+@dataclass(frozen=True)
+class Blob:
+    hash: bytes
+    # If set, `data` is a delta to apply to this blob's text
+    base_hash: Optional[bytes]
+    # How many deltas need to be applied to reconstruct the text
+    depth: int
+    # The length of the uncompressed text
+    size: int
+    data: bytes
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("ascii")).digest()
+
+
+def encode(text: str, base_text: Optional[str] = None, base_depth: int = 0) -> Blob:
+    """Compresses the text, delta-encoding it against base_text if that's smaller."""
+    whole = zlib.compress(text.encode("ascii"))
+    if base_text is not None and base_depth < MAX_DEPTH:
+        delta = zlib.compress(json.dumps(diff(base_text, text)).encode("ascii"))
+        if len(delta) < len(whole):
+            return Blob(
+                text_hash(text), text_hash(base_text), base_depth + 1, len(text), delta
+            )
+    return Blob(text_hash(text), None, 0, len(text), whole)
+
+
+def decode(chain: Sequence[bytes]) -> str:
+    """Reconstructs a text from the data of its blob, followed by that of its base,
+    its base's base and so on."""
+    text = zlib.decompress(chain[-1]).decode("ascii")
+    for data in reversed(chain[:-1]):
+        text = patch(text, json.loads(zlib.decompress(data)))
+    return text
+
+
+def diff(base: str, text: str) -> Delta:
+    base_lines = base.splitlines(keepends=True)
+    lines = text.splitlines(keepends=True)
+    matcher = difflib.SequenceMatcher(None, base_lines, lines)
+    delta: Delta = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            delta.append([i1, i2])
+        elif j2 > j1:
+            delta.append("".join(lines[j1:j2]))
+    return delta
+
+
+def patch(base: str, delta: Delta) -> str:
+    base_lines = base.splitlines(keepends=True)
+    return "".join(
+        op if isinstance(op, str) else "".join(base_lines[op[0] : op[1]])
+        for op in delta
+    )
@@ -2,12 +2,16 @@ from __future__ import annotations
 
 import abc
 import dataclasses
-from typing import List, Optional, Dict, Tuple, Iterable
+import time
+from typing import Any, List, Optional, Dict, Tuple, Iterable, Mapping, cast
 
 import pydantic
 from pydantic import BaseModel
 
-from . import models, db, constants
+from . import models, db
+
+# How often to check whether another backend has finished building an index
+INDEX_BUILD_POLL_INTERVAL = 1.0
 
 
 class Change(pydantic.BaseModel):
@@ -19,6 +23,15 @@ class Change(pydantic.BaseModel):
     begin_rename: Optional[BeginRename] = None
     finish_rename: Optional[FinishRename] = None
 
+    @classmethod
+    def construct_trusted(cls, obj: Mapping[str, object]) -> Change:
+        """Builds a Change from already-validated input without re-validating it."""
+        values = {}
+        for name, value in obj.items():
+            inner_cls = cls.__fields__[name].type_
+            values[name] = inner_cls.construct(**cast(Mapping[str, object], value))
+        return cls.construct(**values)
+
     @property
     def inner(self) -> AbstractChange:
         for field in self.__fields_set__:
@@ -42,6 +55,11 @@ class AbstractChange(abc.ABC):
     def wrap(self) -> Change:
         pass
 
+    def concurrent_target(self, phase: int) -> Optional[str]:
+        """If the given phase can run concurrently with phases on other tables, returns
+        the table it works on. Otherwise returns None, and it must run alone."""
+        return None
+
 
 @dataclasses.dataclass
 class Phase(abc.ABC):
@@ -67,17 +85,29 @@ class PhaseDirection(abc.ABC):
 
 class TransactionalPhase(PhaseDirection):
     def run(self, db: db.Database, index: models.PhaseIndex) -> None:
-        with db.tx():
-            audit = db.audit_phase_start(index)
-            self.run_inner(db, index)
-            db.audit_phase_end(audit)
+        self.run_audited(db, index, is_revert=False)
 
     def revert(self, db: db.Database, index: models.PhaseIndex) -> None:
+        self.run_audited(db, index, is_revert=True)
+
+    def run_audited(
+        self, db: db.Database, index: models.PhaseIndex, is_revert: bool
+    ) -> None:
+        sql = self.batch_sql(index)
+        if sql is not None:
+            db.run_audited(index, sql, is_revert=is_revert)
+            return
         with db.tx():
-            audit = db.audit_phase_start(index, is_revert=True)
+            audit = db.audit_phase_start(index, is_revert=is_revert)
             self.run_inner(db, index)
             db.audit_phase_end(audit)
 
+    def batch_sql(self, index: models.PhaseIndex) -> Optional[str]:
+        """If the phase is just a fixed SQL script, returns it, so that it can be sent
+        along with the audit bookkeeping in one round trip. Otherwise returns None
+        and we call run_inner instead."""
+        return None
+
     @abc.abstractmethod
     def run_inner(self, db: db.Database, index: models.PhaseIndex) -> None:
         pass
@@ -86,8 +116,8 @@ class TransactionalPhase(PhaseDirection):
 class IdempotentPhase(PhaseDirection):
     def run(self, db: db.Database, index: models.PhaseIndex) -> None:
         with db.tx():
-            # FIXME: what happens if we already started?
-            audit = db.audit_phase_start(index)
+            # If we already started, it's safe to just run it again
+            audit = db.audit_phase_start(index, adopt=True)
         self.run_inner(db)
         with db.tx():
             db.audit_phase_end(audit)
@@ -98,8 +128,7 @@ class IdempotentPhase(PhaseDirection):
 
     def revert(self, db: db.Database, index: models.PhaseIndex) -> None:
         with db.tx():
-            # FIXME: what happens if we already started?
-            audit = db.audit_phase_start(index, is_revert=True)
+            audit = db.audit_phase_start(index, is_revert=True, adopt=True)
         self.run_inner(db)
         with db.tx():
             db.audit_phase_end(audit)
@@ -109,16 +138,32 @@ class IdempotentPhase(PhaseDirection):
 class TxDDL(TransactionalPhase):
     ddl: str
 
+    def batch_sql(self, index: models.PhaseIndex) -> Optional[str]:
+        return self.ddl
+
     def run_inner(self, db: db.Database, index: models.PhaseIndex) -> None:
         db.cur.execute(self.ddl)
 
 
 @dataclasses.dataclass
 class NoOp(TransactionalPhase):
+    def batch_sql(self, index: models.PhaseIndex) -> Optional[str]:
+        return ""
+
     def run_inner(self, db: db.Database, index: models.PhaseIndex) -> None:
         pass
 
 
+@dataclasses.dataclass
+class Elided(NoOp):
+    """Stands in for a phase whose net effect is nothing, because a later pending
+    phase undoes it (see logic.elide). A table's creation `opens` a span of phases,
+    and its drop `closes` it, which must be committed together."""
+
+    opens: Optional[str] = None
+    closes: Optional[str] = None
+
+
 @dataclasses.dataclass
 class IdempotentDDL(IdempotentPhase):
     ddl: str
@@ -127,6 +172,35 @@ class IdempotentDDL(IdempotentPhase):
         db.cur.execute(self.ddl)
 
 
+@dataclasses.dataclass
+class CreateIndexPhase(IdempotentPhase):
+    """Builds an index concurrently.
+
+    An interrupted build leaves an INVALID index behind, which slows down every write
+    without ever serving a read, and which IF NOT EXISTS would keep. So if there is
+    one, it's dropped and rebuilt, unless another backend is still building it, in
+    which case we wait for that instead. A valid index is left alone."""
+
+    name: str
+    create_sql: str
+    drop_sql: str
+
+    def run_inner(self, db: db.Database) -> None:
+        name = self.name[1:-1] if self.name.startswith('"') else self.name.lower()
+        while True:
+            state = db.get_index_state(name)
+            if state is None:
+                break
+            is_valid, is_building = state
+            if is_valid:
+                return
+            if not is_building:
+                db.cur.execute(self.drop_sql)
+                break
+            time.sleep(INDEX_BUILD_POLL_INTERVAL)
+        db.cur.execute(self.create_sql)
+
+
 class DDLStep(BaseModel, AbstractChange):
     up: str
     down: str
@@ -165,21 +239,31 @@ class IndexMixin(BaseModel):
     def drop_sql(self) -> str:
         return f"DROP INDEX CONCURRENTLY IF EXISTS {q(self.name)}"
 
+    @property
+    def create_phase(self) -> CreateIndexPhase:
+        return CreateIndexPhase(self.name, self.create_sql, self.drop_sql)
+
 
 class CreateIndex(IndexMixin, AbstractChange):
     def wrap(self) -> Change:
         return Change(create_index=self)
 
+    def concurrent_target(self, phase: int) -> Optional[str]:
+        return self.table
+
     def _phases(self) -> List[Phase]:
-        return [Phase(IdempotentDDL(self.create_sql), IdempotentDDL(self.drop_sql))]
+        return [Phase(self.create_phase, IdempotentDDL(self.drop_sql))]
 
 
 class DropIndex(IndexMixin, AbstractChange):
     def wrap(self) -> Change:
         return Change(drop_index=self)
 
+    def concurrent_target(self, phase: int) -> Optional[str]:
+        return self.table
+
     def _phases(self) -> List[Phase]:
-        return [Phase(IdempotentDDL(self.drop_sql), IdempotentDDL(self.create_sql))]
+        return [Phase(IdempotentDDL(self.drop_sql), self.create_phase)]
 
 
 class ConstraintMixin(BaseModel):
@@ -233,13 +317,19 @@ class ConstraintMixin(BaseModel):
 
     @property
     def drop_sql(self) -> str:
-        return f"{self.alter} DROP CONSTRAINT {q(self.name)}"
+        return f"{self.alter} DROP CONSTRAINT IF EXISTS {q(self.name)}"
 
 
 class AddConstraint(ConstraintMixin, AbstractChange):
     def wrap(self) -> Change:
         return Change(add_constraint=self)
 
+    def concurrent_target(self, phase: int) -> Optional[str]:
+        # Only VALIDATE, which doesn't block writes, is worth running concurrently
+        if phase != 1:
+            return None
+        return self.table or self.domain
+
     def _phases(self) -> List[Phase]:
         return [
             Phase(TxDDL(self.add_sql), TxDDL(self.drop_sql)),
@@ -314,10 +404,10 @@ class CreateRenameViewPhase(RenameMixin, TransactionalPhase):
             """
         SELECT column_name
           FROM information_schema.columns
-         WHERE table_schema = 'public'
+         WHERE table_schema = %s
            AND table_name   = %s
         """,
-            args,
+            [db.schema] + args,
         )
         aliases = []
         for (colname,) in colnames:
@@ -330,17 +420,17 @@ class CreateRenameViewPhase(RenameMixin, TransactionalPhase):
             raise AssertionError(
                 "Columns not present: " + ",".join(self.renames.keys())
             )
-        schema = constants.SHIM_SCHEMA_FORMAT % index.revision
+        schema = db.shim_schema(index.revision)
         db.cur.execute(
             f"""
         CREATE VIEW {schema}.{self.table} AS SELECT
           {", ".join(aliases)}
-        FROM public.{self.table}
+        FROM {db.schema}.{self.table}
         """
         )
 
 
 class RenameDropViewPhase(RenameMixin, TransactionalPhase):
     def run_inner(self, db: db.Database, index: models.PhaseIndex) -> None:
-        schema = constants.SHIM_SCHEMA_FORMAT % index.revision
+        schema = db.shim_schema(index.revision)
         db.cur.execute(f"DROP VIEW {schema}.{self.table}")
@@ -3,12 +3,14 @@ import subprocess
 import os.path
 import textwrap
 from collections import Iterator
+from typing import Optional
+from datetime import timedelta
 from contextlib import contextmanager
 
 import psycopg2
 import yaml
 
-from ..constants import SHIM_SCHEMA_FORMAT, SCHEMA_NAME
+from ..constants import SCHEMA_NAME
 from ..logic import Context
 from .. import models, diff, db
 
@@ -23,26 +25,23 @@ pre_deploy:
 """
 
 
-def format_incantation(rev: models.Revision) -> str:
-    shim_schema = SHIM_SCHEMA_FORMAT % rev.number
+def format_incantation(
+    rev: models.Revision, per_transaction: bool = False, tenant: Optional[str] = None
+) -> str:
+    """The statement each client runs when it connects, to register which revision
+    it's using and put that revision's shim schema on its search path. Per
+    transaction, it runs at the start of each transaction instead, with the client's
+    ID as its parameter, and the search path only lasts for that transaction. A
+    client of a tenant schema gets that tenant's shim schema."""
+    args = f"{rev.number}, decode('{rev.schema_hash.hex()}', 'hex')"
+    if tenant is not None:
+        args += ", '{}'".format(tenant.replace("'", "''"))
+    if per_transaction:
+        return f"""
+    SELECT {SCHEMA_NAME}.register_transaction($1, {args});
+    """
     return f"""
-    SELECT set_config(
-      'search_path',
-      '{shim_schema},'||current_setting('search_path'),
-      false -- not transaction-local
-    );
-
-    INSERT INTO {SCHEMA_NAME}.connections (pid, revision, schema_hash, backend_start)
-    VALUES (
-      pg_backend_pid(),
-      {rev.number},
-      decode('{rev.schema_hash.hex()}', 'hex'),
-      (select backend_start from pg_stat_activity where pid = pg_backend_pid())
-    )
-    ON CONFLICT (pid) DO UPDATE SET
-      revision = excluded.revision,
-      schema_hash = excluded.schema_hash,
-      backend_start = excluded.backend_start;
+    SELECT {SCHEMA_NAME}.register({args});
     """
 
 
@@ -53,7 +52,7 @@ def revision(ctx: Context, message: str) -> None:
     repo = ctx.repo()
     db = ctx.db()
 
-    num = len(repo.revisions) + 1
+    num = repo.revisions.last + 1
     dir = repo.config.migrations_dir
     migration_path = os.path.join(dir, f"{num}-migration.yml")
     new_schema_path = os.path.join(dir, f"{num}-schema.sql")
@@ -66,10 +65,15 @@ def revision(ctx: Context, message: str) -> None:
     with open(old_schema_path, "r") as f:
         old_schema_sql = f.read()
 
-    with temp_db_with_schema(db, old_schema_sql) as old_url, temp_db_with_schema(
-        db, new_schema_sql
+    with schema_db_url(ctx, old_schema_sql) as old_url, schema_db_url(
+        ctx, new_schema_sql
     ) as new_url:
         pre_deploy, post_deploy = diff.diff(old_url, new_url)
+    if repo.config.template_cache_size:
+        db.evict_templates(
+            keep=repo.config.template_cache_size,
+            max_age=timedelta(days=repo.config.template_cache_max_age_days),
+        )
 
     migration = models.Migration(
         message=message, pre_deploy=pre_deploy, post_deploy=post_deploy
@@ -79,7 +83,19 @@ def revision(ctx: Context, message: str) -> None:
 
     rev = models.FileRevision(number=num, migration_filename=migration_path)
     with ctx.ui.open(repo.config.incantation_path, "w") as f:
-        f.write(format_incantation(rev))
+        per_transaction = repo.config.registration == "transaction"
+        f.write(format_incantation(rev, per_transaction))
+
+
+@contextmanager
+def schema_db_url(ctx: Context, schema: str) -> Iterator[str]:
+    """Yields the URL of a database with the given schema loaded, from the template
+    cache if it's enabled."""
+    if ctx.repo().config.template_cache_size:
+        yield ctx.db().template_db_url(schema)
+    else:
+        with temp_db_with_schema(ctx.db(), schema) as url:
+            yield url
 
 
 @contextmanager
@@ -3,7 +3,7 @@ from ..logic.migrate import upgrade
 from ..logic.init import init_db
 
 
-def up(ctx: Context) -> None:
+def up(ctx: Context, wait: bool = False) -> None:
     db = ctx.db()
     if not db.is_set_up():
         if not ctx.ui.ask_yes_no(text.ASK_TO_INITIALIZE_DB):
@@ -12,4 +12,4 @@ def up(ctx: Context) -> None:
         init_db(ctx)
 
     # TODO check that disk + db migrations agree
-    upgrade(ctx)
+    upgrade(ctx, wait=wait)
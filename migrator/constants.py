@@ -1,3 +1,6 @@
 NAME = "migrator"
 SCHEMA_NAME = f"{NAME}_status"
 SHIM_SCHEMA_FORMAT = f"{NAME}_rev_%d"
+PLAN_CACHE_FILENAME = f".{NAME}-plan-cache.json"
+TEMPLATE_DB_PREFIX = f"{NAME}_tpl_"
+CONNECTIONS_CHANNEL = f"{NAME}_connections"
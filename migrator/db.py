@@ -4,12 +4,22 @@ from __future__ import annotations
 import abc
 import contextlib
 import dataclasses
+import datetime
+import functools
+import hashlib
 import os
 import random
 import re
+import select
 from urllib.parse import urlparse
 
-from .constants import SCHEMA_NAME, SHIM_SCHEMA_FORMAT
+from .constants import (
+    CONNECTIONS_CHANNEL,
+    NAME,
+    SCHEMA_NAME,
+    SHIM_SCHEMA_FORMAT,
+    TEMPLATE_DB_PREFIX,
+)
 from contextlib import contextmanager
 from typing import (
     Any,
@@ -23,12 +33,15 @@ from typing import (
     Callable,
     cast,
     Dict,
+    Match,
+    Set,
     Tuple,
+    Union,
 )
 
 import psycopg2
 
-from . import models
+from . import blobs, models
 
 T = TypeVar("T")
 U = TypeVar("U")
@@ -77,6 +90,300 @@ CREATE TABLE {SCHEMA_NAME}.connections (
 );
 """
 
+UNFINISHED_AUDIT_KEY = [
+    "stream",
+    "revision",
+    "migration_hash",
+    "schema_hash",
+    "pre_deploy",
+    "change",
+    "phase",
+    "is_revert",
+]
+
+# SCHEMA_DDL creates version 1 of the schema, and Database.upgrade_schema() takes it
+# from there.
+SCHEMA_VERSION = 11
+
+# Moves revision texts into compressed, deduplicated blobs (see blobs.py)
+SCHEMA_V2_DDL = f"""
+CREATE TABLE {SCHEMA_NAME}.schema_version (
+  version INT NOT NULL
+);
+INSERT INTO {SCHEMA_NAME}.schema_version VALUES (2);
+
+CREATE TABLE {SCHEMA_NAME}.blobs (
+  hash BYTEA PRIMARY KEY,
+  base_hash BYTEA REFERENCES {SCHEMA_NAME}.blobs (hash),
+  depth INT NOT NULL,
+  size INT NOT NULL,
+  data BYTEA NOT NULL
+);
+
+-- The data of the given blob, followed by that of its base, its base's base...
+CREATE FUNCTION {SCHEMA_NAME}.blob_chain(target BYTEA) RETURNS BYTEA[] AS $$
+  WITH RECURSIVE chain (hash, base_hash, data, n) AS (
+    SELECT hash, base_hash, data, 0 FROM {SCHEMA_NAME}.blobs WHERE hash = target
+    UNION ALL
+    SELECT b.hash, b.base_hash, b.data, c.n + 1
+      FROM {SCHEMA_NAME}.blobs b JOIN chain c ON b.hash = c.base_hash
+  )
+  SELECT array_agg(data ORDER BY n) FROM chain
+$$ LANGUAGE SQL STABLE;
+"""
+
+# Allows several phases to be in flight at once, as long as they're different phases
+SCHEMA_V3_DDL = f"""
+DROP INDEX {SCHEMA_NAME}.migration_audit_one_unfinished;
+CREATE UNIQUE INDEX migration_audit_one_unfinished_per_phase
+  ON {SCHEMA_NAME}.migration_audit
+  (revision, migration_hash, schema_hash, pre_deploy, change, phase, is_revert)
+  WHERE started_at IS NOT NULL AND finished_at IS NULL;
+UPDATE {SCHEMA_NAME}.schema_version SET version = 3;
+"""
+
+# Gives each tenant schema its own stream of audits ('' for the default stream)
+SCHEMA_V4_DDL = f"""
+ALTER TABLE {SCHEMA_NAME}.migration_audit ADD COLUMN stream TEXT NOT NULL DEFAULT '';
+CREATE INDEX migration_audit_stream ON {SCHEMA_NAME}.migration_audit (stream, id);
+DROP INDEX {SCHEMA_NAME}.migration_audit_one_unfinished_per_phase;
+CREATE UNIQUE INDEX migration_audit_one_unfinished_per_phase
+  ON {SCHEMA_NAME}.migration_audit ({", ".join(UNFINISHED_AUDIT_KEY)})
+  WHERE started_at IS NOT NULL AND finished_at IS NULL;
+UPDATE {SCHEMA_NAME}.schema_version SET version = 4;
+"""
+
+# A queue of phases for workers on several hosts to share (see logic/worker.py)
+SCHEMA_V5_DDL = f"""
+CREATE TABLE {SCHEMA_NAME}.phase_queue (
+  stream TEXT NOT NULL,
+  batch INT NOT NULL,
+  chain INT NOT NULL,
+  revision INT NOT NULL,
+  migration_hash BYTEA NOT NULL,
+  schema_hash BYTEA NOT NULL,
+  pre_deploy BOOL NOT NULL,
+  changes INT[] NOT NULL,
+  phases INT[] NOT NULL,
+  claimed_by TEXT,
+  -- Identifies the session of the worker that claimed it, so that if the worker
+  -- dies, others can tell and claim it themselves
+  claimed_pid INT,
+  claimed_backend_start TIMESTAMP WITH TIME ZONE,
+  finished_at TIMESTAMP WITH TIME ZONE,
+  error TEXT,
+  PRIMARY KEY (stream, batch, chain)
+);
+UPDATE {SCHEMA_NAME}.schema_version SET version = 5;
+"""
+
+# Notifies whoever is waiting for clients to move to a new revision (see
+# logic.drain) whenever a client registers which revision it's using
+SCHEMA_V6_DDL = f"""
+CREATE FUNCTION {SCHEMA_NAME}.notify_connections() RETURNS TRIGGER AS $$
+BEGIN
+  NOTIFY {CONNECTIONS_CHANNEL};
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER notify_connections
+  AFTER INSERT OR UPDATE ON {SCHEMA_NAME}.connections
+  FOR EACH STATEMENT EXECUTE PROCEDURE {SCHEMA_NAME}.notify_connections();
+UPDATE {SCHEMA_NAME}.schema_version SET version = 6;
+"""
+
+# Makes registering a client (see commands.revision.format_incantation) a single
+# function call, and the registry unlogged: it's rewritten on every connection, and
+# only describes connections that wouldn't survive a crash anyway.
+SCHEMA_V7_DDL = f"""
+ALTER TABLE {SCHEMA_NAME}.connections SET UNLOGGED;
+CREATE FUNCTION {SCHEMA_NAME}.register(revision INT, schema_hash BYTEA)
+RETURNS VOID AS $$
+#variable_conflict use_column
+DECLARE
+  shim TEXT := '{SHIM_SCHEMA_FORMAT.replace("%d", "")}' || register.revision;
+  path TEXT := current_setting('search_path');
+BEGIN
+  -- Put the shim schema first on the search path (for the rest of the session)
+  IF left(path, length(shim) + 1) <> shim || ',' THEN
+    PERFORM set_config('search_path', shim || ',' || path, false);
+  END IF;
+  INSERT INTO {SCHEMA_NAME}.connections (pid, revision, schema_hash, backend_start)
+  SELECT pid, register.revision, register.schema_hash, backend_start
+  FROM pg_stat_activity WHERE pid = pg_backend_pid()
+  ON CONFLICT (pid) DO UPDATE SET
+    revision = excluded.revision,
+    schema_hash = excluded.schema_hash,
+    backend_start = excluded.backend_start;
+END
+$$ LANGUAGE plpgsql;
+UPDATE {SCHEMA_NAME}.schema_version SET version = 7;
+"""
+
+SCHEMA_V8_DDL = f"""
+CREATE INDEX connections_revision ON {SCHEMA_NAME}.connections (revision);
+UPDATE {SCHEMA_NAME}.schema_version SET version = 8;
+"""
+
+# How often a client registered per transaction (see SCHEMA_V9_DDL) updates its
+# registration, if its revision hasn't changed. Its client_ttl should be longer.
+CLIENT_HEARTBEAT_SECONDS = 10
+
+# For connection poolers in transaction mode, where a client's transactions may each
+# run on a different backend: clients identify themselves with a client ID of their
+# choosing instead of by backend, and call register_transaction() at the start of
+# each transaction, which puts the shim schema on the search path for just that
+# transaction. They count as connected until they haven't been seen for a while.
+SCHEMA_V9_DDL = f"""
+CREATE UNLOGGED TABLE {SCHEMA_NAME}.clients (
+  client_id TEXT PRIMARY KEY,
+  revision INT NOT NULL,
+  schema_hash BYTEA NOT NULL,
+  last_seen TIMESTAMP WITH TIME ZONE NOT NULL
+);
+CREATE INDEX clients_revision ON {SCHEMA_NAME}.clients (revision);
+CREATE TRIGGER notify_clients_inserted
+  AFTER INSERT ON {SCHEMA_NAME}.clients
+  FOR EACH ROW EXECUTE PROCEDURE {SCHEMA_NAME}.notify_connections();
+CREATE TRIGGER notify_clients_updated
+  AFTER UPDATE ON {SCHEMA_NAME}.clients
+  FOR EACH ROW WHEN (OLD.revision <> NEW.revision)
+  EXECUTE PROCEDURE {SCHEMA_NAME}.notify_connections();
+CREATE FUNCTION {SCHEMA_NAME}.register_transaction(
+  client_id TEXT, revision INT, schema_hash BYTEA
+) RETURNS VOID AS $$
+#variable_conflict use_column
+DECLARE
+  shim TEXT := '{SHIM_SCHEMA_FORMAT.replace("%d", "")}' || register_transaction.revision;
+  path TEXT := current_setting('search_path');
+BEGIN
+  IF left(path, length(shim) + 1) <> shim || ',' THEN
+    PERFORM set_config('search_path', shim || ',' || path, true);
+  END IF;
+  -- Only write when something changed, or as a heartbeat
+  INSERT INTO {SCHEMA_NAME}.clients AS c (client_id, revision, schema_hash, last_seen)
+  VALUES (
+    register_transaction.client_id,
+    register_transaction.revision,
+    register_transaction.schema_hash,
+    now()
+  )
+  ON CONFLICT (client_id) DO UPDATE SET
+    revision = excluded.revision,
+    schema_hash = excluded.schema_hash,
+    last_seen = excluded.last_seen
+  WHERE c.revision <> excluded.revision
+    OR c.last_seen < now() - interval '{CLIENT_HEARTBEAT_SECONDS} seconds';
+END
+$$ LANGUAGE plpgsql;
+UPDATE {SCHEMA_NAME}.schema_version SET version = 9;
+"""
+
+# Lets clients of a tenant schema register too: given the tenant, register() and
+# register_transaction() put the tenant's shim schema (see Database.shim_schema) on
+# the search path instead of the default one.
+SCHEMA_V10_DDL = f"""
+DROP FUNCTION {SCHEMA_NAME}.register(INT, BYTEA);
+CREATE FUNCTION {SCHEMA_NAME}.register(
+  revision INT, schema_hash BYTEA, tenant TEXT DEFAULT NULL
+) RETURNS VOID AS $$
+#variable_conflict use_column
+DECLARE
+  shim TEXT := coalesce(register.tenant || '_', '')
+    || '{SHIM_SCHEMA_FORMAT.replace("%d", "")}' || register.revision;
+  path TEXT := current_setting('search_path');
+BEGIN
+  -- Put the shim schema first on the search path (for the rest of the session)
+  IF left(path, length(shim) + 1) <> shim || ',' THEN
+    PERFORM set_config('search_path', shim || ',' || path, false);
+  END IF;
+  INSERT INTO {SCHEMA_NAME}.connections (pid, revision, schema_hash, backend_start)
+  SELECT pid, register.revision, register.schema_hash, backend_start
+  FROM pg_stat_activity WHERE pid = pg_backend_pid()
+  ON CONFLICT (pid) DO UPDATE SET
+    revision = excluded.revision,
+    schema_hash = excluded.schema_hash,
+    backend_start = excluded.backend_start;
+END
+$$ LANGUAGE plpgsql;
+DROP FUNCTION {SCHEMA_NAME}.register_transaction(TEXT, INT, BYTEA);
+CREATE FUNCTION {SCHEMA_NAME}.register_transaction(
+  client_id TEXT, revision INT, schema_hash BYTEA, tenant TEXT DEFAULT NULL
+) RETURNS VOID AS $$
+#variable_conflict use_column
+DECLARE
+  shim TEXT := coalesce(register_transaction.tenant || '_', '')
+    || '{SHIM_SCHEMA_FORMAT.replace("%d", "")}' || register_transaction.revision;
+  path TEXT := current_setting('search_path');
+BEGIN
+  IF left(path, length(shim) + 1) <> shim || ',' THEN
+    PERFORM set_config('search_path', shim || ',' || path, true);
+  END IF;
+  -- Only write when something changed, or as a heartbeat
+  INSERT INTO {SCHEMA_NAME}.clients AS c (client_id, revision, schema_hash, last_seen)
+  VALUES (
+    register_transaction.client_id,
+    register_transaction.revision,
+    register_transaction.schema_hash,
+    now()
+  )
+  ON CONFLICT (client_id) DO UPDATE SET
+    revision = excluded.revision,
+    schema_hash = excluded.schema_hash,
+    last_seen = excluded.last_seen
+  WHERE c.revision <> excluded.revision
+    OR c.last_seen < now() - interval '{CLIENT_HEARTBEAT_SECONDS} seconds';
+END
+$$ LANGUAGE plpgsql;
+UPDATE {SCHEMA_NAME}.schema_version SET version = 10;
+"""
+
+# Like the clients table's triggers, only notifies about connections that register
+# for the first time or change revision, so that the churn of clients re-registering
+# at the same revision doesn't contend for the notification queue's lock
+SCHEMA_V11_DDL = f"""
+DROP TRIGGER notify_connections ON {SCHEMA_NAME}.connections;
+CREATE TRIGGER notify_connections_inserted
+  AFTER INSERT ON {SCHEMA_NAME}.connections
+  FOR EACH ROW EXECUTE PROCEDURE {SCHEMA_NAME}.notify_connections();
+CREATE TRIGGER notify_connections_updated
+  AFTER UPDATE ON {SCHEMA_NAME}.connections
+  FOR EACH ROW WHEN (OLD.revision IS DISTINCT FROM NEW.revision)
+  EXECUTE PROCEDURE {SCHEMA_NAME}.notify_connections();
+UPDATE {SCHEMA_NAME}.schema_version SET version = 11;
+"""
+
+# Deletes registrations left behind by clients that have disconnected: per-session
+# ones whose (pid, backend_start) no longer matches a live backend, and
+# per-transaction ones that have expired. Rows registered within the last minute are
+# left alone, in case the backend that registered them reused a pid and isn't in our
+# snapshot of pg_stat_activity yet. Registrations are only ever overwritten
+# otherwise, so without this the tables would grow without bound.
+PRUNE_CLIENTS_CTE = f"""
+        pruned AS (
+          DELETE FROM {SCHEMA_NAME}.connections c
+          WHERE c.backend_start < now() - interval '1 minute' AND NOT EXISTS (
+            SELECT FROM pg_stat_activity a
+            WHERE a.pid = c.pid AND a.backend_start = c.backend_start
+          )
+        ),
+        expired AS (
+          DELETE FROM {SCHEMA_NAME}.clients
+          WHERE last_seen < now() - make_interval(secs => %(client_ttl)s)
+        )"""
+
+# The revision of each connected client, and "PID <pid>" for ones registered per
+# session or the client ID for ones registered per transaction
+LIVE_SESSION_CLIENTS = f"""
+        SELECT c.revision, 'PID ' || c.pid AS client
+        FROM {SCHEMA_NAME}.connections c
+        JOIN pg_stat_activity a
+          ON a.pid = c.pid AND a.backend_start = c.backend_start"""
+LIVE_TRANSACTION_CLIENTS = f"""
+        SELECT revision, client_id AS client FROM {SCHEMA_NAME}.clients
+        WHERE last_seen >= now() - make_interval(secs => %(client_ttl)s)"""
+LIVE_CLIENTS = f"{LIVE_SESSION_CLIENTS}\n        UNION ALL{LIVE_TRANSACTION_CLIENTS}"
+
 
 class Mapper(abc.ABC, Generic[T, U]):
     fields: List[str]
@@ -106,7 +413,8 @@ class Mapper(abc.ABC, Generic[T, U]):
         return ", ".join([f"%({name})s" for name in cls.insert_fields])
 
 
-PhaseDirection = Tuple[bool, models.PhaseIndex]
+# The audit stream, whether it's a revert, and the phase
+PhaseDirection = Tuple[str, bool, models.PhaseIndex]
 
 
 class AuditMapper(Mapper[models.MigrationAudit, PhaseDirection]):
@@ -114,36 +422,41 @@ class AuditMapper(Mapper[models.MigrationAudit, PhaseDirection]):
     _index_fields = list(f.name for f in dataclasses.fields(models.PhaseIndex))
 
     fields = _my_fields + _index_fields
-    insert_fields = ["is_revert"] + _index_fields
+    insert_fields = ["stream", "is_revert"] + _index_fields
     table = "migration_audit"
 
     @classmethod
     def map(cls, row: Sequence[Any]) -> models.MigrationAudit:
-        index = models.PhaseIndex(*row[-6:])
+        rev, mig_h, sch_h, pre_deploy, change, phase = row[-6:]
+        index = models.PhaseIndex(
+            rev, bytes(mig_h), bytes(sch_h), pre_deploy, change, phase
+        )
         return models.MigrationAudit(*row[:-6], index)  # type: ignore
 
     @classmethod
     def get_insert_params(cls, obj: PhaseDirection) -> Dict[str, Any]:
-        is_revert, index = obj
+        stream, is_revert, index = obj
         result = dataclasses.asdict(index)
+        result["stream"] = stream
         result["is_revert"] = is_revert
         return result
 
 
 class RevisionMapper(Mapper[models.DbRevision, models.Revision]):
-    insert_fields = [
-        "revision",
-        "migration_hash",
-        "schema_hash",
-        "migration_text",
-        "schema_text",
+    insert_fields = ["revision", "migration_hash", "schema_hash"]
+    # The texts are stored in blobs, addressed by the revision's hashes
+    fields = insert_fields + [
+        f"{SCHEMA_NAME}.blob_chain(migration_hash)",
+        f"{SCHEMA_NAME}.blob_chain(schema_hash)",
+        "is_deleted",
     ]
-    fields = insert_fields + ["is_deleted"]
     table = "revisions"
 
     @classmethod
     def map(cls, row: Sequence[Any]) -> models.DbRevision:
-        rev, mig_h, sch_h, mig_t, sch_t, is_del = row
+        rev, mig_h, sch_h, mig_chain, sch_chain, is_del = row
+        mig_t = blobs.decode([bytes(data) for data in mig_chain])
+        sch_t = blobs.decode([bytes(data) for data in sch_chain])
         result = models.DbRevision(rev, mig_t, sch_t, is_del)
         assert result.migration_hash == bytes(mig_h)
         assert result.schema_hash == bytes(sch_h)
@@ -156,6 +469,59 @@ class RevisionMapper(Mapper[models.DbRevision, models.Revision]):
         return params
 
 
+RevisionHashes = Tuple[int, bytes, bytes, bool]
+
+
+class RevisionHashMapper(Mapper[RevisionHashes, None]):
+    """Reads just the number, hashes and is_deleted of a revision, not its texts."""
+
+    fields = ["revision", "migration_hash", "schema_hash", "is_deleted"]
+    table = "revisions"
+
+    @classmethod
+    def map(cls, row: Sequence[Any]) -> RevisionHashes:
+        rev, mig_h, sch_h, is_del = row
+        return rev, bytes(mig_h), bytes(sch_h), is_del
+
+    @classmethod
+    def get_insert_params(cls, obj: None) -> Dict[str, Any]:
+        raise NotImplementedError()
+
+
+class BlobMapper(Mapper[blobs.Blob, blobs.Blob]):
+    insert_fields = [f.name for f in dataclasses.fields(blobs.Blob)]
+    fields = insert_fields
+    table = "blobs"
+
+    @classmethod
+    def map(cls, row: Sequence[Any]) -> blobs.Blob:
+        hash, base_hash, depth, size, data = row
+        return blobs.Blob(
+            bytes(hash), base_hash and bytes(base_hash), depth, size, bytes(data)
+        )
+
+    @classmethod
+    def get_insert_params(cls, obj: blobs.Blob) -> Dict[str, Any]:
+        return dataclasses.asdict(obj)
+
+
+class QueueMapper(Mapper[models.QueuedChain, models.QueuedChain]):
+    insert_fields = [f.name for f in dataclasses.fields(models.QueuedChain)]
+    fields = insert_fields
+    table = "phase_queue"
+
+    @classmethod
+    def map(cls, row: Sequence[Any]) -> models.QueuedChain:
+        stream, batch, chain, rev, mig_h, sch_h, *rest = row
+        return models.QueuedChain(
+            stream, batch, chain, rev, bytes(mig_h), bytes(sch_h), *rest
+        )
+
+    @classmethod
+    def get_insert_params(cls, obj: models.QueuedChain) -> Dict[str, Any]:
+        return dataclasses.asdict(obj)
+
+
 class ConnectionMapper(Mapper[models.AppConnection, None]):
     fields = ["pid", "revision", "schema_hash", "backend_start"]
 
@@ -180,19 +546,138 @@ class Results(List[T]):
         return Results(row_to_obj(t) for t in self)
 
 
+# psycopg2 has no type stubs, so its cursor is Any to mypy. Subclassing it (rather
+# than wrapping it) keeps it a drop-in cursor for everything else in psycopg2.
+class CountingCursor(psycopg2.extensions.cursor):  # type: ignore[misc, no-any-unimported]
+    """A cursor that counts how many statements (i.e. round trips) it has sent."""
+
+    round_trips = 0
+
+    def execute(self, query: Any, vars: Optional[Any] = None) -> None:
+        self.round_trips += 1
+        super().execute(query, vars)
+
+
+@dataclasses.dataclass(frozen=True)
+class PreparedQuery:
+    """A query that can be PREPAREd once per connection and then run by name."""
+
+    name: str
+    text: str
+    # The parameter names (or positions) of $1, $2, ... in `text`
+    params: Tuple[Union[str, int], ...]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def build(sql: str) -> PreparedQuery:
+        """Converts a psycopg2-style query to a prepared one. Cached, so the text for
+        each distinct query is only generated once per process."""
+        params: List[Union[str, int]] = []
+
+        def replace(m: Match[str]) -> str:
+            if m.group(0) == "%%":
+                return "%"
+            param: Union[str, int] = m.group(1) or len(
+                [p for p in params if isinstance(p, int)]
+            )
+            if param not in params:
+                params.append(param)
+            return f"${params.index(param) + 1}"
+
+        text = PLACEHOLDER_RE.sub(replace, sql)
+        name = f"{NAME}_{hashlib.sha1(text.encode()).hexdigest()[:16]}"
+        return PreparedQuery(name, text, tuple(params))
+
+    def bind(self, args: Any) -> List[Any]:
+        return [args[param] for param in self.params]
+
+
+PLACEHOLDER_RE = re.compile(r"%\((\w+)\)s|%s|%%")
+
+
 class Database:
-    def __init__(self, database_url: str) -> None:
+    def __init__(
+        self,
+        database_url: str,
+        prepare_statements: bool = True,
+        tenant: Optional[str] = None,
+    ) -> None:
         self.url = database_url
         self.conn = psycopg2.connect(database_url)
         self.conn.set_session(autocommit=True)
-        self.cur = self.conn.cursor()
+        self.cur = self.conn.cursor(cursor_factory=CountingCursor)
         self.in_tx = False
+        self.prepare_statements = prepare_statements
+        # Names of the statements PREPAREd on this connection
+        self.prepared: Set[str] = set()
+        # How many times a mapper query was run with an already-prepared statement
+        self.prepared_hits = 0
+        self.tenant: Optional[str] = None
+        if tenant is not None:
+            self.use_tenant(tenant)
+
+    def use_tenant(self, tenant: Optional[str]) -> None:
+        """Switches to migrating the given tenant schema (or None for the default,
+        `public`). Each tenant has its own stream of audits and its own shim schemas,
+        and migrations' DDL is run with only the tenant schema on the search path."""
+        if tenant == self.tenant:
+            return
+        if tenant is None:
+            self.cur.execute("RESET search_path")
+        else:
+            self.cur.execute(f"SET search_path = {tenant}")
+        self.tenant = tenant
+
+    @property
+    def stream(self) -> str:
+        """The audit stream we read and write."""
+        return self.tenant or ""
+
+    @property
+    def schema(self) -> str:
+        """The schema that migrations apply to."""
+        return self.tenant or "public"
+
+    def shim_schema(self, revision: int) -> str:
+        """The 'shim schema' used by column-rename migrations in the given revision."""
+        shim_schema = SHIM_SCHEMA_FORMAT % revision
+        if self.tenant is None:
+            return shim_schema
+        return f"{self.tenant}_{shim_schema}"
+
+    @property
+    def round_trips(self) -> int:
+        """The number of round trips made to the database so far."""
+        return cast(int, self.cur.round_trips)
 
     def _fetch(self, query: str, args: Optional[Any] = None) -> Results[Any]:
         self.cur.execute(query, args or ())
         result = Results(self.cur.fetchall())
         return result
 
+    def _fetch_prepared(self, query: str, args: Optional[Any] = None) -> Results[Any]:
+        if not self.prepare_statements:
+            return self._fetch(query, args)
+        self.cur.execute(self._execute_sql(PreparedQuery.build(query), args))
+        return Results(self.cur.fetchall())
+
+    def _execute_sql(self, query: PreparedQuery, args: Optional[Any]) -> str:
+        """Returns an EXECUTE statement for the query, preparing it first if this
+        connection hasn't yet."""
+        if query.name in self.prepared:
+            self.prepared_hits += 1
+        else:
+            self.cur.execute(f"PREPARE {query.name} AS {query.text}")
+            self.prepared.add(query.name)
+        values = query.bind(args)
+        if not values:
+            return f"EXECUTE {query.name}"
+        placeholders = ", ".join(["%s"] * len(values))
+        return cast(
+            bytes,
+            self.cur.mogrify(f"EXECUTE {query.name} ({placeholders})", values),
+        ).decode()
+
     @contextmanager
     def tx(self) -> Iterator[None]:
         assert not self.in_tx
@@ -203,6 +688,108 @@ class Database:
             finally:
                 self.in_tx = False
 
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Runs the block in an explicit transaction. (Unlike tx(), which relies on each
+        statement being its own transaction in autocommit mode.)"""
+        assert not self.in_tx
+        self.cur.execute("BEGIN")
+        self.in_tx = True
+        try:
+            yield
+        except BaseException:
+            self.cur.execute("ROLLBACK")
+            raise
+        else:
+            self.cur.execute("COMMIT")
+        finally:
+            self.in_tx = False
+
+    def count_exclusive_locks(self) -> int:
+        """How many tables our transaction holds ACCESS EXCLUSIVE locks on."""
+        return cast(
+            int,
+            self._fetch_prepared(
+                """
+        SELECT count(*) FROM pg_locks
+        WHERE pid = pg_backend_pid() AND locktype = 'relation'
+          AND mode = 'AccessExclusiveLock' AND granted
+        """
+            )[0][0],
+        )
+
+    def get_old_clients(
+        self, revision: int, client_ttl: float, sessions: bool = True
+    ) -> List[Tuple[int, str]]:
+        """Returns each connected client that registered a revision before the given
+        one (see LIVE_CLIENTS), oldest revision first. Clients registered per
+        transaction count as connected for client_ttl seconds after they were last
+        seen. Leaves out clients registered per session unless `sessions`. Prunes
+        registrations of clients that have gone along the way."""
+        live = LIVE_CLIENTS if sessions else LIVE_TRANSACTION_CLIENTS
+        return [
+            (row[0], row[1])
+            for row in self._fetch_prepared(
+                f"""
+        WITH {PRUNE_CLIENTS_CTE}
+        SELECT revision, client FROM ({live}) live
+        WHERE revision < %(revision)s
+        ORDER BY revision, client
+        """,
+                {"revision": revision, "client_ttl": client_ttl},
+            )
+        ]
+
+    def get_client_histogram(self, client_ttl: float) -> Dict[int, int]:
+        """Returns how many connected clients registered each revision. Prunes
+        registrations of clients that have gone along the way."""
+        rows = self._fetch_prepared(
+            f"""
+        WITH {PRUNE_CLIENTS_CTE}
+        SELECT revision, count(*) FROM ({LIVE_CLIENTS}) live
+        GROUP BY revision
+        """,
+            {"client_ttl": client_ttl},
+        )
+        return {revision: count for revision, count in rows}
+
+    def listen(self, channel: str) -> None:
+        self.cur.execute(f"LISTEN {channel}")
+
+    def unlisten(self, channel: str) -> None:
+        self.cur.execute(f"UNLISTEN {channel}")
+
+    def wait_for_notify(self, timeout: float) -> bool:
+        """Waits up to `timeout` seconds for a notification on a channel we're
+        listening on, and returns whether one came. Any others that are queued up are
+        consumed along with it."""
+        if not self.conn.notifies:
+            select.select([self.conn], [], [], timeout)
+            self.conn.poll()
+        notified = bool(self.conn.notifies)
+        self.conn.notifies.clear()
+        return notified
+
+    def get_index_state(self, name: str) -> Optional[Tuple[bool, bool]]:
+        """Returns whether the index (in the schema that migrations apply to) is valid,
+        and whether another backend is building it right now. Or None if there's no
+        such index."""
+        row = self._fetch_prepared(
+            """
+        SELECT pg_index.indisvalid, EXISTS (
+          SELECT FROM pg_stat_progress_create_index progress
+          WHERE progress.index_relid = pg_class.oid
+            AND progress.pid <> pg_backend_pid()
+        )
+        FROM pg_class
+        JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+        JOIN pg_index ON pg_index.indexrelid = pg_class.oid
+        WHERE pg_namespace.nspname = %s AND pg_class.relname = %s
+        """,
+            (self.schema, name),
+        ).first()
+        return None if row is None else (row[0], row[1])
+
     def is_set_up(self) -> bool:
         args = {"schema": SCHEMA_NAME}
         result = self._fetch(
@@ -218,11 +805,89 @@ class Database:
     def create_schema(self) -> None:
         with self.tx():
             self.cur.execute(SCHEMA_DDL)
+        self.upgrade_schema()
+
+    def get_schema_version(self) -> int:
+        """Returns the version of our schema in the database. Schemas created before
+        it was versioned are version 1."""
+        is_versioned = self._fetch(
+            "SELECT to_regclass(%s) IS NOT NULL", (f"{SCHEMA_NAME}.schema_version",)
+        )[0][0]
+        if not is_versioned:
+            return 1
+        return cast(
+            int, self._fetch(f"SELECT version FROM {SCHEMA_NAME}.schema_version")[0][0]
+        )
+
+    def upgrade_schema(self) -> bool:
+        """Upgrades our schema in the database to SCHEMA_VERSION, if it isn't already.
+        Returns whether there was anything to upgrade."""
+        version = self.get_schema_version()
+        if version == SCHEMA_VERSION:
+            return False
+        for v in range(version + 1, SCHEMA_VERSION + 1):
+            getattr(self, f"_upgrade_schema_to_v{v}")()
+        self.deallocate()
+        return True
+
+    def _upgrade_schema_to_v11(self) -> None:
+        self.cur.execute(SCHEMA_V11_DDL)
+
+    def _upgrade_schema_to_v10(self) -> None:
+        self.cur.execute(SCHEMA_V10_DDL)
+
+    def _upgrade_schema_to_v9(self) -> None:
+        self.cur.execute(SCHEMA_V9_DDL)
+
+    def _upgrade_schema_to_v8(self) -> None:
+        self.cur.execute(SCHEMA_V8_DDL)
+
+    def _upgrade_schema_to_v7(self) -> None:
+        self.cur.execute(SCHEMA_V7_DDL)
+
+    def _upgrade_schema_to_v6(self) -> None:
+        self.cur.execute(SCHEMA_V6_DDL)
+
+    def _upgrade_schema_to_v5(self) -> None:
+        self.cur.execute(SCHEMA_V5_DDL)
+
+    def _upgrade_schema_to_v4(self) -> None:
+        self.cur.execute(SCHEMA_V4_DDL)
+
+    def _upgrade_schema_to_v3(self) -> None:
+        self.cur.execute(SCHEMA_V3_DDL)
+
+    def _upgrade_schema_to_v2(self) -> None:
+        rows = self._fetch(
+            f"""
+        SELECT migration_text, schema_text FROM {SCHEMA_NAME}.revisions
+        ORDER BY revision, is_deleted DESC
+        """
+        )
+        encoded = BlobEncoder()
+        for mig_t, sch_t in rows:
+            encoded.add(mig_t, sch_t)
+        # One statement, so the upgrade happens atomically
+        self.cur.execute(
+            f"""
+        {SCHEMA_V2_DDL};
+        {encoded.insert_sql(self.cur)};
+        ALTER TABLE {SCHEMA_NAME}.revisions
+          DROP COLUMN migration_text,
+          DROP COLUMN schema_text;
+        """
+        )
+
+    def deallocate(self) -> None:
+        """Forgets all prepared statements, e.g. because the tables they use changed."""
+        if self.prepared:
+            self.cur.execute("DEALLOCATE ALL")
+            self.prepared.clear()
 
     def select(
         self, mapper: Type[Mapper[T, Any]], rest: str, args: Any = None
     ) -> Results[T]:
-        return self._fetch(
+        return self._fetch_prepared(
             f"""
         SELECT {mapper.columns()}
         FROM {SCHEMA_NAME}.{mapper.table}
@@ -235,48 +900,56 @@ class Database:
         # TODO: remove transactional assertion
         args = mapper.get_insert_params(obj)
         return (
-            self._fetch(
-                f"""
-        INSERT INTO {SCHEMA_NAME}.{mapper.table}
-          ({mapper.insert_columns()})
-        VALUES ({mapper.insert_placeholder()})
-        {rest}
-        RETURNING {mapper.columns()}""",
-                args,
-            )
-            .map(mapper.map)
-            .one()
+            self._fetch_prepared(insert_sql(mapper, rest), args).map(mapper.map).one()
         )
 
     def update(
-        self, mapper: Type[Mapper[T, Any]], set_where: str, args: Sequence[Any]
+        self, mapper: Type[Mapper[T, Any]], set_where: str, args: Any
     ) -> Results[T]:
         # TODO: remove transactional assertion
-        return self._fetch(
-            f"""
-        UPDATE {SCHEMA_NAME}.{mapper.table}
-        {set_where}
-        RETURNING {mapper.columns()}
-        """,
-            args,
-        ).map(mapper.map)
+        return self._fetch_prepared(update_sql(mapper, set_where), args).map(mapper.map)
 
     def get_last_finished(self) -> Optional[models.MigrationAudit]:
         return self.select(
             AuditMapper,
             """
-            WHERE finished_at IS NOT NULL
+            WHERE stream = %s AND finished_at IS NOT NULL
             ORDER BY id DESC LIMIT 1
             """,
+            (self.stream,),
         ).first()
 
     def get_latest_audit(self) -> Optional[models.MigrationAudit]:
-        return self.select(AuditMapper, "ORDER BY id DESC LIMIT 1").first()
+        return self.select(
+            AuditMapper, "WHERE stream = %s ORDER BY id DESC LIMIT 1", (self.stream,)
+        ).first()
+
+    def get_unfinished_audits(self) -> Results[models.MigrationAudit]:
+        return self.select(
+            AuditMapper,
+            "WHERE stream = %s AND finished_at IS NULL ORDER BY id",
+            (self.stream,),
+        )
+
+    def get_audits_since(self, audit_id: int) -> Results[models.MigrationAudit]:
+        return self.select(
+            AuditMapper,
+            "WHERE stream = %s AND id > %s ORDER BY id",
+            (self.stream, audit_id),
+        )
 
     def audit_phase_start(
-        self, index: models.PhaseIndex, is_revert: bool = False
+        self, index: models.PhaseIndex, is_revert: bool = False, adopt: bool = False
     ) -> models.MigrationAudit:
-        return self.insert(AuditMapper, (is_revert, index))
+        """Records that the phase has started. If adopt is True and it already started
+        but didn't finish, returns that record instead."""
+        if not adopt:
+            return self.insert(AuditMapper, (self.stream, is_revert, index))
+        on_conflict = f"""
+        ON CONFLICT ({", ".join(UNFINISHED_AUDIT_KEY)})
+          WHERE started_at IS NOT NULL AND finished_at IS NULL
+        DO UPDATE SET started_at = {AuditMapper.table}.started_at"""
+        return self.insert(AuditMapper, (self.stream, is_revert, index), on_conflict)
 
     def audit_phase_end(self, audit: models.MigrationAudit) -> models.MigrationAudit:
         return self.update(
@@ -285,13 +958,44 @@ class Database:
             (audit.id,),
         ).one()
 
+    def run_audited(
+        self, index: models.PhaseIndex, sql: str, is_revert: bool = False
+    ) -> models.MigrationAudit:
+        """Runs `sql` for the given phase, along with its audit_phase_start and
+        audit_phase_end bookkeeping, in a single round trip.
+
+        Postgres runs a multi-statement query in a single transaction, so this is just
+        as atomic as doing the three steps inside tx()."""
+        start_sql = insert_sql(AuditMapper)
+        start_args = AuditMapper.get_insert_params((self.stream, is_revert, index))
+        # We can't use RETURNING from the INSERT in the UPDATE, but currval() is
+        # local to our session so it's the id we just inserted.
+        end_sql = update_sql(
+            AuditMapper,
+            f"""SET finished_at = now()
+            WHERE id = currval(pg_get_serial_sequence(
+              '{SCHEMA_NAME}.{AuditMapper.table}', 'id'
+            ))""",
+        )
+        if self.prepare_statements:
+            start = self._execute_sql(PreparedQuery.build(start_sql), start_args)
+            end = self._execute_sql(PreparedQuery.build(end_sql), None)
+        else:
+            start = cast(bytes, self.cur.mogrify(start_sql, start_args)).decode()
+            end = end_sql
+        # Not _fetch: sql isn't a format string, so mustn't be interpolated. The
+        # newline protects against sql ending in a -- comment.
+        self.cur.execute(f"{start};\n{sql}\n;{end}")
+        return Results(self.cur.fetchall()).map(AuditMapper.map).one()
+
     def get_audit(
         self, index: models.PhaseIndex, is_revert: bool = False
     ) -> models.MigrationAudit:
         return self.select(
             AuditMapper,
             f"""
-        WHERE revision = %(revision)s
+        WHERE stream = %(stream)s
+        AND revision = %(revision)s
         AND migration_hash = %(migration_hash)s
         AND schema_hash = %(schema_hash)s
         AND pre_deploy = %(pre_deploy)s
@@ -300,9 +1004,135 @@ class Database:
         AND is_revert = %(is_revert)s
         ORDER BY id DESC LIMIT 1
         """,
-            AuditMapper.get_insert_params((is_revert, index)),
+            AuditMapper.get_insert_params((self.stream, is_revert, index)),
         ).one()
 
+    @contextmanager
+    def advisory_lock(self, name: str, shared: bool = False) -> Iterator[None]:
+        """Holds a session-level advisory lock, shared by everyone using this name.
+        With shared=True, other shared holders don't exclude each other (but still
+        exclude, and are excluded by, exclusive ones)."""
+        suffix = "_shared" if shared else ""
+        self.cur.execute(f"SELECT pg_advisory_lock{suffix}(hashtext(%s))", (name,))
+        try:
+            yield
+        finally:
+            self.cur.execute(
+                f"SELECT pg_advisory_unlock{suffix}(hashtext(%s))", (name,)
+            )
+
+    def publish_chains(self, chains: List[models.QueuedChain]) -> None:
+        """Replaces our stream's phase queue with the given chains."""
+        insert = insert_values_sql(self.cur, QueueMapper, chains) if chains else ""
+        # Not _fetch: the values are already interpolated
+        self.cur.execute(
+            cast(
+                bytes,
+                self.cur.mogrify(
+                    f"DELETE FROM {SCHEMA_NAME}.{QueueMapper.table} WHERE stream = %s",
+                    (self.stream,),
+                ),
+            ).decode()
+            + f";\n{insert}"
+        )
+
+    def claim_chain(self, worker: str) -> Optional[models.QueuedChain]:
+        """Claims the next chain in our stream's queue that's ready to run: one that
+        nobody (alive) has claimed, with every chain in earlier batches finished.
+        Nothing is claimable once a chain has failed.
+
+        Other workers' claims are skipped rather than waited for, so this never
+        blocks."""
+        return self.update(
+            QueueMapper,
+            f"""
+        SET claimed_by = %(worker)s,
+            claimed_pid = pg_backend_pid(),
+            claimed_backend_start = (
+              SELECT backend_start FROM pg_stat_activity WHERE pid = pg_backend_pid()
+            )
+        WHERE (stream, batch, chain) = (
+          SELECT stream, batch, chain FROM {SCHEMA_NAME}.phase_queue c
+          WHERE stream = %(stream)s AND finished_at IS NULL AND error IS NULL
+            AND NOT EXISTS (
+              SELECT FROM {SCHEMA_NAME}.phase_queue f
+              WHERE f.stream = c.stream AND f.error IS NOT NULL
+            )
+            AND (claimed_pid IS NULL OR NOT EXISTS (
+              SELECT FROM pg_stat_activity a
+              WHERE a.pid = c.claimed_pid
+                AND a.backend_start = c.claimed_backend_start
+            ))
+            AND NOT EXISTS (
+              SELECT FROM {SCHEMA_NAME}.phase_queue p
+              WHERE p.stream = c.stream AND p.batch < c.batch
+                AND p.finished_at IS NULL
+            )
+          ORDER BY batch, chain LIMIT 1
+          FOR UPDATE SKIP LOCKED
+        )""",
+            {"worker": worker, "stream": self.stream},
+        ).first()
+
+    def finish_chain(
+        self, chain: models.QueuedChain, error: Optional[str] = None
+    ) -> None:
+        """Marks the chain as finished, or as failed with the given error, as long as
+        it's still our claim. (If the plan has been replaced since we claimed it, the
+        chain in the same place in the new plan is left alone.)"""
+        self.update(
+            QueueMapper,
+            f"""
+        SET finished_at = CASE WHEN %(error)s::TEXT IS NULL THEN now() END,
+            error = %(error)s
+        WHERE stream = %(stream)s AND batch = %(batch)s AND chain = %(chain)s
+          AND claimed_pid = pg_backend_pid()
+          AND claimed_backend_start = (
+            SELECT backend_start FROM pg_stat_activity WHERE pid = pg_backend_pid()
+          )""",
+            {
+                "error": error,
+                "stream": chain.stream,
+                "batch": chain.batch,
+                "chain": chain.chain,
+            },
+        )
+
+    def count_live_claims(self) -> int:
+        """How many unfinished chains in our stream's queue are claimed by workers
+        that are still alive, as judged by claim_chain. Waits for any claim that's in
+        progress to commit, so that it's counted."""
+        return cast(
+            int,
+            self._fetch_prepared(
+                f"""
+        WITH unfinished AS (
+          SELECT claimed_pid, claimed_backend_start FROM {SCHEMA_NAME}.phase_queue
+          WHERE stream = %s AND finished_at IS NULL AND error IS NULL
+          FOR UPDATE
+        )
+        SELECT count(*) FROM unfinished c
+        WHERE EXISTS (
+          SELECT FROM pg_stat_activity a
+          WHERE a.pid = c.claimed_pid AND a.backend_start = c.claimed_backend_start
+        )
+        """,
+                (self.stream,),
+            )[0][0],
+        )
+
+    def get_queue_status(self) -> Tuple[int, Optional[str]]:
+        """Returns how many chains in our stream's queue haven't finished, and the
+        error from one that failed, if any."""
+        unfinished, error = self._fetch_prepared(
+            f"""
+        SELECT count(*) FILTER (WHERE finished_at IS NULL), min(error)
+        FROM {SCHEMA_NAME}.phase_queue WHERE stream = %s
+        """,
+            (self.stream,),
+        )[0]
+        return unfinished, error
+
     def close(self) -> None:
         self.conn.close()
 
@@ -311,35 +1141,338 @@ class Database:
         with temp_db_url(self.conn) as url:
             yield url
 
-    def upsert_revision(self, revision: models.Revision) -> models.DbRevision:
+    def template_db_url(self, schema: str) -> str:
+        """Returns the URL of a database with the given schema loaded into it, which
+        is cached (keyed by the schema's hash) for the next caller that needs the same
+        schema. Callers mustn't modify it."""
+        name = TEMPLATE_DB_PREFIX + blobs.text_hash(schema).hex()[:32]
+        if not self._database_exists(name):
+            # Load into a database with a different name and then rename it, so that
+            # a failed load can't leave a half-loaded template behind
+            suffix = "".join(random.choices("qwertyuiopasdfghjklzxcvbnm", k=6))
+            loading = f"{name}_{suffix}"
+            self.cur.execute(f"CREATE DATABASE {loading}")
+            try:
+                self._touch_database(loading)
+                conn = psycopg2.connect(replace_db(self.url, loading))
+                with contextlib.closing(conn):
+                    conn.set_session(autocommit=True)
+                    with conn.cursor() as cur:
+                        cur.execute(schema)
+                self.cur.execute(f"ALTER DATABASE {loading} RENAME TO {name}")
+            except psycopg2.Error:
+                # Someone else may have loaded the same schema concurrently
+                if not self._database_exists(name):
+                    raise
+            finally:
+                self.cur.execute(f"DROP DATABASE IF EXISTS {loading}")
+        self._touch_database(name)
+        return replace_db(self.url, name)
+
+    def evict_templates(self, keep: int, max_age: datetime.timedelta) -> List[str]:
+        """Drops cached template databases that weren't among the `keep` most recently
+        used, or haven't been used within `max_age`. Returns the names of the ones
+        dropped. Ones that are in use are left alone."""
+        prefix = TEMPLATE_DB_PREFIX.replace("_", "\\_")
+        rows = self._fetch(
+            """
+        SELECT datname, shobj_description(oid, 'pg_database')
+        FROM pg_database WHERE datname LIKE %s
+        """,
+            (prefix + "%",),
+        )
+        epoch = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+        last_used = {name: parse_timestamp(comment) or epoch for name, comment in rows}
+        by_recency = sorted(last_used, key=last_used.__getitem__, reverse=True)
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - max_age
+        dropped = []
+        for i, name in enumerate(by_recency):
+            if i < keep and last_used[name] >= cutoff:
+                continue
+            try:
+                self.cur.execute(f"DROP DATABASE {name}")
+            except psycopg2.Error:
+                continue
+            dropped.append(name)
+        return dropped
+
+    def _database_exists(self, name: str) -> bool:
+        return cast(
+            bool,
+            self._fetch(
+                "SELECT EXISTS (SELECT FROM pg_database WHERE datname = %s)", (name,)
+            )[0][0],
+        )
+
+    def _touch_database(self, name: str) -> None:
+        """Records that the database was just used, in its comment."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.cur.execute(f"COMMENT ON DATABASE {name} IS %s", (now.isoformat(),))
+
+    def upsert_revision(self, revision: models.Revision) -> None:
         """Upserts the given revision into the database.
 
         Raises an exception if there's already a *different* (non-deleted) revision
         with the same number."""
-        on_conflict = "ON CONFLICT (revision, migration_hash, schema_hash) DO NOTHING"
-        return self.insert(RevisionMapper, revision, on_conflict)
+        self.upsert_revisions([revision])
 
-    def get_revisions(self) -> models.RevisionList:
-        """Returns the sequence of revisions stored in the (excluding deleted ones)."""
-        results = self.select(RevisionMapper, "WHERE NOT is_deleted")
-        return models.RevisionList({rev.number: rev for rev in results})
+    def upsert_revisions(self, revisions: Sequence[models.Revision]) -> None:
+        """Upserts the given revisions into the database with a single INSERT.
 
-    def create_shim_schema(self, revision: int) -> None:
-        """Creates the 'shim schema' used by column-rename migrations. Idempotent."""
-        shim_schema = SHIM_SCHEMA_FORMAT % revision
-        parsed = urlparse(self.url)
-        username = shim_schema
-        password = parsed.password
-        search_path = self._fetch("SHOW search_path")[0][0]
-        # TODO: why is this ALTER USER necessary?! In manual testing, $user seems to
-        # refer to the name of the role we're inheriting from :(
+        Revisions that are already recorded are skipped without sending their texts.
+        Raises an exception if there's already a *different* (non-deleted) revision
+        with the same number as one of them."""
+        numbers = [rev.number for rev in revisions]
+        recorded = set(
+            self.select(RevisionHashMapper, "WHERE revision = ANY(%s)", (numbers,))
+        )
+        new = [
+            rev
+            for rev in revisions
+            if (rev.number, rev.migration_hash, rev.schema_hash, False) not in recorded
+        ]
+        if not new:
+            return
+        new.sort(key=lambda rev: rev.number)
+        encoded = BlobEncoder(self._get_previous_schema(new[0].number))
+        for rev in new:
+            encoded.add(rev.migration_text, rev.schema_text)
+        # Not _fetch: the values are already interpolated and may contain %s
         self.cur.execute(
             f"""
-        CREATE USER {shim_schema} IN ROLE {username} PASSWORD %(password)s INHERIT;
-        ALTER USER {shim_schema} SET search_path = {shim_schema}, {search_path};
+        {encoded.insert_sql(self.cur)};
+        {insert_values_sql(self.cur, RevisionMapper, new)}
+        ON CONFLICT (revision, migration_hash, schema_hash) DO NOTHING
+        """
+        )
+
+    def is_empty(self) -> bool:
+        """Whether there's nothing (no tables, views, sequences...) in the schema that
+        migrations apply to."""
+        result = self._fetch(
+            """
+        SELECT NOT EXISTS (
+          SELECT FROM pg_class JOIN pg_namespace ON pg_namespace.oid = relnamespace
+          WHERE nspname = %s
+        )""",
+            (self.schema,),
+        )[0][0]
+        return cast(bool, result)
+
+    def bootstrap(self, revisions: Sequence[models.Revision], schema_sql: str) -> None:
+        """Loads schema_sql (the last revision's schema) and records the revisions,
+        and every one of their phases as done, all in one transaction: as if each
+        phase had been run in turn."""
+        audits = [
+            (self.stream, False, index)
+            for revision in revisions
+            for index in revision.phase_indexes
+        ]
+        finish = self.cur.mogrify(
+            f"""
+        UPDATE {SCHEMA_NAME}.{AuditMapper.table} SET finished_at = now()
+        WHERE stream = %s AND finished_at IS NULL""",
+            (self.stream,),
+        ).decode()
+        with self.transaction():
+            self.upsert_revisions(revisions)
+            # Not _fetch: the schema and values may contain %s
+            self.cur.execute(
+                f"""
+        {schema_sql};
+        {insert_values_sql(self.cur, AuditMapper, audits)};
+        {finish}
+        """
+            )
+
+    def _get_previous_schema(self, number: int) -> Optional[Tuple[str, int]]:
+        """Returns the schema text of the latest revision before `number`, and the
+        depth of its blob, to delta-encode the next schema against."""
+        row = self._fetch_prepared(
+            f"""
+        SELECT {SCHEMA_NAME}.blob_chain(hash), depth
+        FROM {SCHEMA_NAME}.revisions JOIN {SCHEMA_NAME}.blobs ON hash = schema_hash
+        WHERE NOT is_deleted AND revision < %s
+        ORDER BY revision DESC LIMIT 1
+        """,
+            (number,),
+        ).first()
+        if row is None:
+            return None
+        chain, depth = row
+        return blobs.decode([bytes(data) for data in chain]), depth
+
+    def get_storage_stats(self) -> models.StorageStats:
+        text_bytes, stored_bytes = self._fetch(
+            f"""
+        SELECT
+          (SELECT COALESCE(sum(m.size + s.size), 0)
+             FROM {SCHEMA_NAME}.revisions
+             JOIN {SCHEMA_NAME}.blobs m ON m.hash = migration_hash
+             JOIN {SCHEMA_NAME}.blobs s ON s.hash = schema_hash),
+          (SELECT COALESCE(sum(octet_length(data)), 0) FROM {SCHEMA_NAME}.blobs)
+        """
+        )[0]
+        return models.StorageStats(int(text_bytes), int(stored_bytes))
+
+    def get_revisions(self, texts: bool = True) -> models.RevisionList:
+        """Returns the sequence of revisions stored in the database (excluding deleted
+        ones).
+
+        With texts=False, only the revisions' numbers and hashes are fetched up front,
+        and each revision's texts are fetched the first time they're needed."""
+        if texts:
+            results = self.select(RevisionMapper, "WHERE NOT is_deleted")
+            return models.RevisionList({rev.number: rev for rev in results})
+        hashes = self.select(RevisionHashMapper, "WHERE NOT is_deleted")
+        return models.RevisionList(
+            {
+                num: models.LazyDbRevision(
+                    num,
+                    (mig_h, sch_h),
+                    is_del,
+                    functools.partial(self.get_revision, num, mig_h, sch_h),
+                )
+                for num, mig_h, sch_h, is_del in hashes
+            }
+        )
+
+    def get_revision(
+        self, number: int, migration_hash: bytes, schema_hash: bytes
+    ) -> models.DbRevision:
+        return self.select(
+            RevisionMapper,
+            "WHERE revision = %s AND migration_hash = %s AND schema_hash = %s",
+            (number, migration_hash, schema_hash),
+        ).one()
+
+    def get_first_revision(self) -> Optional[int]:
+        """The number of the earliest revision recorded (and not deleted), if any."""
+        return cast(
+            Optional[int],
+            self._fetch(
+                f"SELECT min(revision) FROM {SCHEMA_NAME}.revisions WHERE NOT is_deleted"
+            )[0][0],
+        )
+
+    def get_first_audited_revision(self) -> Optional[int]:
+        """The number of the earliest revision with an audit row in our stream, if
+        any."""
+        return cast(
+            Optional[int],
+            self._fetch(
+                f"""
+        SELECT min(revision) FROM {SCHEMA_NAME}.{AuditMapper.table} WHERE stream = %s
+        """,
+                (self.stream,),
+            )[0][0],
+        )
+
+    def get_latest_audits(self) -> Dict[str, models.MigrationAudit]:
+        """The latest audit row in each stream (not just ours)."""
+        return {
+            audit.stream: audit
+            for audit in self.select(
+                AuditMapper,
+                f"""
+        WHERE id IN (
+          SELECT max(id) FROM {SCHEMA_NAME}.{AuditMapper.table} GROUP BY stream
+        )""",
+            )
+        }
+
+    def squash(self, baseline: models.Revision, streams: Sequence[str]) -> None:
+        """Replaces the revisions up to and including the baseline's number with the
+        baseline, and their audit rows in each of the streams with the stream's
+        latest one, made to point at the baseline's phase. Then deletes the blobs
+        nothing needs anymore.
+
+        Every one of the streams must already be past the baseline."""
+        index = dataclasses.asdict(baseline.last_index)
+        audits = f"{SCHEMA_NAME}.{AuditMapper.table}"
+        with self.transaction():
+            self.cur.execute(
+                f"""
+        DELETE FROM {audits} a
+        WHERE stream = ANY(%(streams)s) AND revision <= %(revision)s AND id < (
+          SELECT max(id) FROM {audits} b
+          WHERE b.stream = a.stream AND b.revision <= %(revision)s
+        );
+        UPDATE {audits} SET
+          revision = %(revision)s,
+          migration_hash = %(migration_hash)s,
+          schema_hash = %(schema_hash)s,
+          pre_deploy = %(pre_deploy)s,
+          change = %(change)s,
+          phase = %(phase)s,
+          is_revert = FALSE
+        WHERE stream = ANY(%(streams)s) AND revision <= %(revision)s;
+        DELETE FROM {SCHEMA_NAME}.revisions WHERE revision <= %(revision)s;
         """,
-            (password,),
+                dict(index, streams=list(streams)),
+            )
+            self.upsert_revisions([baseline])
+            self.cur.execute(
+                f"""
+        WITH RECURSIVE live (hash) AS (
+          SELECT migration_hash FROM {SCHEMA_NAME}.revisions
+          UNION SELECT schema_hash FROM {SCHEMA_NAME}.revisions
+          UNION SELECT b.base_hash
+            FROM {SCHEMA_NAME}.blobs b JOIN live ON b.hash = live.hash
+            WHERE b.base_hash IS NOT NULL
         )
+        DELETE FROM {SCHEMA_NAME}.blobs WHERE hash NOT IN (SELECT hash FROM live)
+        """
+            )
+
+    def fetch_names(self, query: str) -> List[str]:
+        """Runs a query (e.g. from the repo config) that returns a column of names."""
+        # Not _fetch: the query isn't a format string
+        self.cur.execute(query)
+        return [name for (name,) in self.cur.fetchall()]
+
+    def get_migration_hashes(self) -> Set[bytes]:
+        """Returns the hashes of every migration ever recorded, including deleted ones.
+
+        Migrations are parsed and validated before they're recorded, so these can be
+        loaded without validating them again."""
+        rows = self._fetch(f"SELECT migration_hash FROM {SCHEMA_NAME}.revisions")
+        return {bytes(mig_h) for (mig_h,) in rows}
+
+    def create_shim_schema(self, revision: int, create_role: bool = True) -> None:
+        """Creates the 'shim schema' used by column-rename migrations. Idempotent.
+
+        Unless create_role is False, also creates a login role of the same name with
+        the shim schema on its search path. Clients that connect as it pick up the
+        shim without running the incantation, at the cost of (e.g. with pgbouncer) a
+        separate connection pool per revision. Tenants' applications choose their
+        own search path, so for a tenant there's never a role."""
+        shim_schema = self.shim_schema(revision)
+        if self.tenant is not None or not create_role:
+            self.cur.execute(f"CREATE SCHEMA IF NOT EXISTS {shim_schema}")
+            return
+        parsed = urlparse(self.url)
+        username = parsed.username
+        password = parsed.password
+        search_path = self._fetch("SHOW search_path")[0][0]
+        role_exists = self._fetch(
+            "SELECT EXISTS (SELECT FROM pg_roles WHERE rolname = %s)", (shim_schema,)
+        )[0][0]
+        if not role_exists:
+            # TODO: why is this ALTER USER necessary?! In manual testing, $user seems
+            # to refer to the name of the role we're inheriting from :(
+            # Another process (e.g. upgrading another database on the same server)
+            # may create the role concurrently, which is fine.
+            self.cur.execute(
+                f"""
+            DO $$ BEGIN
+            CREATE USER {shim_schema} IN ROLE {username} PASSWORD %(password)s INHERIT;
+            ALTER USER {shim_schema} SET search_path = {shim_schema}, {search_path};
+            EXCEPTION WHEN duplicate_object OR unique_violation THEN NULL;
+            END $$
+            """,
+                {"password": password},
+            )
         self.cur.execute(f"CREATE SCHEMA IF NOT EXISTS {shim_schema}")
 
     def drop_shim_schema(self, revision: int) -> None:
@@ -347,10 +1480,69 @@ class Database:
 
         Does not cascade: the migration is assumed to have left the shim empty.
         (Otherwise we can't be sure it's safe to drop.)"""
-        shim_schema = SHIM_SCHEMA_FORMAT % revision
+        shim_schema = self.shim_schema(revision)
         self.cur.execute(f"DROP SCHEMA IF EXISTS {shim_schema}")
 
 
+def insert_sql(mapper: Type[Mapper[Any, Any]], rest: str = "") -> str:
+    return f"""
+        INSERT INTO {SCHEMA_NAME}.{mapper.table}
+          ({mapper.insert_columns()})
+        VALUES ({mapper.insert_placeholder()})
+        {rest}
+        RETURNING {mapper.columns()}"""
+
+
+def insert_values_sql(cur: Any, mapper: Type[Mapper[Any, U]], objs: List[U]) -> str:
+    """An INSERT of all the objs at once, with the values interpolated."""
+    row = f"({mapper.insert_placeholder()})"
+    values = ",\n".join(
+        cast(bytes, cur.mogrify(row, mapper.get_insert_params(obj))).decode()
+        for obj in objs
+    )
+    return f"""
+        INSERT INTO {SCHEMA_NAME}.{mapper.table}
+          ({mapper.insert_columns()})
+        VALUES {values}"""
+
+
+def update_sql(mapper: Type[Mapper[Any, Any]], set_where: str) -> str:
+    return f"""
+        UPDATE {SCHEMA_NAME}.{mapper.table}
+        {set_where}
+        RETURNING {mapper.columns()}
+        """
+
+
+class BlobEncoder:
+    """Encodes a sequence of revisions' texts as blobs, delta-encoding each schema
+    against the one before it."""
+
+    def __init__(self, previous_schema: Optional[Tuple[str, int]] = None) -> None:
+        self.previous_schema = previous_schema
+        self.blobs: Dict[bytes, blobs.Blob] = {}
+
+    def add(self, migration_text: str, schema_text: str) -> None:
+        self._add(migration_text)
+        schema_blob = self._add(schema_text, self.previous_schema)
+        self.previous_schema = (schema_text, schema_blob.depth)
+
+    def _add(self, text: str, base: Optional[Tuple[str, int]] = None) -> blobs.Blob:
+        hash = blobs.text_hash(text)
+        if hash not in self.blobs:
+            base_text, base_depth = base or (None, 0)
+            self.blobs[hash] = blobs.encode(text, base_text, base_depth)
+        return self.blobs[hash]
+
+    def insert_sql(self, cur: Any) -> str:
+        if not self.blobs:
+            return ""
+        return (
+            insert_values_sql(cur, BlobMapper, list(self.blobs.values()))
+            + "\n        ON CONFLICT (hash) DO NOTHING"
+        )
+
+
 @contextlib.contextmanager
 def temp_db_url(control_conn: Any) -> Iterator[str]:
     cur = control_conn.cursor()
@@ -365,6 +1557,13 @@ def temp_db_url(control_conn: Any) -> Iterator[str]:
         cur.close()
 
 
+def parse_timestamp(text: Optional[str]) -> Optional[datetime.datetime]:
+    try:
+        return datetime.datetime.fromisoformat(text or "")
+    except ValueError:
+        return None
+
+
 def replace_db(database_url: str, db_name: str) -> str:
     name = re.sub("/[^/]+$", "/" + db_name, database_url)
     return name
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import abc
+import os
 from dataclasses import dataclass
 from typing import Optional, NoReturn, TextIO, cast
 
@@ -13,24 +14,33 @@ class Context:
     config_path: str
     database_url: str
     ui: UserInterface
+    # The tenant schema to migrate, in a schema-per-tenant database
+    tenant: Optional[str] = None
+    # Where to keep the plan cache, if not next to the migrations
+    plan_cache_path: Optional[str] = None
     _db: Optional[db.Database] = None
     _repo: Optional[models.Repo] = None
 
     def repo(self) -> models.Repo:
         if self._repo is None:
-            self._repo = models.Repo.parse(self.config_path)
+            self._repo = models.Repo.parse(self.config_path, self.plan_cache_path)
         return self._repo
 
     def db(self) -> db.Database:
         if self._db is None:
-            self._db = db.Database(self.database_url)
+            self._db = db.Database(self.database_url, tenant=self.tenant)
         return self._db
 
     def close(self) -> None:
+        if self._repo is not None:
+            self._repo.save_plan_cache()
+        self.close_db()
+        self.ui.close()
+
+    def close_db(self) -> None:
         if self._db is not None:
             self._db.close()
             self._db = None
-        self.ui.close()
 
 
 class UserInterface(abc.ABC):
@@ -65,6 +75,10 @@ class UserInterface(abc.ABC):
     def open(self, filename: str, mode: str) -> TextIO:
         pass
 
+    @abc.abstractmethod
+    def remove(self, filename: str) -> None:
+        pass
+
     def close(self) -> None:
         pass
 
@@ -83,3 +97,6 @@ class ConsoleUserInterface(UserInterface):
 
     def open(self, filename: str, mode: str) -> TextIO:
         return cast(TextIO, open(filename, mode))
+
+    def remove(self, filename: str) -> None:
+        os.remove(filename)
@@ -0,0 +1,90 @@
+"""Holds back post-deploy phases while clients using an earlier revision are still
+connected, since those phases may break them.
+
+Clients register the revision they're using (with the incantation) when they
+connect, or at the start of each transaction behind a pooler in transaction mode,
+and triggers on the registration tables NOTIFY us whenever one changes, so
+while we wait we only re-check when something has changed. Nothing notifies us when
+a client disconnects (or a per-transaction registration expires, after
+client_ttl_seconds), though, so we also re-check every drain_recheck_seconds.
+
+With pgbouncer_admin_url set, clients connected through pgbouncer are read from its
+admin console instead of from the per-session registrations (see pgbouncer.py)."""
+from __future__ import annotations
+
+from typing import List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+from . import Context, text
+from .. import models, pgbouncer
+from ..constants import CONNECTIONS_CHANNEL
+
+# The revision of a connected client, and "PID <pid>", its client ID or (through
+# pgbouncer) its address
+Client = Tuple[int, str]
+
+
+def first_blocked(
+    ctx: Context, phases: Sequence[models.IndexRevisionChangePhase]
+) -> Tuple[int, List[Client]]:
+    """Returns the position of the first phase that has to wait for older clients to
+    go away (or len(phases) if none do), and those clients."""
+    post_deploy = [index.revision for index, _, _, _ in phases if not index.pre_deploy]
+    if not post_deploy:
+        return len(phases), []
+    clients = old_clients(ctx, max(post_deploy))
+    for i, (index, _, _, _) in enumerate(phases):
+        if index.pre_deploy:
+            continue
+        blocking = [client for client in clients if client[0] < index.revision]
+        if blocking:
+            return i, blocking
+    return len(phases), []
+
+
+def wait_for_clients(ctx: Context, revision: int) -> None:
+    """Waits until no clients using a revision before `revision` are connected."""
+    database = ctx.db()
+    recheck = ctx.repo().config.drain_recheck_seconds
+    # Listen first, so that we can't miss a change between checking and waiting
+    database.listen(CONNECTIONS_CHANNEL)
+    try:
+        reported: Optional[List[Client]] = None
+        while True:
+            clients = old_clients(ctx, revision)
+            if not clients:
+                return
+            if clients != reported:
+                ctx.ui.print(
+                    text.WAITING_FOR_CLIENTS.format(
+                        revision=clients[0][0], clients=describe_clients(clients)
+                    )
+                )
+                reported = clients
+            database.wait_for_notify(recheck)
+    finally:
+        database.unlisten(CONNECTIONS_CHANNEL)
+
+
+def old_clients(ctx: Context, revision: int) -> List[Client]:
+    """Returns each connected client using a revision before `revision`, oldest
+    revision first."""
+    config = ctx.repo().config
+    admin_url = config.pgbouncer_admin_url
+    clients = ctx.db().get_old_clients(
+        revision, config.client_ttl_seconds, sessions=admin_url is None
+    )
+    if admin_url is None:
+        return clients
+    database = config.pgbouncer_database or urlparse(ctx.database_url).path[1:]
+    pooled = pgbouncer.get_clients(admin_url, database)
+    return sorted(clients + [client for client in pooled if client[0] < revision])
+
+
+def describe_clients(clients: List[Client], limit: int = 3) -> str:
+    """The clients using the oldest revision, e.g. "PID 1, PID 2, web-3 and 20
+    more"."""
+    oldest = [client for revision, client in clients if revision == clients[0][0]]
+    if len(oldest) <= limit:
+        return ", ".join(oldest)
+    return f"{', '.join(oldest[:limit])} and {len(oldest) - limit} more"
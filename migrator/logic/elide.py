@@ -0,0 +1,154 @@
+"""Net-effect planning for catching up: skips the work of phases that create an
+object (an index, a constraint or a table) which a later pending phase drops again,
+along with that drop.
+
+The skipped phases are replaced with changes.Elided, so they're still audited (and
+can be reverted) as if they'd run.
+
+Dropping an index or a constraint that isn't there is harmless (the drops use IF
+EXISTS), so if we stop part-way it's fine to run the drop for real later. A table's
+drop isn't, so a table is only elided if everything from its CREATE to its DROP can
+run in one catch-up transaction, which run_transaction then commits all at once."""
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Set
+
+from . import schedule
+from .. import changes
+
+CREATE_TABLE_RE = re.compile(
+    r"\s*CREATE\s+TABLE\s+([\w.\"]+)\s*\(.*\)\s*;?\s*",
+    re.IGNORECASE | re.DOTALL,
+)
+DROP_TABLE_RE = re.compile(
+    r"\s*DROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?([\w.\"]+)\s*;?\s*", re.IGNORECASE
+)
+
+
+@dataclass(frozen=True)
+class Event:
+    kind: str  # "index", "constraint" or "table"
+    name: str
+    creates: bool
+
+
+def normalize(name: str) -> str:
+    name = name.replace('"', "").lower()
+    return name[len("public.") :] if name.startswith("public.") else name
+
+
+def event(step: schedule.Step) -> Optional[Event]:
+    """What the step does to an object we know how to elide, if anything."""
+    _, _, change, _ = step
+    inner = change.inner
+    if isinstance(inner, (changes.CreateIndex, changes.DropIndex)):
+        creates = isinstance(inner, changes.CreateIndex)
+        return Event("index", normalize(inner.name), creates)
+    if isinstance(inner, (changes.AddConstraint, changes.DropConstraint)):
+        on = normalize(inner.table or inner.domain or "")
+        name = f"{on}.{normalize(inner.name)}"
+        return Event("constraint", name, isinstance(inner, changes.AddConstraint))
+    if isinstance(inner, changes.DDLStep) and inner.up.count(";") <= 1:
+        match = CREATE_TABLE_RE.fullmatch(inner.up)
+        if match:
+            return Event("table", normalize(match[1]), True)
+        match = DROP_TABLE_RE.fullmatch(inner.up)
+        if match:
+            return Event("table", normalize(match[1]), False)
+    return None
+
+
+def table_of(step: schedule.Step) -> Optional[str]:
+    """The table the (non-DDL) step works on."""
+    inner = step[2].inner
+    table = getattr(inner, "table", None)
+    return normalize(table) if isinstance(table, str) else None
+
+
+def mentions(step: schedule.Step, name: str) -> bool:
+    """Whether any of the step's SQL (other than the name of what it works on) might
+    refer to the object."""
+    inner = step[2].inner
+    if isinstance(inner, changes.DDLStep):
+        sql = [inner.up]
+    else:
+        fields = inner.dict(exclude={"name", "table", "domain"})  # type: ignore
+        sql = [value for value in fields.values() if isinstance(value, str)]
+    bare = re.escape(name.rsplit(".", 1)[-1])
+    return any(re.search(rf"\b{bare}\b", s, re.IGNORECASE) for s in sql)
+
+
+def elide(steps: Sequence[schedule.Step]) -> List[schedule.Step]:
+    """Returns the steps, with those whose net effect is nothing replaced by
+    Elided phases."""
+    events = [event(step) for step in steps]
+    elided: Dict[int, changes.Elided] = {}
+    # Where each object was last created, and not yet dropped
+    created: Dict[Event, int] = {}
+    for i, ev in enumerate(events):
+        if ev is None:
+            continue
+        key = Event(ev.kind, ev.name, True)
+        if ev.creates:
+            # A constraint is created in two phases; remember the first
+            created.setdefault(key, i)
+            continue
+        start = created.pop(key, None)
+        if start is None:
+            continue
+        # Likewise, a constraint is dropped in two phases
+        end = i
+        while end + 1 < len(steps) and events[end + 1] == ev:
+            end += 1
+        span = covered(steps, events, start, end, ev, elided)
+        if span is None:
+            continue
+        for j in span:
+            elided.setdefault(j, changes.Elided())
+        if ev.kind == "table":
+            elided[start] = changes.Elided(opens=ev.name)
+            elided[end] = changes.Elided(closes=ev.name)
+    result = []
+    for i, (index, revision, change, phase) in enumerate(steps):
+        if i in elided:
+            phase = changes.Phase(elided[i], phase.down)
+        result.append((index, revision, change, phase))
+    return result
+
+
+def covered(
+    steps: Sequence[schedule.Step],
+    events: List[Optional[Event]],
+    start: int,
+    end: int,
+    ev: Event,
+    elided: Dict[int, changes.Elided],
+) -> Optional[Set[int]]:
+    """The steps to elide for an object created at `start` and dropped by `end`, or
+    None if that isn't safe: if something in between might use it, or (for a
+    table) if what's in between can't all run in one transaction."""
+    span = {start, end}
+    for j in range(start + 1, end):
+        if events[j] == Event(ev.kind, ev.name, True):
+            # The rest of a constraint's creation
+            span.add(j)
+            continue
+        if events[j] == Event(ev.kind, ev.name, False):
+            span.add(j)
+            continue
+        if ev.kind == "table" and table_of(steps[j]) == ev.name:
+            # Whatever is done to the table goes away along with it
+            span.add(j)
+            continue
+        if mentions(steps[j], ev.name):
+            return None
+        if ev.kind != "table":
+            continue
+        if j not in elided and (
+            not schedule.is_transactional(steps[j])
+            or schedule.concurrent_target(steps[j]) is not None
+        ):
+            return None
+    return span
@@ -0,0 +1,264 @@
+"""Upgrades many databases with the same schema (e.g. one per tenant) at once, or
+many tenant schemas in the same database."""
+from __future__ import annotations
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import List, NoReturn, Optional, Sequence, TextIO, Tuple
+from urllib.parse import urlparse
+
+from . import Context, UserInterface, drain, init, migrate, text
+from .. import db, models
+
+PRE_DEPLOY = "pre-deploy"
+POST_DEPLOY = "post-deploy"
+
+
+class FanOutError(Exception):
+    pass
+
+
+# A database URL, and the tenant schema in it (if any)
+Target = Tuple[str, Optional[str]]
+
+
+@dataclass
+class Outcome:
+    database_url: str
+    tenant: Optional[str] = None
+    phases: int = 0
+    error: Optional[BaseException] = None
+    # Clients using an earlier revision, which held back post-deploy phases
+    blocked: List[drain.Client] = field(default_factory=list)
+    # Everything printed while upgrading this database
+    output: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def done(self) -> bool:
+        """Whether it's been upgraded as far as it was asked to be."""
+        return self.ok and not self.blocked
+
+    def describe(self) -> str:
+        database = describe_url(self.database_url)
+        return database if self.tenant is None else f"{database} ({self.tenant})"
+
+
+class DatabaseUserInterface(UserInterface):
+    """Collects the output for one database, since they'd be interleaved otherwise.
+    Can't ask questions: there's nobody to answer them for each database."""
+
+    def __init__(self, parent: UserInterface, outcome: Outcome) -> None:
+        self.parent = parent
+        self.outcome = outcome
+
+    def print(
+        self, *args: object, sep: Optional[str] = " ", end: Optional[str] = "\n"
+    ) -> None:
+        self.outcome.output.append((sep or "").join(str(arg) for arg in args))
+
+    def input(self, prompt: str) -> str:
+        raise FanOutError(f"Can't ask for input: {prompt}")
+
+    def exit(self, status: int) -> NoReturn:
+        raise FanOutError("\n".join(self.outcome.output[-1:]))
+
+    def open(self, filename: str, mode: str) -> TextIO:
+        return self.parent.open(filename, mode)
+
+    def remove(self, filename: str) -> None:
+        self.parent.remove(filename)
+
+
+class Connections:
+    """A connection for each worker thread, which it keeps using for as long as it's
+    working on the same database (e.g. for successive tenants)."""
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._all: List[db.Database] = []
+
+    def get(self, database_url: str, tenant: Optional[str]) -> db.Database:
+        database: Optional[db.Database] = getattr(self._local, "database", None)
+        if database is not None and database.url != database_url:
+            self.discard()
+            database = None
+        if database is None:
+            database = db.Database(database_url)
+            self._local.database = database
+            self._all.append(database)
+        database.use_tenant(tenant)
+        return database
+
+    def discard(self) -> None:
+        """Closes this thread's connection, e.g. because it may be broken."""
+        database = getattr(self._local, "database", None)
+        if database is not None:
+            database.close()
+            self._local.database = None
+
+    def close(self) -> None:
+        for database in self._all:
+            database.close()
+
+
+def fan_out(
+    ctx: Context, database_urls: Sequence[str], stage: str = POST_DEPLOY
+) -> List[Outcome]:
+    """Upgrades each of the databases, up to repo.config.max_concurrent_databases at
+    a time. ctx is only used for its repo (which is parsed once and shared) and UI.
+
+    Every database is first brought up to the end of the latest revision's
+    pre-deploy phases. If stage is POST_DEPLOY and that succeeded everywhere, the
+    post-deploy phases are then run, so no database runs them before every database
+    is ready for the new code."""
+    return fan_out_targets(ctx, [(url, None) for url in database_urls], stage)
+
+
+def fan_out_tenants(
+    ctx: Context, tenants: Optional[Sequence[str]] = None, stage: str = POST_DEPLOY
+) -> List[Outcome]:
+    """Like fan_out, but upgrades each of the tenant schemas in ctx's database (by
+    default, the ones in the repo config)."""
+    if tenants is None:
+        tenants = get_tenants(ctx)
+    # The status schema is shared, so upgrade it once up front rather than have
+    # every tenant race to
+    init.upgrade_db(ctx)
+    return fan_out_targets(ctx, [(ctx.database_url, t) for t in tenants], stage)
+
+
+def get_tenants(ctx: Context) -> List[str]:
+    config = ctx.repo().config
+    tenants = list(config.tenant_schemas)
+    if config.tenant_schemas_query:
+        tenants += ctx.db().fetch_names(config.tenant_schemas_query)
+    return tenants
+
+
+def fan_out_targets(
+    ctx: Context, targets: Sequence[Target], stage: str = POST_DEPLOY
+) -> List[Outcome]:
+    connections = Connections()
+    try:
+        return _fan_out(ctx, targets, stage, connections)
+    finally:
+        connections.close()
+
+
+def _fan_out(
+    ctx: Context, targets: Sequence[Target], stage: str, connections: Connections
+) -> List[Outcome]:
+    repo = ctx.repo()
+    # Parse and plan every migration up front, rather than in each thread
+    repo.revisions.phase_table()
+    boundary = None
+    if repo.revisions:
+        boundary = repo.revisions[repo.revisions.last].post_deploy_index
+    outcomes = run_stage(ctx, targets, PRE_DEPLOY, boundary, connections)
+    if stage == POST_DEPLOY:
+        if all(outcome.ok for outcome in outcomes):
+            post_deploy = run_stage(ctx, targets, POST_DEPLOY, None, connections)
+            for outcome, post in zip(outcomes, post_deploy):
+                outcome.phases += post.phases
+                outcome.error = post.error
+                outcome.blocked = post.blocked
+                outcome.output += post.output
+        else:
+            ctx.ui.print(text.FAN_OUT_HOLDING_BACK)
+    ctx.ui.print(
+        text.FAN_OUT_SUMMARY.format(
+            ok=sum(outcome.done for outcome in outcomes),
+            total=len(outcomes),
+            phases=sum(outcome.phases for outcome in outcomes),
+            blocked=sum(outcome.ok and bool(outcome.blocked) for outcome in outcomes),
+            failed=sum(not outcome.ok for outcome in outcomes),
+        )
+    )
+    for outcome in outcomes:
+        if not outcome.ok:
+            ctx.ui.print(
+                text.FAN_OUT_FAILURE.format(
+                    database=outcome.describe(), error=outcome.error
+                )
+            )
+        elif outcome.blocked:
+            ctx.ui.print(
+                text.FAN_OUT_WAITING.format(
+                    database=outcome.describe(), revision=outcome.blocked[0][0]
+                )
+            )
+    return outcomes
+
+
+def run_stage(
+    ctx: Context,
+    targets: Sequence[Target],
+    stage: str,
+    end: Optional[models.PhaseIndex],
+    connections: Connections,
+) -> List[Outcome]:
+    repo = ctx.repo()
+    outcomes = [Outcome(url, tenant) for url, tenant in targets]
+    ctx.ui.print(text.FAN_OUT_STAGE.format(stage=stage, total=len(outcomes)))
+    with ThreadPoolExecutor(repo.config.max_concurrent_databases) as executor:
+        futures = [
+            executor.submit(upgrade_one, ctx, outcome, end, connections)
+            for outcome in outcomes
+        ]
+        for done, future in enumerate(as_completed(futures), 1):
+            outcome = future.result()
+            if not outcome.ok:
+                status = text.FAN_OUT_FAILED.format(error=outcome.error)
+            elif outcome.blocked:
+                status = text.FAN_OUT_BLOCKED.format(
+                    phases=outcome.phases, revision=outcome.blocked[0][0]
+                )
+            else:
+                status = text.FAN_OUT_OK.format(phases=outcome.phases)
+            ctx.ui.print(
+                text.FAN_OUT_PROGRESS.format(
+                    done=done,
+                    total=len(outcomes),
+                    database=outcome.describe(),
+                    status=status,
+                )
+            )
+    return outcomes
+
+
+def upgrade_one(
+    ctx: Context,
+    outcome: Outcome,
+    end: Optional[models.PhaseIndex],
+    connections: Connections,
+) -> Outcome:
+    try:
+        db_ctx = Context(
+            ctx.config_path,
+            outcome.database_url,
+            DatabaseUserInterface(ctx.ui, outcome),
+            outcome.tenant,
+            _db=connections.get(outcome.database_url, outcome.tenant),
+            _repo=ctx.repo(),
+        )
+        if not db_ctx.db().is_set_up():
+            raise FanOutError(text.NOT_INITIALIZED)
+        outcome.phases, outcome.blocked = migrate.upgrade_until_blocked(db_ctx, end)
+    except Exception as e:
+        outcome.error = e
+        connections.discard()
+    return outcome
+
+
+def describe_url(database_url: str) -> str:
+    """The database URL without the password."""
+    parsed = urlparse(database_url)
+    host = parsed.hostname or ""
+    if parsed.port:
+        host += f":{parsed.port}"
+    return f"{host}{parsed.path}"
@@ -1,9 +1,28 @@
-from ..logic import Context
+from ..logic import Context, text
 
 
 def init_db(ctx: Context) -> None:
     ctx.db().create_schema()
 
 
+def upgrade_db(ctx: Context) -> None:
+    """Upgrades our schema in the database, if it was created by an older version."""
+    db = ctx.db()
+    if db.upgrade_schema():
+        ctx.ui.print(text.SCHEMA_UPGRADED)
+        report_storage(ctx)
+
+
+def report_storage(ctx: Context) -> None:
+    stats = ctx.db().get_storage_stats()
+    ctx.ui.print(
+        text.STORAGE_REPORT.format(
+            text_bytes=stats.text_bytes,
+            stored_bytes=stats.stored_bytes,
+            saved=stats.saved,
+        )
+    )
+
+
 def init_repo(ctx: Context) -> None:
     pass
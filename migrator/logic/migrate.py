@@ -1,34 +1,236 @@
+import contextlib
 import dataclasses
+import time
+from typing import List, Optional, Sequence, Set, Tuple
 
-from . import Context
-from .. import models
+from . import Context, drain, elide, init, schedule, squash, text
+from .. import changes, models
 
 
-def upgrade(ctx: Context) -> None:
+def upgrade(
+    ctx: Context, end: Optional[models.PhaseIndex] = None, wait: bool = False
+) -> int:
+    """Runs all the phases that haven't been run yet, stopping before `end` if it's
+    given. Returns how many phases were run.
+
+    Post-deploy phases are held back while clients using an earlier revision are
+    still connected: we stop there, or with wait=True, wait for them to go away.
+
+    Only one upgrade or downgrade runs at a time (per audit stream): any others wait
+    for it to finish, and then find there's nothing left for them to do."""
+    ran, _ = upgrade_until_blocked(ctx, end, wait)
+    return ran
+
+
+def upgrade_until_blocked(
+    ctx: Context, end: Optional[models.PhaseIndex] = None, wait: bool = False
+) -> Tuple[int, List[drain.Client]]:
+    """Like upgrade, but also returns the clients holding back the phases it stopped
+    before, if it stopped at the drain gate (and otherwise [])."""
+    with ctx.db().advisory_lock(migrate_lock(ctx)):
+        return _upgrade(ctx, end, wait)
+
+
+def _upgrade(
+    ctx: Context, end: Optional[models.PhaseIndex], wait: bool
+) -> Tuple[int, List[drain.Client]]:
+    repo = ctx.repo()
+    if end is None and repo.config.bootstrap_empty and can_bootstrap(ctx):
+        return bootstrap(ctx), []
+    phases = pending_phases(ctx, end)
+    ran = 0
+    while phases:
+        blocked, clients = drain.first_blocked(ctx, phases)
+        run_phases(ctx, phases[:blocked])
+        ran += blocked
+        phases = phases[blocked:]
+        if not phases:
+            break
+        revision = phases[0][0].revision
+        if not wait:
+            ctx.ui.print(
+                text.CLIENTS_BLOCKING.format(
+                    revision=clients[0][0], clients=drain.describe_clients(clients)
+                )
+            )
+            return ran, clients
+        drain.wait_for_clients(ctx, revision)
+    return ran, []
+
+
+def run_phases(ctx: Context, phases: Sequence[models.IndexRevisionChangePhase]) -> None:
     db = ctx.db()
     repo = ctx.repo()
+    if repo.config.catch_up:
+        phases = elide.elide(phases)
+    scheduler = schedule.Scheduler(
+        ctx.database_url, repo.config.max_concurrent_phases, db.tenant
+    )
+    batches = scheduler.batches(phases)
+    if repo.config.catch_up:
+        batches = schedule.coalesce(batches)
+    recorded: Set[int] = set()
+    with contextlib.closing(scheduler):
+        for batch in batches:
+            index, revision, _, _ = batch[0]
+            if isinstance(batch, schedule.Transaction) or (
+                len(batch) == 1
+                and schedule.is_transactional(batch[0])
+                and revision.number not in recorded
+            ):
+                # A new revision is recorded in the same transaction as its phase
+                run_transaction(ctx, batch, recorded)
+                continue
+            record_revisions(ctx, batch, recorded)
+            if index == revision.first_index:
+                create_shim_schema(ctx, revision)
+            templates = {index: done_template(phase) for index, _, _, phase in batch}
+            scheduler.run(
+                db,
+                batch,
+                lambda index, round_trips: report_phase(
+                    ctx, templates[index], index, round_trips
+                ),
+            )
+            index, revision, _, _ = batch[-1]
+            if index == revision.last_index:
+                db.drop_shim_schema(revision.number)
 
-    last = db.get_latest_audit()
-    if last:
-        assert last.finished_at is not None
-        phases = repo.revisions.get_phases(
-            models.PhaseSlice(start=last.index, start_inclusive=last.is_revert)
-        )
+
+def can_bootstrap(ctx: Context) -> bool:
+    """Whether the database is empty and nothing has ever been run on it."""
+    db = ctx.db()
+    init.upgrade_db(ctx)
+    return bool(ctx.repo().revisions) and db.is_empty() and not db.get_latest_audit()
+
+
+def bootstrap(ctx: Context) -> int:
+    """Brings an empty database up to date by loading the latest revision's schema.
+    Records the same revisions and audit rows as running every phase would, and
+    leaves the same shim roles behind."""
+    db = ctx.db()
+    revisions = [revision for _, revision in ctx.repo().revisions.ordered_revisions]
+    latest = revisions[-1]
+    phases = sum(len(revision.phase_indexes) for revision in revisions)
+    for revision in revisions:
+        # As in run_phases, which creates each revision's shim (and maybe its role)
+        # before its first phase and drops the shim after its last
+        create_shim_schema(ctx, revision)
+        db.drop_shim_schema(revision.number)
+    db.bootstrap(revisions, latest.schema_text)
+    ctx.ui.print(text.BOOTSTRAPPED.format(revision=latest.number, phases=phases))
+    return phases
+
+
+def record_revisions(
+    ctx: Context,
+    steps: Sequence[models.IndexRevisionChangePhase],
+    recorded: Set[int],
+) -> None:
+    """Records the revisions of the steps, unless they're in `recorded` already. This
+    is done just as their phases start, so that a revision is never recorded without
+    an audit row (which might happen if we stopped before getting to it)."""
+    new = {
+        revision.number: revision
+        for _, revision, _, _ in steps
+        if revision.number not in recorded
+    }
+    if new:
+        ctx.db().upsert_revisions(list(new.values()))
+        recorded.update(new)
+
+
+def run_transaction(
+    ctx: Context,
+    steps: Sequence[models.IndexRevisionChangePhase],
+    recorded: Optional[Set[int]] = None,
+) -> None:
+    """Runs transactional phases in as few transactions as the catch-up budget allows.
+    Each phase still gets its own audit row, so it's as if they ran one by one, and
+    a revision is recorded in the same transaction as its first phase.
+
+    The budget is ignored inside a span of elided phases, which has to be committed
+    all at once (see elide)."""
+    db = ctx.db()
+    config = ctx.repo().config
+    if recorded is None:
+        recorded = set()
+    while steps:
+        started = time.monotonic()
+        done: List[Tuple[models.PhaseIndex, int, str]] = []
+        spans: Set[str] = set()
+        with db.transaction():
+            for step in steps:
+                index, revision, _, phase = step
+                round_trips = db.round_trips
+                record_revisions(ctx, [step], recorded)
+                if index == revision.first_index:
+                    create_shim_schema(ctx, revision)
+                phase.run(db, index)
+                if index == revision.last_index:
+                    db.drop_shim_schema(revision.number)
+                done.append((index, db.round_trips - round_trips, done_template(phase)))
+                if isinstance(phase.up, changes.Elided):
+                    if phase.up.opens:
+                        spans.add(phase.up.opens)
+                    spans.discard(phase.up.closes or "")
+                if not spans and (
+                    0 < config.catch_up_max_phases <= len(done)
+                    or 0 < config.catch_up_max_seconds <= time.monotonic() - started
+                    or 0 < config.catch_up_max_locks <= db.count_exclusive_locks()
+                ):
+                    break
+        # Only report them once they're committed
+        for index, round_trips, template in done:
+            report_phase(ctx, template, index, round_trips)
+        steps = steps[len(done) :]
+
+
+def pending_phases(
+    ctx: Context, end: Optional[models.PhaseIndex] = None
+) -> List[models.IndexRevisionChangePhase]:
+    """Returns the phases that haven't been run yet, stopping before `end` if it's
+    given."""
+    db = ctx.db()
+    repo = ctx.repo()
+    init.upgrade_db(ctx)
+    squash.squash_db(ctx)
+    repo.revisions.trust(db.get_migration_hashes())
+
+    unfinished = db.get_unfinished_audits()
+    done: Set[models.PhaseIndex] = set()
+    if unfinished:
+        # Phases may have run concurrently, so some of the ones after the earliest
+        # unfinished phase may have finished. Only idempotent phases are left
+        # unfinished, so it's safe to pick up from there.
+        first = min(unfinished, key=lambda audit: audit.index)
+        done = {
+            audit.index
+            for audit in db.get_audits_since(first.id)
+            if audit.finished_at is not None and not audit.is_revert
+        }
+        slc = models.PhaseSlice(start=first.index, start_inclusive=True)
     else:
-        phases = repo.revisions.get_phases(models.PhaseSlice())
-    for (index, revision, change, phase) in phases:
-        if index == revision.first_index:
-            db.create_shim_schema(revision.number)
-            db.upsert_revision(revision)
-        phase.run(db, index)
-        if index == revision.last_index:
-            db.drop_shim_schema(revision.number)
+        last = db.get_latest_audit()
+        if last:
+            slc = models.PhaseSlice(start=last.index, start_inclusive=last.is_revert)
+        else:
+            slc = models.PhaseSlice()
+    if end is not None:
+        slc = dataclasses.replace(slc, end=end, end_inclusive=False)
+    return [step for step in repo.revisions.get_phases(slc) if step[0] not in done]
 
 
 def downgrade(ctx: Context, to_revision: int) -> None:
+    with ctx.db().advisory_lock(migrate_lock(ctx)):
+        _downgrade(ctx, to_revision)
+
+
+def _downgrade(ctx: Context, to_revision: int) -> None:
     db = ctx.db()
+    init.upgrade_db(ctx)
 
-    revisions = db.get_revisions()
+    revisions = db.get_revisions(texts=False)
     last_downgrade_to_run = revisions[to_revision + 1].first_index
     slc = models.PhaseSlice(start=last_downgrade_to_run, start_inclusive=True)
     last = db.get_latest_audit()
@@ -37,7 +239,43 @@ def downgrade(ctx: Context, to_revision: int) -> None:
         slc = dataclasses.replace(slc, end=last.index, end_inclusive=not last.is_revert)
     for (index, revision, change, phase) in reversed(list(revisions.get_phases(slc))):
         if index == revision.last_index:
-            db.create_shim_schema(revision.number)
+            create_shim_schema(ctx, revision)
+        round_trips = db.round_trips
         phase.revert(db, index)
+        report_phase(ctx, text.PHASE_REVERTED, index, db.round_trips - round_trips)
         if index == revision.first_index:
             db.drop_shim_schema(revision.number)
+
+
+def migrate_lock(ctx: Context) -> str:
+    """The name of the advisory lock held while upgrading or downgrading (and, shared
+    with each other, by queue workers). Several phases may be in flight at once (see
+    schedule), so nothing in the audit table stops two runners from adopting the same
+    unfinished phase."""
+    return f"{ctx.db().stream}:migrate"
+
+
+def create_shim_schema(ctx: Context, revision: models.Revision) -> None:
+    mode = ctx.repo().config.shim_roles
+    create_role = mode == "always" or (mode == "renames" and revision.has_renames)
+    ctx.db().create_shim_schema(revision.number, create_role=create_role)
+
+
+def done_template(phase: changes.Phase) -> str:
+    if isinstance(phase.up, changes.Elided):
+        return text.PHASE_ELIDED
+    return text.PHASE_DONE
+
+
+def report_phase(
+    ctx: Context, template: str, index: models.PhaseIndex, round_trips: int
+) -> None:
+    ctx.ui.print(
+        template.format(
+            revision=index.revision,
+            deploy="pre-deploy" if index.pre_deploy else "post-deploy",
+            change=index.change + 1,
+            phase=index.phase + 1,
+            round_trips=round_trips,
+        )
+    )
@@ -0,0 +1,157 @@
+"""Runs independent phases of a migration concurrently, on separate connections."""
+from __future__ import annotations
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .. import changes, db, models
+
+Step = models.IndexRevisionChangePhase
+Report = Callable[[models.PhaseIndex, int], None]
+
+
+def concurrent_target(step: Step) -> Optional[str]:
+    index, _, change, phase = step
+    if isinstance(phase.up, changes.Elided):
+        return None
+    return change.inner.concurrent_target(index.phase)
+
+
+def batches(steps: Iterable[Step]) -> Iterator[List[Step]]:
+    """Splits the steps into batches to run one after the other. A batch is either a
+    single step, or consecutive steps from the same stage (pre- or post-deploy) of one
+    revision that can all run concurrently with steps on other tables."""
+    batch: List[Step] = []
+    for step in steps:
+        if batch and not can_share_batch(batch[-1], step):
+            yield batch
+            batch = []
+        batch.append(step)
+    if batch:
+        yield batch
+
+
+def can_share_batch(prev: Step, step: Step) -> bool:
+    return (
+        concurrent_target(prev) is not None
+        and concurrent_target(step) is not None
+        and prev[0].revision == step[0].revision
+        and prev[0].pre_deploy == step[0].pre_deploy
+    )
+
+
+class Transaction(List[Step]):
+    """Consecutive transactional phases to run in a single transaction (or a few,
+    depending on the catch-up budget)."""
+
+
+def is_transactional(step: Step) -> bool:
+    index, _, _, phase = step
+    return (
+        isinstance(phase.up, changes.TransactionalPhase)
+        and phase.up.batch_sql(index) is not None
+    )
+
+
+def coalesce(batches: Iterable[List[Step]]) -> Iterator[List[Step]]:
+    """Merges runs of single-step batches of plain transactional phases (even from
+    different revisions) into Transactions."""
+    merged = Transaction()
+    for batch in batches:
+        if len(batch) == 1 and is_transactional(batch[0]):
+            merged.append(batch[0])
+            continue
+        if merged:
+            yield merged
+            merged = Transaction()
+        yield batch
+    if merged:
+        yield merged
+
+
+def chains(batch: List[Step]) -> List[List[Step]]:
+    """Splits a batch by the table each step works on. Steps on the same table
+    conflict, so each chain has to run in order, but different chains can run
+    concurrently."""
+    by_table: Dict[str, List[Step]] = {}
+    for step in batch:
+        target = concurrent_target(step)
+        assert target is not None
+        by_table.setdefault(target, []).append(step)
+    return list(by_table.values())
+
+
+class Scheduler:
+    def __init__(
+        self, database_url: str, max_workers: int, tenant: Optional[str] = None
+    ) -> None:
+        self.database_url = database_url
+        self.max_workers = max_workers
+        # Worker connections migrate the same tenant schema as the main one
+        self.tenant = tenant
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()
+        self._databases: List[db.Database] = []
+
+    def batches(self, steps: Iterable[Step]) -> Iterator[List[Step]]:
+        if self.max_workers <= 1:
+            return ([step] for step in steps)
+        return batches(steps)
+
+    def run(self, database: db.Database, batch: List[Step], report: Report) -> None:
+        """Runs the batch, calling report (on this thread) with each step's index and
+        the number of round trips it took once it's done.
+
+        A single step is run on `database`. Otherwise each chain is run on a
+        connection of its own. If any of them fail, waits for the rest to finish (so
+        that no phase is left running) and raises the first error."""
+        if len(batch) == 1:
+            self._run_chain(batch, report, database)
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers)
+        futures: List[Future[List[Tuple[models.PhaseIndex, int]]]] = [
+            self._executor.submit(self._run_chain_in_worker, chain)
+            for chain in chains(batch)
+        ]
+        error: Optional[BaseException] = None
+        for future in as_completed(futures):
+            exc = future.exception()
+            if exc is not None:
+                error = error or exc
+                continue
+            for index, round_trips in future.result():
+                report(index, round_trips)
+        if error is not None:
+            raise error
+
+    def _run_chain_in_worker(
+        self, chain: List[Step]
+    ) -> List[Tuple[models.PhaseIndex, int]]:
+        results: List[Tuple[models.PhaseIndex, int]] = []
+        self._run_chain(
+            chain,
+            lambda index, round_trips: results.append((index, round_trips)),
+            self._worker_database(),
+        )
+        return results
+
+    @staticmethod
+    def _run_chain(chain: List[Step], report: Report, database: db.Database) -> None:
+        for index, _, _, phase in chain:
+            round_trips = database.round_trips
+            phase.run(database, index)
+            report(index, database.round_trips - round_trips)
+
+    def _worker_database(self) -> db.Database:
+        if not hasattr(self._local, "database"):
+            self._local.database = db.Database(self.database_url, tenant=self.tenant)
+            self._databases.append(self._local.database)
+        return self._local.database  # type: ignore
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+        for database in self._databases:
+            database.close()
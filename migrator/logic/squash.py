@@ -0,0 +1,101 @@
+"""Squashes old history into a baseline revision, so that neither the migrations
+directory nor the status tables grow without bound.
+
+Squashing through revision K replaces K's migration with one that creates K's schema
+from scratch (and can't be reverted), and deletes the files of the revisions before
+it. Databases that are already past K have their history squashed the next time
+they're upgraded; ones that aren't can't be upgraded any more."""
+from __future__ import annotations
+
+from typing import cast
+
+import yaml
+
+from . import Context, text
+from .. import changes, models
+
+
+# The advisory lock held while deciding whether to squash, and squashing
+SQUASH_LOCK = "squash"
+
+
+class SquashError(Exception):
+    pass
+
+
+def squash(ctx: Context, through: int) -> None:
+    revisions = ctx.repo().revisions
+    if through not in revisions or through == revisions.start:
+        ctx.ui.die(text.CANT_SQUASH.format(revision=through, start=revisions.start))
+    baseline = cast(models.FileRevision, revisions[through])
+    migration = baseline_migration(revisions.start, baseline)
+    with ctx.ui.open(baseline.migration_filename, "w") as f:
+        f.write(yaml.safe_dump(migration.dict(exclude_defaults=True), sort_keys=False))
+    for number in range(revisions.start, through):
+        revision = cast(models.FileRevision, revisions[number])
+        ctx.ui.remove(revision.migration_filename)
+        ctx.ui.remove(revision.schema_filename)
+    ctx.ui.print(text.SQUASHED.format(start=revisions.start, revision=through))
+
+
+def baseline_migration(start: int, baseline: models.Revision) -> models.Migration:
+    down = text.BASELINE_DOWN.format(revision=baseline.number).replace("'", "''")
+    step = changes.DDLStep(
+        up=baseline.schema_text,
+        down=f"DO $$ BEGIN RAISE EXCEPTION '{down}'; END $$",
+    )
+    return models.Migration(
+        message=text.BASELINE_MESSAGE.format(start=start, revision=baseline.number),
+        pre_deploy=[step.wrap()],
+    )
+
+
+def squash_db(ctx: Context) -> None:
+    """Squashes the database's history to match the repo's, if the repo's has been
+    squashed since. Raises SquashError if our audit stream is behind the baseline.
+
+    The revisions are shared by every stream (e.g. every tenant schema), so the first
+    stream to get here squashes them, along with the audits of every stream that's
+    past the baseline. Any stream that still has audits from before the baseline
+    after that was behind it."""
+    db = ctx.db()
+    revisions = ctx.repo().revisions
+    if revisions.start == 1:
+        return
+    first = db.get_first_audited_revision()
+    if first is None or first >= revisions.start:
+        return
+    baseline = revisions[revisions.start]
+    behind = SquashError(text.BEHIND_BASELINE.format(revision=baseline.number))
+    # Other streams may be upgrading (and so getting here) at the same time
+    with db.advisory_lock(SQUASH_LOCK):
+        first_recorded = db.get_first_revision()
+        if first_recorded is not None and first_recorded >= revisions.start:
+            # Another stream squashed the revisions, and left our audits alone
+            raise behind
+        recorded = db.get_revisions(texts=False)
+        past = [
+            stream
+            for stream, last in db.get_latest_audits().items()
+            if is_past(recorded, last, baseline)
+        ]
+        if db.stream not in past:
+            raise behind
+        db.squash(baseline, past)
+    ctx.ui.print(text.DB_SQUASHED.format(revision=baseline.number))
+
+
+def is_past(
+    recorded: models.RevisionList,
+    last: models.MigrationAudit,
+    baseline: models.Revision,
+) -> bool:
+    """Whether the latest audit shows that every phase of the baseline revision (as
+    recorded in the database, before it was squashed) has been run."""
+    if last.index.revision != baseline.number:
+        return last.index.revision > baseline.number
+    return (
+        last.finished_at is not None
+        and not last.is_revert
+        and last.index == recorded[baseline.number].last_index
+    )
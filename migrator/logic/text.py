@@ -2,3 +2,61 @@ from ..constants import NAME
 
 PROMPT_YES_NO = " (Y/n): "
 ASK_TO_INITIALIZE_DB = f"This database hasn't been set up for {NAME}. Set it up?"
+PHASE = "  #{revision} {deploy} change {change} phase {phase}"
+PHASE_DONE = PHASE + ": done ({round_trips} round trips)"
+PHASE_ELIDED = PHASE + ": skipped, a later phase undoes it ({round_trips} round trips)"
+PHASE_REVERTED = PHASE + ": reverted ({round_trips} round trips)"
+BOOTSTRAPPED = (
+    "Bootstrapped the empty database from revision #{revision}'s schema"
+    " ({phases} phases recorded as done)"
+)
+CLIENTS_BLOCKING = (
+    "STOPPING: There are still connected clients using schema revision {revision}:"
+    "\n  {clients}\nPlease deploy your new code, then run `up` again (or `up --wait`)."
+)
+WAITING_FOR_CLIENTS = (
+    "Waiting for connected clients using schema revision {revision} to go away:"
+    "\n  {clients}"
+)
+SCHEMA_UPGRADED = f"Upgraded the {NAME} schema in the database."
+STORAGE_REPORT = (
+    "Revision texts: {text_bytes} bytes, stored in {stored_bytes} ({saved:.0%} saved)"
+)
+NOT_INITIALIZED = f"This database hasn't been set up for {NAME}."
+FAN_OUT_STAGE = "Running {stage} phases on {total} databases"
+FAN_OUT_PROGRESS = "[{done}/{total}] {database}: {status}"
+FAN_OUT_OK = "{phases} phases run"
+FAN_OUT_BLOCKED = (
+    "{phases} phases run, then stopped: clients using schema revision {revision}"
+    " are still connected"
+)
+FAN_OUT_FAILED = "FAILED: {error}"
+FAN_OUT_HOLDING_BACK = (
+    "Not running post-deploy phases, since not every database finished pre-deploy"
+)
+FAN_OUT_SUMMARY = (
+    "{ok} of {total} databases upgraded ({phases} phases), {blocked} waiting for"
+    " old clients to go away, {failed} failed"
+)
+FAN_OUT_FAILURE = "  {database}: {error}"
+FAN_OUT_WAITING = "  {database}: waiting for clients using schema revision {revision}"
+QUEUE_FAILED = "A phase failed on another worker: {error}"
+QUEUE_STILL_RUNNING = (
+    "A phase failed, but {count} chain(s) of the failed plan are still running on"
+    " other workers. Try again once they've finished."
+)
+QUEUE_MISMATCH = "Revision #{revision} here doesn't match the one in the phase queue"
+BASELINE_MESSAGE = "Baseline: revisions #{start} to #{revision}, squashed"
+BASELINE_DOWN = "Can't downgrade past baseline revision #{revision}"
+CANT_SQUASH = (
+    "Can't squash through revision #{revision}: it has to be after the first"
+    " revision (#{start}) and no later than the latest one"
+)
+SQUASHED = (
+    "Squashed revisions #{start} to #{revision} into baseline revision #{revision}"
+)
+DB_SQUASHED = "Squashed the database's history into baseline revision #{revision}"
+BEHIND_BASELINE = (
+    "This database is behind revision #{revision}, which earlier history has been"
+    " squashed into, so it can't be upgraded any more"
+)
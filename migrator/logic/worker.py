@@ -0,0 +1,131 @@
+"""Runs the pending phases cooperatively with workers on other hosts.
+
+The first worker to arrive publishes the plan (the pending phases, split up by
+schedule.batches and schedule.chains) to a queue table. Every worker then claims
+chains from it one at a time. A chain is only claimable once every chain in earlier
+batches has finished, so batches act as barriers: in particular, between revisions
+and between a revision's pre- and post-deploy phases.
+
+As with `up`, post-deploy phases are held back while clients using an earlier
+revision are connected: they're left out of the plan, for a later run to publish.
+Workers share the lock that `up` and `down` take, so they never run at the same
+time as those (though they do run alongside each other)."""
+from __future__ import annotations
+
+import os
+import socket
+import time
+from typing import List, Optional
+
+from . import Context, drain, migrate, schedule, text
+from .. import models
+
+POLL_INTERVAL = 1.0
+
+
+class QueueError(Exception):
+    pass
+
+
+def work(
+    ctx: Context,
+    end: Optional[models.PhaseIndex] = None,
+    worker: Optional[str] = None,
+    poll_interval: float = POLL_INTERVAL,
+) -> int:
+    """Publishes the pending phases (stopping before `end`) if nobody else has, then
+    runs chains of them until the queue is empty. Returns how many phases this
+    worker ran."""
+    db = ctx.db()
+    if worker is None:
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+    with db.advisory_lock(migrate.migrate_lock(ctx), shared=True):
+        publish(ctx, end)
+        return run_chains(ctx, worker, poll_interval)
+
+
+def run_chains(ctx: Context, worker: str, poll_interval: float) -> int:
+    db = ctx.db()
+    ran = 0
+    while True:
+        chain = db.claim_chain(worker)
+        if chain is None:
+            unfinished, error = db.get_queue_status()
+            if error is not None:
+                raise QueueError(text.QUEUE_FAILED.format(error=error))
+            if not unfinished:
+                return ran
+            time.sleep(poll_interval)
+            continue
+        try:
+            ran += run_chain(ctx, chain)
+        except Exception as e:
+            db.finish_chain(chain, error=f"{worker}: {e}")
+            raise
+        db.finish_chain(chain)
+
+
+def publish(ctx: Context, end: Optional[models.PhaseIndex] = None) -> None:
+    """Publishes the pending phases to the queue, unless there's already a plan in
+    progress. A plan that failed is replaced, so that running again retries it, but
+    only once no worker is still running one of its chains: the new plan would
+    include that chain's phases too."""
+    db = ctx.db()
+    with db.advisory_lock(f"{db.stream}:phase_queue"):
+        unfinished, error = db.get_queue_status()
+        if unfinished and error is None:
+            return
+        if error is not None:
+            running = db.count_live_claims()
+            if running:
+                raise QueueError(text.QUEUE_STILL_RUNNING.format(count=running))
+        steps = migrate.pending_phases(ctx, end)
+        blocked, clients = drain.first_blocked(ctx, steps)
+        if blocked < len(steps):
+            ctx.ui.print(
+                text.CLIENTS_BLOCKING.format(
+                    revision=clients[0][0], clients=drain.describe_clients(clients)
+                )
+            )
+        db.publish_chains(plan(db.stream, steps[:blocked]))
+
+
+def plan(stream: str, steps: List[schedule.Step]) -> List[models.QueuedChain]:
+    result = []
+    for i_batch, batch in enumerate(schedule.batches(steps)):
+        chains = schedule.chains(batch) if len(batch) > 1 else [batch]
+        for i_chain, chain in enumerate(chains):
+            first = chain[0][0]
+            result.append(
+                models.QueuedChain(
+                    stream,
+                    i_batch,
+                    i_chain,
+                    first.revision,
+                    first.migration_hash,
+                    first.schema_hash,
+                    first.pre_deploy,
+                    [index.change for index, _, _, _ in chain],
+                    [index.phase for index, _, _, _ in chain],
+                )
+            )
+    return result
+
+
+def run_chain(ctx: Context, chain: models.QueuedChain) -> int:
+    db = ctx.db()
+    revision = ctx.repo().revisions[chain.revision]
+    phases = {index: phase for index, _, phase in revision.phases()}
+    if any(index not in phases for index in chain.indexes):
+        raise QueueError(text.QUEUE_MISMATCH.format(revision=chain.revision))
+    # Recorded as its phases start, as in migrate.run_phases
+    db.upsert_revisions([revision])
+    for index in chain.indexes:
+        if index == revision.first_index:
+            migrate.create_shim_schema(ctx, revision)
+        round_trips = db.round_trips
+        phases[index].run(db, index)
+        migrate.report_phase(ctx, text.PHASE_DONE, index, db.round_trips - round_trips)
+        if index == revision.last_index:
+            db.drop_shim_schema(revision.number)
+    return len(chain.indexes)
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import bisect
 import dataclasses
+import functools
+import itertools
+import json
 import os.path
-import glob
 from contextlib import contextmanager
 
 import pydantic
@@ -13,7 +16,13 @@ import hashlib
 from pydantic import BaseModel, root_validator, PrivateAttr
 from dataclasses import dataclass, field
 from typing import (
+    Callable,
+    ClassVar,
+    Hashable,
+    Iterable,
+    Set,
     List,
+    Mapping,
     Union,
     Optional,
     Dict,
@@ -21,20 +30,35 @@ from typing import (
     Iterator,
     Tuple,
     TYPE_CHECKING,
-    Protocol,
+    TypeVar,
+    cast,
 )
 
+from typing_extensions import Literal, Protocol
+
+from .constants import PLAN_CACHE_FILENAME
+
 if TYPE_CHECKING:
     from . import changes
 
+T = TypeVar("T")
+
 
 def get_revision_number(filename: str) -> int:
     return int(os.path.basename(filename).split("-", 1)[0])
 
 
+# The C (libyaml) loader is several times faster, if PyYAML was built with it
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def parse_yaml(text: str) -> Any:
+    return yaml.load(text, Loader=YamlLoader)
+
+
 def load_yaml(fname: str) -> Dict[Any, Any]:
     with open(fname) as f:
-        return yaml.safe_load(f.read())  # type: ignore
+        return parse_yaml(f.read())  # type: ignore
 
 
 def sibling(fname: str, path: str) -> str:
@@ -46,12 +70,23 @@ class Repo:
     config_path: str
     config: RepoConfig
     revisions: RevisionList
+    plan_cache: Optional[PlanCache] = None
 
     @staticmethod
-    def parse(config_path: str) -> Repo:
+    def parse(config_path: str, plan_cache_path: Optional[str] = None) -> Repo:
         config = RepoConfig.parse_obj(load_yaml(config_path))
-        revisions = RevisionList.parse(sibling(config_path, config.migrations_dir))
-        return Repo(config_path, config, revisions)
+        migrations_dir = sibling(config_path, config.migrations_dir)
+        plan_cache = None
+        if config.plan_cache:
+            plan_cache = PlanCache.load(
+                plan_cache_path or os.path.join(migrations_dir, PLAN_CACHE_FILENAME)
+            )
+        revisions = RevisionList.parse(migrations_dir, plan_cache)
+        return Repo(config_path, config, revisions, plan_cache)
+
+    def save_plan_cache(self) -> None:
+        if self.plan_cache is not None:
+            self.plan_cache.save()
 
 
 class RepoConfig(BaseModel):
@@ -59,6 +94,73 @@ class RepoConfig(BaseModel):
     migrations_dir: str = "migrations"
     crash_on_incompatible_version: bool = True
     incantation_path: str = "migrations/incantation.sql"
+    # Whether to keep a cache of each revision's hashes and phases next to the
+    # migrations, so that unchanged migration files don't have to be re-parsed.
+    plan_cache: bool = True
+    # How many template databases (with a schema already loaded) to keep around for
+    # diffing schemas, and how many days since they were last used to keep them for.
+    # Set template_cache_size to 0 to load each schema into a fresh database instead.
+    template_cache_size: int = 4
+    template_cache_max_age_days: float = 7
+    # How many phases to run at once, on separate connections. Phases that can run
+    # concurrently (building indexes and validating constraints) on different tables
+    # are run in parallel if this is more than 1.
+    max_concurrent_phases: int = 1
+    # How many databases (or tenant schemas) to upgrade at once when fanning out
+    # across many of them
+    max_concurrent_databases: int = 8
+    # For schema-per-tenant databases: the schemas to apply migrations to, either
+    # listed or as a query returning their names. Each has its own audit stream.
+    tenant_schemas: List[str] = []
+    tenant_schemas_query: Optional[str] = None
+    # Catch-up mode: run consecutive transactional phases (even across revisions) in
+    # a single transaction, committing once it's run catch_up_max_phases phases,
+    # taken catch_up_max_seconds, or holds catch_up_max_locks exclusive table locks
+    # (0 for no limit).
+    catch_up: bool = False
+    catch_up_max_phases: int = 50
+    catch_up_max_seconds: float = 5
+    catch_up_max_locks: int = 20
+    # Bootstrap mode: bring an empty database all the way up to date by loading the
+    # latest revision's schema, rather than replaying every revision's phases.
+    bootstrap_empty: bool = False
+    # How often `up --wait` re-checks whether clients using an earlier revision have
+    # disconnected, when nothing else has prompted it to
+    drain_recheck_seconds: float = 5
+    # Which revisions get a login role (named after their shim schema, with the shim
+    # on its search path) for clients to connect as: "always", "renames" (only
+    # revisions that rename columns, and so use the shim), or "never" (clients put
+    # the shim on their search path with the incantation instead).
+    shim_roles: Literal["always", "renames", "never"] = "always"
+    # How clients register their revision: "session" (once, when they connect) or
+    # "transaction" (at the start of every transaction, for clients behind a
+    # connection pooler in transaction mode, identifying themselves by a client ID).
+    registration: Literal["session", "transaction"] = "session"
+    # How long after its last transaction a client registered per transaction still
+    # counts as connected
+    client_ttl_seconds: float = 60
+    # The URL of pgbouncer's admin console, to count the clients connected through
+    # pgbouncer (by the revision role they logged in as) instead of the backends
+    # registered per session
+    pgbouncer_admin_url: Optional[str] = None
+    # The name pgbouncer gives the database, if it's not the one in the database URL
+    pgbouncer_database: Optional[str] = None
+
+    @root_validator(skip_on_failure=True)
+    def check_pgbouncer_roles(cls, values: Dict[str, object]) -> Dict[str, object]:
+        """pgbouncer's admin console only tells us a client's revision by the role it
+        logged in as, and session registrations are ignored when we use it. So every
+        revision needs its own role, unless clients register per transaction."""
+        if (
+            values["pgbouncer_admin_url"] is not None
+            and values["shim_roles"] != "always"
+            and values["registration"] == "session"
+        ):
+            raise ValueError(
+                "pgbouncer_admin_url needs shim_roles: always, or registration:"
+                " transaction (otherwise clients on a shared role aren't counted)"
+            )
+        return values
 
 
 class ValidationError(Exception):
@@ -83,81 +185,228 @@ class Revision:
     migration_text: str
     schema_text: str
 
+    def _cache_key(self) -> Optional[Hashable]:
+        """Returns a key that changes whenever the revision's source changes.
+
+        Values memoized by `_cached` are discarded when the key changes. The default
+        of None means the source never changes."""
+        return None
+
+    def _cached(self, name: str, compute: Callable[[], T]) -> T:
+        key = self._cache_key()
+        # Stored outside of the dataclass fields so that it doesn't affect eq/repr.
+        cache: Optional[RevisionCache] = self.__dict__.get("_cache")
+        if cache is None or cache.key != key:
+            cache = self._new_cache(key)
+            self.__dict__["_cache"] = cache
+        if name not in cache.values:
+            cache.values[name] = compute()
+        return cast(T, cache.values[name])
+
+    def _new_cache(self, key: Optional[Hashable]) -> RevisionCache:
+        return RevisionCache(key)
+
     @property
     def migration_hash(self) -> bytes:
-        return hashlib.sha256(self.migration_text.encode("ascii")).digest()
+        return self._cached(
+            "migration_hash",
+            lambda: hashlib.sha256(self.migration_text.encode("ascii")).digest(),
+        )
 
     @property
     def migration(self) -> Migration:
+        return self._cached("migration", self._parse_migration)
+
+    @property
+    def has_renames(self) -> bool:
+        """Whether the migration renames columns, and so puts views in the shim."""
+        return self._cached(
+            "has_renames",
+            lambda: any(
+                change.begin_rename or change.finish_rename
+                for change in self.migration.pre_deploy + self.migration.post_deploy
+            ),
+        )
+
+    def _parse_migration(self) -> Migration:
         with parsing_file(self.migration_filename):
-            m = Migration(**yaml.safe_load(self.migration_text))
+            obj = parse_yaml(self.migration_text)
+            if self.is_trusted:
+                return Migration.construct_trusted(obj)
+            m = Migration(**obj)
             return m
 
+    @property
+    def is_trusted(self) -> bool:
+        """Whether this revision's migration is known to have been validated before, so
+        that it can be loaded without validating it again."""
+        return False
+
     @property
     def schema_hash(self) -> bytes:
-        return hashlib.sha256(self.schema_text.encode("ascii")).digest()
+        return self._cached(
+            "schema_hash",
+            lambda: hashlib.sha256(self.schema_text.encode("ascii")).digest(),
+        )
 
     @staticmethod
-    def parse(filename: str) -> Revision:
+    def parse(
+        filename: str,
+        plan_cache: Optional[PlanCache] = None,
+        trusted_hashes: Optional[Set[bytes]] = None,
+    ) -> Revision:
         assert os.path.isfile(filename)
         number = get_revision_number(filename)
-        return FileRevision(number, filename)
+        if trusted_hashes is None:
+            trusted_hashes = set()
+        return FileRevision(number, filename, plan_cache, trusted_hashes)
 
     def get_phases(self, slice: PhaseSlice) -> Iterator[IndexChangePhase]:
         if slice.start and slice.start.revision > self.number:
             return
         if slice.end and slice.end.revision < self.number:
             return
-        for next_index, change, phase in self.phases():
-            if next_index in slice:
-                yield next_index, change, phase
+        # Checking the (cached) indexes first saves parsing the migration if none of
+        # its phases are in the slice.
+        lo, hi = slice.bounds(self.phase_table)
+        if lo == hi:
+            return
+        yield from itertools.islice(self.phases(), lo, hi)
 
     def phases(self) -> Iterator[IndexChangePhase]:
         return self.migration.phases(self.first_index)
 
     @property
     def first_index(self) -> PhaseIndex:
-        return PhaseIndex(
-            revision=self.number,
-            migration_hash=self.migration_hash,
-            schema_hash=self.schema_hash,
-            pre_deploy=True,
-            change=0,
-            phase=0,
+        return self._cached(
+            "first_index",
+            lambda: PhaseIndex(
+                revision=self.number,
+                migration_hash=self.migration_hash,
+                schema_hash=self.schema_hash,
+                pre_deploy=True,
+                change=0,
+                phase=0,
+            ),
         )
 
+    @property
+    def post_deploy_index(self) -> PhaseIndex:
+        """Where the post-deploy phases start (whether or not there are any)."""
+        return dataclasses.replace(self.first_index, pre_deploy=False)
+
+    @property
+    def phase_indexes(self) -> List[PhaseIndex]:
+        return self._cached("phase_indexes", self._compute_phase_indexes)
+
+    def _compute_phase_indexes(self) -> List[PhaseIndex]:
+        return [i[0] for i in self.phases()]
+
+    @property
+    def phase_table(self) -> PhaseTable:
+        return self._cached("phase_table", lambda: PhaseTable(self.phase_indexes))
+
     @property
     def last_index(self) -> PhaseIndex:
-        return next(reversed([i[0] for i in self.migration.phases(self.first_index)]))
+        return self.phase_indexes[-1]
+
+
+@dataclass
+class RevisionCache:
+    """Values derived from a revision's source, valid as long as `key` is."""
+
+    key: Optional[Hashable]
+    values: Dict[str, Any] = field(default_factory=dict)
+
+
+RevisionSource = Union[Revision, Callable[[], Revision]]
+
+
+class RevisionList(Mapping[int, Revision]):
+    """The contiguous sequence of revisions 1..N, keyed by number. Or K..N, if
+    revisions 1..K have been squashed into a baseline revision K (see logic.squash).
+
+    Revisions may be supplied as loader functions instead, in which case each is only
+    loaded the first time it's looked up. That way working on the last few revisions
+    of a long history doesn't need to touch every migration file."""
+
+    def __init__(
+        self,
+        revisions: Mapping[int, RevisionSource],
+        trusted_hashes: Optional[Set[bytes]] = None,
+    ) -> None:
+        self._sources: Dict[int, RevisionSource] = dict(revisions)
+        self._numbers = sorted(self._sources)
+        assert self._numbers == list(range(self.start, self.start + len(self)))
+        # Shared with the revisions we load, so that trust() applies to them too
+        self.trusted_hashes = set() if trusted_hashes is None else trusted_hashes
 
+    def __getitem__(self, number: int) -> Revision:
+        source = self._sources[number]
+        if not isinstance(source, Revision):
+            source = self._sources[number] = source()
+        return source
 
-class RevisionList(Dict[int, Revision]):
-    def __init__(self, *args: Any, **kwargs: Any) -> None:
-        super().__init__(*args, **kwargs)
-        assert list(self.keys()) == list(range(1, len(self) + 1))
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._numbers)
+
+    def __len__(self) -> int:
+        return len(self._numbers)
+
+    @property
+    def start(self) -> int:
+        """The number of the first revision (the baseline, if history was squashed)."""
+        return self._numbers[0] if self._numbers else 1
+
+    @property
+    def last(self) -> int:
+        """The number of the latest revision, or start - 1 if there are none."""
+        return self._numbers[-1] if self._numbers else self.start - 1
+
+    def is_loaded(self, number: int) -> bool:
+        return isinstance(self._sources[number], Revision)
 
     @staticmethod
-    def parse(dirname: str) -> RevisionList:
+    def parse(dirname: str, plan_cache: Optional[PlanCache] = None) -> RevisionList:
+        """Indexes the migrations in the given directory by the revision numbers in
+        their filenames, without reading them."""
         assert os.path.isdir(dirname)
-        revisions = {}
-        for f in glob.glob(os.path.join(dirname, "*.yml")):
-            rev = Revision.parse(f)
-            revisions[rev.number] = rev
-        return RevisionList(revisions)
+        sources: Dict[int, RevisionSource] = {}
+        trusted_hashes: Set[bytes] = set()
+        for name in os.listdir(dirname):
+            if name.endswith(".yml"):
+                filename = os.path.join(dirname, name)
+                sources[get_revision_number(name)] = functools.partial(
+                    Revision.parse, filename, plan_cache, trusted_hashes
+                )
+        return RevisionList(sources, trusted_hashes)
+
+    def trust(self, migration_hashes: Iterable[bytes]) -> None:
+        """Marks migrations with the given hashes (e.g. ones already recorded in the
+        database) as validated, so that they're loaded without re-validating."""
+        self.trusted_hashes.update(migration_hashes)
 
     @property
     def ordered_revisions(self) -> Iterator[Tuple[int, Revision]]:
-        yield from sorted(self.items())
+        yield from self.items()
 
     def get_phases(self, slice: PhaseSlice) -> Iterator[IndexRevisionChangePhase]:
-        for num, revision in self.ordered_revisions:
-            if slice.start and slice.start.revision > num:
-                continue
-            if slice.end and slice.end.revision < num:
-                continue
+        first = slice.start.revision if slice.start else self.start
+        last = slice.end.revision if slice.end else self.last
+        # Only load the revisions that the slice covers
+        for num in range(max(first, self.start), min(last, self.last) + 1):
+            revision = self[num]
             for next_index, change, phase in revision.get_phases(slice):
                 yield next_index, revision, change, phase
 
+    def phase_table(self) -> PhaseTable:
+        """Returns the indexes of every phase of every revision, in order.
+
+        Loads every revision, so this is cheapest when the plan cache is warm."""
+        return PhaseTable(
+            index for revision in self.values() for index in revision.phase_indexes
+        )
+
 
 @dataclass
 class FileRevision(Revision):
@@ -165,12 +414,49 @@ class FileRevision(Revision):
 
     number: int
     migration_filename: str
+    plan_cache: Optional[PlanCache] = field(default=None, compare=False, repr=False)
+    trusted_hashes: Set[bytes] = field(default_factory=set, compare=False, repr=False)
+
+    @property
+    def is_trusted(self) -> bool:
+        return self.migration_hash in self.trusted_hashes
+
+    def _cache_key(self) -> Optional[Hashable]:
+        return (file_stamp(self.migration_filename), file_stamp(self.schema_filename))
+
+    def _new_cache(self, key: Optional[Hashable]) -> RevisionCache:
+        cache = super()._new_cache(key)
+        entry = self.plan_cache.get(self.number) if self.plan_cache else None
+        if entry and entry.stamps == key:
+            # Neither file has been touched since the plan was cached, so we don't
+            # even need to read them.
+            cache.values["migration_hash"] = entry.migration_hash
+            cache.values["schema_hash"] = entry.schema_hash
+            cache.values["phase_indexes"] = entry.phase_indexes(self.number)
+        return cache
+
+    def _compute_phase_indexes(self) -> List[PhaseIndex]:
+        if self.plan_cache is None:
+            return super()._compute_phase_indexes()
+        entry = self.plan_cache.get(self.number)
+        hashes = (self.migration_hash, self.schema_hash)
+        if entry and entry.hashes == hashes:
+            # Touched but not changed; no need to re-parse.
+            indexes = entry.phase_indexes(self.number)
+        else:
+            indexes = super()._compute_phase_indexes()
+        stamps = cast(Stamps, self._cache_key())
+        self.plan_cache.put(self.number, PlanEntry.build(stamps, hashes, indexes))
+        return indexes
 
     # here and below, the type: ignore comments tell mypy that it's ok for this to be a
     # property even though it's an attribute on the parent class. Sigh.
     # Removable when this bug is closed: https://github.com/python/mypy/issues/4125
     @property
     def schema_text(self) -> str:  # type: ignore
+        return self._cached("schema_text", self._read_schema)
+
+    def _read_schema(self) -> str:
         with open(self.schema_filename) as f:
             return f.read()
 
@@ -180,14 +466,188 @@ class FileRevision(Revision):
 
     @property
     def migration_text(self) -> str:  # type:ignore
+        return self._cached("migration_text", self._read_migration)
+
+    def _read_migration(self) -> str:
         if not os.path.exists(self.migration_filename):
             return ""
         with open(self.migration_filename) as f:
             return f.read()
 
 
+FileStamp = Tuple[int, int]
+Stamps = Tuple[Optional[FileStamp], Optional[FileStamp]]
+
+
+def file_stamp(filename: str) -> Optional[FileStamp]:
+    """Returns the (mtime, size) of the file, or None if it doesn't exist."""
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class RevisionFetcher(Protocol):
+    # A protocol rather than a Callable, which mypy would take to be a method
+    def __call__(self) -> DbRevision:
+        ...
+
+
+@dataclass(frozen=True)
+class LazyDbRevision(Revision):
+    """A revision stored in the database, of which only the number and hashes have
+    been fetched. The texts are fetched the first time they're needed."""
+
+    number: int
+    hashes: Tuple[bytes, bytes]
+    is_deleted: bool
+    fetch: RevisionFetcher = field(compare=False, repr=False)
+
+    @property
+    def migration_hash(self) -> bytes:
+        return self.hashes[0]
+
+    @property
+    def schema_hash(self) -> bytes:
+        return self.hashes[1]
+
+    @property
+    def stored(self) -> DbRevision:
+        return self._cached("stored", self.fetch)
+
+    @property
+    def migration_text(self) -> str:  # type: ignore
+        return self.stored.migration_text
+
+    @property
+    def schema_text(self) -> str:  # type: ignore
+        return self.stored.schema_text
+
+    @property
+    def migration(self) -> Migration:
+        return self.stored.migration
+
+    @property
+    def migration_filename(self) -> str:  # type: ignore
+        return f"<database file, hash={self.migration_hash.hex()}>"
+
+
+@dataclass
+class PlanEntry:
+    """The cached hashes and phases of a single revision."""
+
+    stamps: Stamps
+    migration_hash: bytes
+    schema_hash: bytes
+    # (pre_deploy, change, phase) for each phase, in order
+    phases: List[Tuple[bool, int, int]]
+
+    @property
+    def hashes(self) -> Tuple[bytes, bytes]:
+        return self.migration_hash, self.schema_hash
+
+    @staticmethod
+    def build(
+        stamps: Stamps, hashes: Tuple[bytes, bytes], indexes: List[PhaseIndex]
+    ) -> PlanEntry:
+        return PlanEntry(
+            stamps=stamps,
+            migration_hash=hashes[0],
+            schema_hash=hashes[1],
+            phases=[(i.pre_deploy, i.change, i.phase) for i in indexes],
+        )
+
+    def phase_indexes(self, revision: int) -> List[PhaseIndex]:
+        return [
+            PhaseIndex(revision, self.migration_hash, self.schema_hash, *phase)
+            for phase in self.phases
+        ]
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "stamps": self.stamps,
+            "migration_hash": self.migration_hash.hex(),
+            "schema_hash": self.schema_hash.hex(),
+            "phases": self.phases,
+        }
+
+    @staticmethod
+    def from_json(obj: Mapping[str, object]) -> PlanEntry:
+        stamps = cast(List[Optional[List[int]]], obj["stamps"])
+        phases = cast(List[Tuple[bool, int, int]], obj["phases"])
+        return PlanEntry(
+            stamps=cast(Stamps, tuple(tuple(s) if s else None for s in stamps)),
+            migration_hash=bytes.fromhex(cast(str, obj["migration_hash"])),
+            schema_hash=bytes.fromhex(cast(str, obj["schema_hash"])),
+            phases=[(bool(p), int(c), int(ph)) for p, c, ph in phases],
+        )
+
+
 @dataclass
+class PlanCache:
+    """The "compiled" form of a migrations directory: each revision's hashes and phase
+    indexes, stored next to the migrations.
+
+    Entries are trusted as long as the (mtime, size) of both of the revision's files
+    are unchanged, and otherwise re-used if the files' contents hash the same. Only
+    revisions that actually changed need their YAML parsed."""
+
+    VERSION = 1
+
+    path: str
+    entries: Dict[int, PlanEntry] = field(default_factory=dict)
+    dirty: bool = False
+
+    @staticmethod
+    def load(path: str) -> PlanCache:
+        try:
+            with open(path) as f:
+                obj = json.load(f)
+            if obj["version"] != PlanCache.VERSION:
+                return PlanCache(path)
+            entries = {
+                int(num): PlanEntry.from_json(entry)
+                for num, entry in obj["revisions"].items()
+            }
+        except (OSError, ValueError, KeyError, TypeError):
+            # A missing or corrupt cache just means starting from scratch.
+            return PlanCache(path)
+        return PlanCache(path, entries)
+
+    def get(self, revision: int) -> Optional[PlanEntry]:
+        return self.entries.get(revision)
+
+    def put(self, revision: int, entry: PlanEntry) -> None:
+        if self.entries.get(revision) != entry:
+            self.entries[revision] = entry
+            self.dirty = True
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        obj = {
+            "version": self.VERSION,
+            "revisions": {
+                str(num): entry.to_json() for num, entry in sorted(self.entries.items())
+            },
+        }
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(obj, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            # e.g. a read-only checkout; we'll just have to parse again next time.
+            return
+        self.dirty = False
+
+
+@dataclass(frozen=True)
 class DbRevision(Revision):
+    """A revision whose source is stored in the database. Never changes, so anything
+    derived from it is cached forever."""
+
     number: int
     migration_text: str
     schema_text: str
@@ -197,15 +657,51 @@ class DbRevision(Revision):
     def migration_filename(self) -> str:  # type: ignore
         return f"<database file, hash={self.migration_hash.hex()}>"
 
+    @property
+    def is_trusted(self) -> bool:
+        # Revisions are only recorded after their migration has been parsed
+        return True
 
-@dataclass
+
+# Bits of the sort key given to each of a phase's change and phase numbers
+CHANGE_BITS = 16
+PHASE_BITS = 16
+
+
+@dataclass(frozen=True)
 class PhaseIndex:
+    """The position of a phase within the history of migrations, along with the
+    hashes of the revision it came from.
+
+    Ordering only looks at the position, via an integer sort key computed once up
+    front; equality and hashing also take the hashes into account."""
+
+    __slots__ = (
+        "revision",
+        "migration_hash",
+        "schema_hash",
+        "pre_deploy",
+        "change",
+        "phase",
+        "_sortkey",
+    )
+
     revision: int
     migration_hash: bytes
     schema_hash: bytes
     pre_deploy: bool
     change: int
     phase: int
+    # Not a dataclass field (hence ClassVar); set per-instance in __post_init__
+    _sortkey: ClassVar[int]
+
+    def __post_init__(self) -> None:
+        assert 0 <= self.change < 1 << CHANGE_BITS
+        assert 0 <= self.phase < 1 << PHASE_BITS
+        key = (self.revision << 1) | (0 if self.pre_deploy else 1)
+        key = (key << CHANGE_BITS) | self.change
+        key = (key << PHASE_BITS) | self.phase
+        object.__setattr__(self, "_sortkey", key)
 
     @property
     def first_change(self) -> PhaseIndex:
@@ -216,15 +712,24 @@ class PhaseIndex:
         return dataclasses.replace(self, phase=0)
 
     @property
-    def sortkey(self) -> Tuple[int, int, int, int]:
-        return (self.revision, 0 if self.pre_deploy else 1, self.change, self.phase)
+    def sortkey(self) -> int:
+        return self._sortkey
 
     @property
     def is_first_for_revision(self) -> bool:
         return self.pre_deploy and self.change == 0 and self.phase == 0
 
+    def __lt__(self, other: PhaseIndex) -> bool:
+        return self._sortkey < other._sortkey
+
+    def __le__(self, other: PhaseIndex) -> bool:
+        return self._sortkey <= other._sortkey
+
     def __gt__(self, other: PhaseIndex) -> bool:
-        return self.sortkey > other.sortkey
+        return self._sortkey > other._sortkey
+
+    def __ge__(self, other: PhaseIndex) -> bool:
+        return self._sortkey >= other._sortkey
 
 
 @dataclass
@@ -243,6 +748,46 @@ class PhaseSlice:
                 return False
         return True
 
+    def bounds(self, table: PhaseTable) -> Tuple[int, int]:
+        """Returns the range [lo, hi) of positions in the table that are in the slice.
+
+        Equivalent to checking each index with `in`, but O(log n)."""
+        indexes, keys = table.indexes, table.keys
+        lo, hi = 0, len(keys)
+        if self.start:
+            lo = bisect.bisect_left(keys, self.start.sortkey)
+            if not self.start_inclusive:
+                # Only excluded if it's the very same phase, hashes and all
+                while lo < hi and indexes[lo] == self.start:
+                    lo += 1
+        if self.end:
+            hi = bisect.bisect_right(keys, self.end.sortkey, lo)
+            if not self.end_inclusive:
+                while hi > lo and indexes[hi - 1] == self.end:
+                    hi -= 1
+        return lo, max(lo, hi)
+
+
+class PhaseTable:
+    """A sorted sequence of phase indexes, which can be sliced with a bisect."""
+
+    def __init__(self, indexes: Iterable[PhaseIndex]) -> None:
+        self.indexes = sorted(indexes)
+        self.keys = [index.sortkey for index in self.indexes]
+
+    def __len__(self) -> int:
+        return len(self.indexes)
+
+    def __iter__(self) -> Iterator[PhaseIndex]:
+        return iter(self.indexes)
+
+    def __getitem__(self, i: int) -> PhaseIndex:
+        return self.indexes[i]
+
+    def select(self, slice: PhaseSlice) -> List[PhaseIndex]:
+        lo, hi = slice.bounds(self)
+        return self.indexes[lo:hi]
+
 
 IndexChangePhase = Tuple[PhaseIndex, "changes.Change", "changes.Phase"]
 IndexRevisionChangePhase = Tuple[
@@ -256,6 +801,8 @@ class MigrationAudit:
     started_at: datetime
     finished_at: Optional[datetime]
     is_revert: bool
+    # The tenant schema whose audit stream this is in, or '' for the default
+    stream: str
     index: PhaseIndex
 
 
@@ -264,6 +811,18 @@ class Migration(BaseModel):
     pre_deploy: List[changes.Change] = []
     post_deploy: List[changes.Change] = []
 
+    @staticmethod
+    def construct_trusted(obj: Mapping[str, object]) -> Migration:
+        """Builds a migration from input that's known to be valid, skipping pydantic
+        validation (which is the bulk of the cost of loading a migration)."""
+        pre_deploy = cast(List[Mapping[str, object]], obj.get("pre_deploy", []))
+        post_deploy = cast(List[Mapping[str, object]], obj.get("post_deploy", []))
+        return Migration.construct(
+            message=cast(str, obj["message"]),
+            pre_deploy=[changes.Change.construct_trusted(c) for c in pre_deploy],
+            post_deploy=[changes.Change.construct_trusted(c) for c in post_deploy],
+        )
+
     def phases(self, index: PhaseIndex) -> Iterator[IndexChangePhase]:
         for i_change, change in enumerate(self.pre_deploy):
             for i_phase, phase in enumerate(change.inner.phases):
@@ -277,6 +836,37 @@ class Migration(BaseModel):
                 yield new_index, change, phase
 
 
+@dataclasses.dataclass
+class QueuedChain:
+    """A chain of phases in the phase queue, to be run in order by one worker."""
+
+    stream: str
+    # Chains in the same batch can run concurrently, but only once every chain in
+    # earlier batches has finished
+    batch: int
+    chain: int
+    revision: int
+    migration_hash: bytes
+    schema_hash: bytes
+    pre_deploy: bool
+    changes: List[int]
+    phases: List[int]
+
+    @property
+    def indexes(self) -> List[PhaseIndex]:
+        return [
+            PhaseIndex(
+                self.revision,
+                self.migration_hash,
+                self.schema_hash,
+                self.pre_deploy,
+                change,
+                phase,
+            )
+            for change, phase in zip(self.changes, self.phases)
+        ]
+
+
 @dataclasses.dataclass
 class AppConnection:
     pid: int
@@ -285,6 +875,22 @@ class AppConnection:
     backend_start: datetime
 
 
+@dataclasses.dataclass
+class StorageStats:
+    """How much space the revision texts stored in the database take up."""
+
+    # The total length of every stored revision's texts
+    text_bytes: int
+    # The space taken up by the (deduplicated, compressed) blobs storing them
+    stored_bytes: int
+
+    @property
+    def saved(self) -> float:
+        if not self.text_bytes:
+            return 0.0
+        return 1 - self.stored_bytes / self.text_bytes
+
+
 from . import changes
 
 for s in BaseModel.__subclasses__():
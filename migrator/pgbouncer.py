@@ -0,0 +1,52 @@
+"""Reads which revision each client connected through pgbouncer is using, from its
+admin console.
+
+Behind pgbouncer, the backends that register in migrator_status.connections are
+shared by many clients and outlive them, so they don't say which clients are still
+around. pgbouncer itself knows each client connection, and the user it logged in
+as, which is the login role of its revision's shim schema (see
+Database.create_shim_schema)."""
+from __future__ import annotations
+
+import contextlib
+import re
+from typing import Any, List, Optional, Sequence, Tuple
+
+import psycopg2
+
+from .constants import SHIM_SCHEMA_FORMAT
+
+ROLE_RE = re.compile(SHIM_SCHEMA_FORMAT.replace("%d", r"(\d+)"))
+
+
+def revision_of(user: str) -> Optional[int]:
+    """The revision whose login role the user is, if it is one."""
+    match = ROLE_RE.fullmatch(user)
+    return int(match[1]) if match else None
+
+
+def parse_clients(
+    columns: Sequence[str], rows: Sequence[Sequence[Any]], database: str
+) -> List[Tuple[int, str]]:
+    """Returns the revision and address of each client of the database in the output
+    of SHOW CLIENTS, oldest revision first. Clients that didn't log in as a revision's
+    role are left out."""
+    clients = []
+    for row in rows:
+        client = dict(zip(columns, row))
+        revision = revision_of(client["user"])
+        if client["database"] != database or revision is None:
+            continue
+        clients.append((revision, f"{client['addr']}:{client['port']}"))
+    return sorted(clients)
+
+
+def get_clients(admin_url: str, database: str) -> List[Tuple[int, str]]:
+    """Runs SHOW CLIENTS on the admin console at admin_url (see parse_clients)."""
+    with contextlib.closing(psycopg2.connect(admin_url)) as conn:
+        # The admin console doesn't support transactions
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SHOW CLIENTS")
+            columns = [column[0] for column in cur.description]
+            return parse_clients(columns, cur.fetchall(), database)
@@ -8,7 +8,7 @@ import pytest
 
 from migrator.logic import Context
 from migrator.db import temp_db_url
-from migrator.constants import SCHEMA_NAME, SHIM_SCHEMA_FORMAT
+from migrator.constants import PLAN_CACHE_FILENAME, SCHEMA_NAME, SHIM_SCHEMA_FORMAT
 from tests.fakes import FakeUserInterface
 
 
@@ -38,11 +38,18 @@ def test_db_url(control_conn: Any) -> Iterator[str]:
 
 
 @pytest.fixture
-def ctx(test_db_url: str) -> Iterator[Context]:
+def ctx(test_db_url: str, tmp_path: Any) -> Iterator[Context]:
     old_dir = os.getcwd()
     os.chdir("test")
     try:
-        ctx = Context("migrator.yml", test_db_url, FakeUserInterface())
+        # Keep the plan cache out of the checked-in fixture directory
+        plan_cache_path = str(tmp_path / PLAN_CACHE_FILENAME)
+        ctx = Context(
+            "migrator.yml",
+            test_db_url,
+            FakeUserInterface(),
+            plan_cache_path=plan_cache_path,
+        )
         with contextlib.closing(ctx):
             yield ctx
     finally:
@@ -1,5 +1,6 @@
 import hashlib
 import os
+import shutil
 import tempfile
 from typing import Any, NoReturn, TextIO, List, Tuple, Dict, cast
 
@@ -8,7 +9,13 @@ import psycopg2
 import migrator.logic
 
 from migrator.logic import Context, UserInterface, text
-from migrator import db
+from migrator import db, models
+
+POST_DEPLOY_MIGRATION = """
+message: Has a post-deploy phase
+post_deploy:
+- run_ddl: {up: ALTER TABLE users DROP COLUMN email, down: SELECT 1}
+"""
 
 
 class FakeExit(Exception):
@@ -20,6 +27,7 @@ class FakeUserInterface(UserInterface):
         self.outputs: List[Tuple[Tuple[Any, ...], Dict[str, Any]]] = []
         self.responses: Dict[str, List[str]] = {}
         self.tmpdir = tempfile.TemporaryDirectory()
+        self.removed: List[str] = []
 
     def respond_to(self, message: str, response: str) -> None:
         self.responses.setdefault(message, []).append(response)
@@ -43,6 +51,13 @@ class FakeUserInterface(UserInterface):
         print(f"open {filename}")
         return cast(TextIO, open(os.path.join(dir, os.path.basename(filename)), mode))
 
+    def remove(self, filename: str) -> None:
+        assert not os.path.isabs(filename)
+        self.removed.append(filename)
+        path = os.path.join(self.tmpdir.name, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
     def close(self) -> None:
         self.tmpdir.cleanup()
 
@@ -78,6 +93,16 @@ def schema_db_url(conn: Any, schema_sql: str) -> str:
                 raise
 
 
+def repo_with_post_deploy(tmp_path: Any) -> models.Repo:
+    """A copy of the test repo (from the test directory, where the ctx fixture runs)
+    with a third revision, which has a post-deploy phase."""
+    shutil.copytree(".", tmp_path / "test")
+    migrations = tmp_path / "test" / "migrations"
+    (migrations / "3-drop-email.yml").write_text(POST_DEPLOY_MIGRATION)
+    shutil.copy(migrations / "2-schema.sql", migrations / "3-schema.sql")
+    return models.Repo.parse(str(tmp_path / "test" / "migrator.yml"))
+
+
 class FakeContext(Context):
     # stub to help tests typecheck
     ui: FakeUserInterface
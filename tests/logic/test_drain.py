@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+from typing import Any
+
+import psycopg2
+import pytest
+
+from migrator import models, pgbouncer
+from migrator.constants import CONNECTIONS_CHANNEL, SHIM_SCHEMA_FORMAT
+from migrator.commands.revision import format_incantation
+from migrator.logic import drain, init, text
+from tests.fakes import FakeContext
+
+MIGRATION = """
+message: Has post-deploy phases
+pre_deploy:
+- run_ddl: {up: SELECT 1, down: SELECT 1}
+post_deploy:
+- run_ddl: {up: SELECT 2, down: SELECT 2}
+"""
+
+
+def connect_client(ctx: FakeContext, revision: int) -> Any:
+    conn = psycopg2.connect(ctx.database_url)
+    conn.set_session(autocommit=True)
+    register(conn, ctx.repo().revisions[revision])
+    return conn
+
+
+def register(conn: Any, revision: models.Revision) -> None:
+    with conn.cursor() as cur:
+        cur.execute(format_incantation(revision))
+
+
+def register_transaction(conn: Any, revision: models.Revision, client_id: str) -> str:
+    """Registers at the start of a transaction, as a client behind a pooler in
+    transaction mode would, and returns the search path it gets."""
+    incantation = format_incantation(revision, per_transaction=True)
+    with conn.cursor() as cur:
+        cur.execute(incantation.replace("$1", "%s"), (client_id,))
+        cur.execute("SHOW search_path")
+        return str(cur.fetchone()[0])
+
+
+def test_first_blocked(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    revision = models.DbRevision(2, MIGRATION, "", False)
+    steps = [(index, revision, c, p) for index, c, p in revision.phases()]
+    assert drain.first_blocked(ctx, steps) == (2, [])
+    client = connect_client(ctx, 1)
+    try:
+        # The pre-deploy phase can run, but not the post-deploy one
+        blocked, clients = drain.first_blocked(ctx, steps)
+        assert blocked == 1
+        assert clients == [(1, f"PID {client.get_backend_pid()}")]
+        register(client, ctx.repo().revisions[2])
+        assert drain.first_blocked(ctx, steps) == (2, [])
+    finally:
+        client.close()
+
+
+def test_wait_for_clients(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    # Only a notification could wake us up in time
+    ctx.repo().config.drain_recheck_seconds = 60
+    client = connect_client(ctx, 1)
+    revision = ctx.repo().revisions[2]
+    upgraded = threading.Timer(0.2, register, (client, revision))
+    try:
+        started = time.monotonic()
+        upgraded.start()
+        drain.wait_for_clients(ctx, 2)
+        assert time.monotonic() - started < 10
+    finally:
+        upgraded.join()
+        client.close()
+    [(args, _)] = ctx.ui.outputs
+    assert args[0].startswith(text.WAITING_FOR_CLIENTS.split("{")[0])
+
+
+def test_notify_on_revision_change(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    db = ctx.db()
+    db.listen(CONNECTIONS_CHANNEL)
+    client = connect_client(ctx, 1)
+    try:
+        assert db.wait_for_notify(5)
+        # Registering again at the same revision doesn't notify anyone...
+        register(client, ctx.repo().revisions[1])
+        assert not db.wait_for_notify(0.2)
+        # ...but moving to another one does
+        register(client, ctx.repo().revisions[2])
+        assert db.wait_for_notify(5)
+    finally:
+        client.close()
+        db.unlisten(CONNECTIONS_CHANNEL)
+
+
+def test_describe_clients() -> None:
+    clients = [(1, f"PID {pid}") for pid in range(10, 14)] + [(1, "web"), (2, "x")]
+    assert drain.describe_clients(clients) == "PID 10, PID 11, PID 12 and 2 more"
+    assert drain.describe_clients(clients[-2:]) == "web"
+
+
+def test_client_histogram_prunes(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    db = ctx.db()
+    # Left behind by clients long gone, and one that only just went
+    db.cur.execute(
+        """
+    INSERT INTO migrator_status.connections
+    SELECT -n, 1, '', now() - interval '1 hour' FROM generate_series(1, 1000) n;
+    INSERT INTO migrator_status.connections VALUES (-1001, 1, '', now());
+    """
+    )
+    client = connect_client(ctx, 2)
+    try:
+        assert db.get_client_histogram(60) == {2: 1}
+        assert db._fetch("SELECT count(*) FROM migrator_status.connections") == [(2,)]
+        assert db.get_old_clients(3, 60) == [(2, f"PID {client.get_backend_pid()}")]
+    finally:
+        client.close()
+
+
+def test_old_clients_with_pgbouncer(ctx: FakeContext, monkeypatch: Any) -> None:
+    init.init_db(ctx)
+    config = ctx.repo().config
+    config.pgbouncer_admin_url = "postgres://localhost:6643/pgbouncer"
+    pooled = [(1, "10.0.0.1:5000"), (2, "10.0.0.2:5000")]
+    monkeypatch.setattr(pgbouncer, "get_clients", lambda url, database: pooled)
+    client = connect_client(ctx, 1)
+    try:
+        with psycopg2.connect(ctx.database_url) as other:
+            register_transaction(other, ctx.repo().revisions[1], "web-1")
+        # Per-session registrations are left to pgbouncer, but not per-transaction
+        # ones
+        assert drain.old_clients(ctx, 2) == [(1, "10.0.0.1:5000"), (1, "web-1")]
+        config.pgbouncer_admin_url = None
+        assert len(drain.old_clients(ctx, 2)) == 2
+    finally:
+        client.close()
+
+
+def test_transaction_clients(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    db = ctx.db()
+    revisions = ctx.repo().revisions
+    client = psycopg2.connect(ctx.database_url)
+    try:
+        with client:
+            path = register_transaction(client, revisions[1], "web-1")
+            assert path.startswith(SHIM_SCHEMA_FORMAT % 1 + ",")
+        with client, client.cursor() as cur:
+            # The search path only lasted for that transaction
+            cur.execute("SHOW search_path")
+            assert not cur.fetchone()[0].startswith(SHIM_SCHEMA_FORMAT % 1)
+        assert db.get_old_clients(2, 60) == [(1, "web-1")]
+        assert db.get_client_histogram(60) == {1: 1}
+        # Registering again soon after doesn't write anything
+        seen = "SELECT last_seen FROM migrator_status.clients"
+        last_seen = db._fetch(seen)
+        with client:
+            register_transaction(client, revisions[1], "web-1")
+        assert db._fetch(seen) == last_seen
+        with client:
+            register_transaction(client, revisions[2], "web-1")
+        assert db.get_old_clients(2, 60) == []
+        # Once it hasn't been seen for client_ttl, it's gone
+        assert db.get_old_clients(3, 0) == []
+        assert db._fetch("SELECT count(*) FROM migrator_status.clients") == [(0,)]
+    finally:
+        client.close()
+
+
+@pytest.mark.skipif(
+    "PGBOUNCER_URL" not in os.environ,
+    reason="needs PGBOUNCER_URL, e.g. docker-pgbouncer's, in front of DATABASE_URL",
+)
+def test_transaction_clients_through_pgbouncer(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    revision = ctx.repo().revisions[1]
+    client = psycopg2.connect(os.environ["PGBOUNCER_URL"])
+    try:
+        # Each transaction may run on a different backend
+        for _ in range(2):
+            with client:
+                path = register_transaction(client, revision, "web-1")
+                assert path.startswith(SHIM_SCHEMA_FORMAT % 1 + ",")
+            assert ctx.db().get_old_clients(2, 60) == [(1, "web-1")]
+    finally:
+        client.close()
@@ -0,0 +1,81 @@
+from typing import List
+
+from migrator import changes, models
+from migrator.logic import elide, init, migrate, schedule
+from tests.fakes import FakeContext
+
+MIGRATION = """
+message: Comes and goes
+pre_deploy:
+- run_ddl: {up: "CREATE TABLE tmp (x INT)", down: DROP TABLE tmp}
+- create_index: {name: tmp_x, table: tmp, expr: x}
+- create_index: {name: missing_x, table: missing, expr: x}
+- add_constraint: {name: missing_pos, table: missing, check: (x > 0)}
+- run_ddl: {up: "CREATE TABLE kept (x INT)", down: DROP TABLE kept}
+post_deploy:
+- drop_index: {name: missing_x, table: missing, expr: x}
+- drop_constraint: {name: missing_pos, table: missing, check: (x > 0)}
+- run_ddl: {up: DROP TABLE tmp, down: "CREATE TABLE tmp (x INT)"}
+"""
+
+
+def make_steps(migration: str = MIGRATION) -> List[schedule.Step]:
+    revision = models.DbRevision(1, migration, "", False)
+    return [(index, revision, c, p) for index, c, p in revision.phases()]
+
+
+def elided(steps: List[schedule.Step]) -> List[bool]:
+    return [isinstance(phase.up, changes.Elided) for _, _, _, phase in steps]
+
+
+def test_elide() -> None:
+    steps = elide.elide(make_steps())
+    assert elided(steps) == [
+        # tmp, and its index
+        True,
+        True,
+        # missing_x
+        True,
+        # missing_pos: ADD ... NOT VALID and VALIDATE
+        True,
+        True,
+        # kept
+        False,
+        # missing_x, missing_pos (both phases) and tmp
+        True,
+        True,
+        True,
+        True,
+    ]
+    assert steps[0][3].up == changes.Elided(opens="tmp")
+    assert steps[-1][3].up == changes.Elided(closes="tmp")
+
+
+def test_elide_used_in_between() -> None:
+    migration = """
+message: Uses the table
+pre_deploy:
+- run_ddl: {up: "CREATE TABLE tmp (x INT)", down: DROP TABLE tmp}
+- run_ddl: {up: "INSERT INTO kept SELECT x FROM tmp", down: ""}
+- run_ddl: {up: DROP TABLE tmp, down: "CREATE TABLE tmp (x INT)"}
+- create_index: {name: kept_x, table: kept, expr: x}
+- run_ddl: {up: "ALTER INDEX kept_x SET (fillfactor = 50)", down: ""}
+- drop_index: {name: kept_x, table: kept, expr: x}
+"""
+    assert not any(elided(elide.elide(make_steps(migration))))
+
+
+def test_run_elided(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    db = ctx.db()
+    # tmp's span commits all at once, whatever the budget
+    ctx.repo().config.catch_up_max_phases = 1
+    steps = make_steps()
+    migrate.run_transaction(ctx, elide.elide(steps))
+    # The index and constraint on a missing table would have failed if they'd run
+    assert db._fetch("SELECT to_regclass('tmp'), to_regclass('kept')") == [
+        (None, "kept")
+    ]
+    audits = [db.get_audit(index) for index, _, _, _ in steps]
+    assert all(audit.finished_at is not None for audit in audits)
+    assert len({audit.started_at for audit in audits}) == 1
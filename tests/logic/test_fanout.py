@@ -0,0 +1,90 @@
+from typing import Any
+from urllib.parse import urlparse
+
+import psycopg2
+
+from migrator import db
+from migrator.commands.revision import format_incantation
+from migrator.logic import fanout, init, text
+from tests.fakes import FakeContext, repo_with_post_deploy
+
+
+def test_fan_out(ctx: FakeContext, control_conn: Any) -> None:
+    with db.temp_db_url(control_conn) as url1, db.temp_db_url(control_conn) as url2:
+        ready = db.Database(url1)
+        ready.create_schema()
+        ready.close()
+        outcomes = fanout.fan_out(ctx, [url1, url2])
+        assert [o.phases for o in outcomes] == [2, 0]
+        assert outcomes[0].ok
+        assert str(outcomes[1].error) == text.NOT_INITIALIZED
+        printed = [args[0] for args, _ in ctx.ui.outputs]
+        # The post-deploy stage is held back until every database is ready for it
+        assert text.FAN_OUT_HOLDING_BACK in printed
+        assert printed[-1] == text.FAN_OUT_FAILURE.format(
+            database=fanout.describe_url(url2), error=text.NOT_INITIALIZED
+        )
+        assert str(urlparse(url2).password) not in fanout.describe_url(url2)
+
+        uninitialized = db.Database(url2)
+        uninitialized.create_schema()
+        uninitialized.close()
+        outcomes = fanout.fan_out(ctx, [url1, url2])
+        assert [(o.ok, o.phases) for o in outcomes] == [(True, 0), (True, 2)]
+
+
+def test_fan_out_blocked(ctx: FakeContext, control_conn: Any, tmp_path: Any) -> None:
+    ctx._repo = repo_with_post_deploy(tmp_path)
+    with db.temp_db_url(control_conn) as url:
+        database = db.Database(url)
+        database.create_schema()
+        database.close()
+        client = psycopg2.connect(url)
+        client.set_session(autocommit=True)
+        try:
+            with client.cursor() as cur:
+                cur.execute(format_incantation(ctx.repo().revisions[2]))
+            [outcome] = fanout.fan_out(ctx, [url])
+            assert outcome.ok and not outcome.done
+            assert (outcome.phases, outcome.blocked) == (
+                2,
+                [(2, f"PID {client.get_backend_pid()}")],
+            )
+            printed = [args[0] for args, _ in ctx.ui.outputs]
+            assert printed[-2] == text.FAN_OUT_SUMMARY.format(
+                ok=0, total=1, phases=2, blocked=1, failed=0
+            )
+
+            with client.cursor() as cur:
+                cur.execute(format_incantation(ctx.repo().revisions[3]))
+            [outcome] = fanout.fan_out(ctx, [url])
+            assert outcome.done and outcome.phases == 1
+        finally:
+            client.close()
+
+
+def test_fan_out_tenants(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    tenants = ["tenant_a", "tenant_b", "tenant_c"]
+    mdb = ctx.db()
+    mdb.cur.execute("".join(f"CREATE SCHEMA {t};" for t in tenants))
+    try:
+        outcomes = fanout.fan_out_tenants(ctx, tenants)
+        assert [(o.tenant, o.ok, o.phases) for o in outcomes] == [
+            (t, True, 2) for t in tenants
+        ]
+        for tenant in tenants:
+            mdb.cur.execute(f"SELECT u_id, email, mobile FROM {tenant}.users")
+        assert mdb.get_latest_audit() is None
+        tenant_db = db.Database(ctx.database_url, tenant="tenant_b")
+        audit = tenant_db.get_latest_audit()
+        assert audit is not None and audit.stream == "tenant_b"
+        assert audit.index == ctx.repo().revisions[2].last_index
+        assert tenant_db.shim_schema(2) == "tenant_b_migrator_rev_2"
+        tenant_db.close()
+
+        # Already done
+        outcomes = fanout.fan_out_tenants(ctx, tenants)
+        assert [o.phases for o in outcomes] == [0, 0, 0]
+    finally:
+        mdb.cur.execute("".join(f"DROP SCHEMA {t} CASCADE;" for t in tenants))
@@ -1,3 +1,11 @@
+import threading
+from typing import List, Tuple
+
+import psycopg2.errors
+import pytest
+
+from migrator import changes, db, models
+from migrator.constants import SHIM_SCHEMA_FORMAT
 from migrator.logic import migrate, init
 from tests.fakes import FakeContext
 
@@ -12,3 +20,193 @@ def test_upgrade(ctx: FakeContext) -> None:
     migrate.downgrade(ctx, to_revision=1)
     # This statement will fail on revision 2
     db.cur.execute("insert into users values (1, '2')")
+
+
+def test_one_runner_at_a_time(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    other = db.Database(ctx.database_url)
+    ran: List[int] = []
+    upgrade = threading.Thread(target=lambda: ran.append(migrate.upgrade(ctx)))
+    try:
+        with other.advisory_lock(migrate.migrate_lock(ctx)):
+            upgrade.start()
+            # Waits for the other runner to finish
+            upgrade.join(0.5)
+            assert upgrade.is_alive()
+            assert other.get_latest_audit() is None
+        upgrade.join()
+    finally:
+        other.close()
+    assert ran == [2]
+
+
+def test_revisions_recorded_as_they_run(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    db = ctx.db()
+    migrate.upgrade(ctx, end=ctx.repo().revisions[2].first_index)
+    # Revision 2 hasn't run, so it's not recorded (and can still be edited)
+    assert list(db.get_revisions()) == [1]
+    migration = "message: Fails\npre_deploy:\n- run_ddl: {up: SELECT 1/0, down: ''}\n"
+    revision = models.DbRevision(3, migration, "", False)
+    steps = [(index, revision, c, p) for index, c, p in revision.phases()]
+    # Nor is one whose first phase failed
+    with pytest.raises(psycopg2.errors.DivisionByZero):
+        migrate.run_phases(ctx, steps)
+    assert list(db.get_revisions()) == [1]
+
+
+def test_transactional_phase_round_trips(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    db = ctx.db()
+    index = ctx.repo().revisions[1].first_index
+    # warm up the prepared statements
+    changes.NoOp().run(db, index)
+    round_trips = db.round_trips
+    changes.TxDDL("CREATE TABLE foo (t TEXT CHECK (t LIKE '%'))").run(db, index)
+    assert db.round_trips - round_trips == 1
+    audit = db.get_latest_audit()
+    assert audit is not None and audit.finished_at is not None
+    assert audit.index == index
+
+    # The audit rows are rolled back along with a failed phase
+    with pytest.raises(psycopg2.errors.DivisionByZero):
+        changes.TxDDL("SELECT 1/0").run(db, ctx.repo().revisions[2].first_index)
+    assert db.get_latest_audit() == audit
+
+
+def test_catch_up(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    config = ctx.repo().config
+    config.catch_up = True
+    migrate.upgrade(ctx)
+    db = ctx.db()
+    first = db.get_audit(ctx.repo().revisions[1].first_index)
+    second = db.get_audit(ctx.repo().revisions[2].first_index)
+    # One audit row per phase, written in the same transaction
+    assert first.id != second.id
+    assert first.started_at == second.started_at
+
+    migrate.downgrade(ctx, to_revision=0)
+    config.catch_up_max_phases = 1
+    migrate.upgrade(ctx)
+    first = db.get_audit(ctx.repo().revisions[1].first_index)
+    second = db.get_audit(ctx.repo().revisions[2].first_index)
+    assert first.started_at < second.started_at
+
+    # 0 means no limit, not a limit of 0
+    migrate.downgrade(ctx, to_revision=0)
+    config.catch_up_max_phases = 0
+    config.catch_up_max_seconds = 0
+    migrate.upgrade(ctx)
+    first = db.get_audit(ctx.repo().revisions[1].first_index)
+    second = db.get_audit(ctx.repo().revisions[2].first_index)
+    assert first.started_at == second.started_at
+
+
+def test_catch_up_failure(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    migration = """
+message: Fails
+pre_deploy:
+- run_ddl: {up: CREATE TABLE t (), down: DROP TABLE t}
+- run_ddl: {up: SELECT 1/0, down: ""}
+"""
+    revision = models.DbRevision(1, migration, "", False)
+    steps = [(index, revision, c, p) for index, c, p in revision.phases()]
+    db = ctx.db()
+    with pytest.raises(psycopg2.errors.DivisionByZero):
+        migrate.run_transaction(ctx, steps)
+    # The first phase was rolled back along with the second
+    assert db.get_latest_audit() is None
+    assert db._fetch("SELECT to_regclass('t')")[0][0] is None
+    assert not db.in_tx
+
+
+def test_bootstrap(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    ctx.repo().config.bootstrap_empty = True
+    revisions = ctx.repo().revisions
+    db = ctx.db()
+    shims = [SHIM_SCHEMA_FORMAT % n for n in (1, 2)]
+    # Roles outlive the database between tests
+    db.cur.execute(f"DROP ROLE IF EXISTS {', '.join(shims)}")
+    phases = migrate.upgrade(ctx)
+    db.cur.execute("select u_id, email, mobile from users")
+    # Replay leaves each revision's login role behind, but drops its shim schema
+    # after its last phase
+    roles = db._fetch("SELECT rolname FROM pg_roles WHERE rolname = ANY(%s)", (shims,))
+    assert sorted(roles) == [(shim,) for shim in shims]
+    schemas = db._fetch(
+        "SELECT nspname FROM pg_namespace WHERE nspname = ANY(%s)", (shims,)
+    )
+    assert schemas == []
+    assert len(db.get_revisions()) == 2
+    assert phases == len(revisions[1].phase_indexes) + len(revisions[2].phase_indexes)
+    for revision in revisions.values():
+        for index in revision.phase_indexes:
+            assert db.get_audit(index).finished_at is not None
+    latest = db.get_latest_audit()
+    assert latest is not None and latest.index == revisions[2].last_index
+    # It's as if every phase had run
+    assert migrate.upgrade(ctx) == 0
+    migrate.downgrade(ctx, to_revision=1)
+    db.cur.execute("insert into users values (1, '2')")
+
+
+def test_resume_invalid_index(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    db = ctx.db()
+    db.cur.execute("CREATE TABLE t (x INT); INSERT INTO t VALUES (1), (1)")
+    change = changes.CreateIndex(name="t_x", table="t", expr="x", unique=True)
+    # An interrupted build (here, by a duplicate) leaves an INVALID index behind
+    with pytest.raises(psycopg2.errors.UniqueViolation):
+        db.cur.execute(change.create_sql)
+    assert db.get_index_state("t_x") == (False, False)
+    db.cur.execute("DELETE FROM t; INSERT INTO t VALUES (1)")
+    index = ctx.repo().revisions[1].first_index
+    db.audit_phase_start(index)
+    [phase] = change.phases
+    phase.run(db, index)
+    assert db.get_index_state("t_x") == (True, False)
+    assert not db.get_unfinished_audits()
+
+
+def test_wait_for_index_build(monkeypatch: pytest.MonkeyPatch) -> None:
+    class FakeDatabase:
+        # Being built by another backend, then done
+        states = [(False, True), (False, True), (True, False)]
+        cur = None
+
+        def get_index_state(self, name: str) -> Tuple[bool, bool]:
+            return self.states.pop(0)
+
+    monkeypatch.setattr(changes, "INDEX_BUILD_POLL_INTERVAL", 0)
+    change = changes.CreateIndex(name="t_x", table="t", expr="x")
+    # Doesn't build the index itself (so doesn't touch cur)
+    change.create_phase.run_inner(FakeDatabase())  # type: ignore
+    assert not FakeDatabase.states
+
+
+def test_shim_roles(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    db = ctx.db()
+    ctx.repo().config.shim_roles = "renames"
+    plain = models.DbRevision(9001, "message: m\n", "", False)
+    renames = models.DbRevision(
+        9002,
+        "message: m\npre_deploy:\n- begin_rename: {table: t, renames: {a: b}}\n",
+        "",
+        False,
+    )
+    role_exists = "SELECT EXISTS (SELECT FROM pg_roles WHERE rolname = %s)"
+    try:
+        for revision in (plain, renames):
+            migrate.create_shim_schema(ctx, revision)
+            shim = db.shim_schema(revision.number)
+            assert db._fetch("SELECT to_regnamespace(%s) IS NOT NULL", (shim,))[0][0]
+        assert not db._fetch(role_exists, (db.shim_schema(9001),))[0][0]
+        assert db._fetch(role_exists, (db.shim_schema(9002),))[0][0]
+    finally:
+        for revision in (plain, renames):
+            db.drop_shim_schema(revision.number)
+        db.cur.execute(f"DROP ROLE IF EXISTS {db.shim_schema(9002)}")
@@ -0,0 +1,99 @@
+import contextlib
+
+from migrator import models
+from migrator.logic import init, schedule
+from tests.fakes import FakeContext
+
+MIGRATION = """
+message: Indexes
+pre_deploy:
+- create_index: {name: a_x, table: a, expr: x}
+- create_index: {name: b_x, table: b, expr: x}
+- create_index: {name: a_y, table: a, expr: y}
+- add_constraint: {name: b_pos, table: b, check: (x > 0)}
+post_deploy:
+- drop_index: {name: b_x, table: b, expr: x}
+"""
+
+
+def make_revision() -> models.Revision:
+    return models.DbRevision(1, MIGRATION, "", False)
+
+
+def test_batches() -> None:
+    revision = make_revision()
+    steps = [(index, revision, c, p) for index, c, p in revision.phases()]
+    batches = list(schedule.batches(steps))
+    assert [[type(step[2].inner).__name__ for step in b] for b in batches] == [
+        ["CreateIndex", "CreateIndex", "CreateIndex"],
+        # ADD CONSTRAINT ... NOT VALID runs alone; VALIDATE could run concurrently
+        ["AddConstraint"],
+        ["AddConstraint"],
+        # Post-deploy phases never share a batch with pre-deploy ones
+        ["DropIndex"],
+    ]
+    chains = schedule.chains(batches[0])
+    assert [[step[2].inner.name for step in c] for c in chains] == [  # type: ignore
+        ["a_x", "a_y"],
+        ["b_x"],
+    ]
+
+
+def test_run_concurrently(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    db = ctx.db()
+    db.cur.execute("CREATE TABLE a (x INT, y INT); CREATE TABLE b (x INT)")
+    revision = make_revision()
+    steps = [(index, revision, c, p) for index, c, p in revision.phases()]
+    reported = []
+    scheduler = schedule.Scheduler(ctx.database_url, 2)
+    with contextlib.closing(scheduler):
+        for batch in scheduler.batches(steps):
+            scheduler.run(db, batch, lambda index, _: reported.append(index))
+    assert sorted(reported) == [step[0] for step in steps]
+    # The batch of indexes ran on two worker connections
+    assert len(scheduler._databases) == 2
+    assert not db.get_unfinished_audits()
+    indexes = db._fetch("SELECT indexname FROM pg_indexes WHERE tablename = 'a'")
+    assert sorted(indexes) == [("a_x",), ("a_y",)]
+
+
+def test_run_concurrently_in_tenant(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    db = ctx.db()
+    db.cur.execute("CREATE SCHEMA tenant_a")
+    try:
+        db.use_tenant("tenant_a")
+        db.cur.execute("CREATE TABLE a (x INT, y INT); CREATE TABLE b (x INT)")
+        revision = make_revision()
+        steps = [(index, revision, c, p) for index, c, p in revision.phases()]
+        scheduler = schedule.Scheduler(ctx.database_url, 2, db.tenant)
+        with contextlib.closing(scheduler):
+            batch = next(scheduler.batches(steps))
+            assert len(batch) == 3
+            scheduler.run(db, batch, lambda index, _: None)
+        # The worker connections built the indexes in the tenant's schema, and
+        # audited them in its stream
+        assert [d.tenant for d in scheduler._databases] == ["tenant_a", "tenant_a"]
+        indexes = db._fetch(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = 'tenant_a'"
+        )
+        assert sorted(indexes) == [("a_x",), ("a_y",), ("b_x",)]
+        assert db.get_latest_audit() is not None
+        db.use_tenant(None)
+        assert db.get_latest_audit() is None
+    finally:
+        db.use_tenant(None)
+        db.cur.execute("DROP SCHEMA tenant_a CASCADE")
+
+
+def test_adopt_unfinished_audit(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    db = ctx.db()
+    first, second = [index for index, _, _ in make_revision().phases()][:2]
+    # Several phases can be in flight at once
+    audit = db.audit_phase_start(first)
+    db.audit_phase_start(second)
+    assert len(db.get_unfinished_audits()) == 2
+    # ...and an idempotent phase picks up where it left off
+    assert db.audit_phase_start(first, adopt=True) == audit
@@ -0,0 +1,103 @@
+import psycopg2.errors
+import pytest
+import yaml
+
+from migrator import models
+from migrator.logic import Context, init, migrate, squash
+from tests.fakes import FakeContext, FakeUserInterface
+
+
+def squashed_revisions(ctx: FakeContext) -> models.RevisionList:
+    """The test repo's revisions, as they'd be after squashing through #2"""
+    baseline = ctx.repo().revisions[2]
+    migration = squash.baseline_migration(1, baseline)
+    text = yaml.safe_dump(migration.dict(exclude_defaults=True), sort_keys=False)
+    return models.RevisionList(
+        {2: models.DbRevision(2, text, baseline.schema_text, False)}
+    )
+
+
+def test_squash(ctx: FakeContext) -> None:
+    squash.squash(ctx, 2)
+    assert ctx.ui.removed == [
+        "migrations/1-create-table.yml",
+        "migrations/1-schema.sql",
+    ]
+    with ctx.ui.open("migrations/2-add-mobile.yml", "r") as f:
+        migration = models.Migration(**models.parse_yaml(f.read()))
+    [change] = migration.pre_deploy
+    assert change.inner.up == ctx.repo().revisions[2].schema_text  # type: ignore
+
+
+def test_squash_db(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    migrate.upgrade(ctx)
+    db = ctx.db()
+    old_first = ctx.repo().revisions[1].migration_hash
+    ctx.repo().revisions = squashed_revisions(ctx)
+    assert migrate.upgrade(ctx) == 0
+    assert list(db.get_revisions()) == [2]
+    latest = db.get_latest_audit()
+    assert latest is not None and latest.index == ctx.repo().revisions[2].last_index
+    assert not db._fetch(
+        "SELECT FROM migrator_status.migration_audit WHERE revision < 2"
+    )
+    assert not db._fetch(
+        "SELECT FROM migrator_status.blobs WHERE hash = %s", (old_first,)
+    )
+    # Can't go back past the baseline
+    with pytest.raises(psycopg2.errors.RaiseException):
+        migrate.downgrade(ctx, to_revision=1)
+
+
+def test_squash_db_behind(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    migrate.upgrade(ctx, end=ctx.repo().revisions[2].first_index)
+    ctx.repo().revisions = squashed_revisions(ctx)
+    with pytest.raises(squash.SquashError):
+        migrate.upgrade(ctx)
+
+
+def test_squash_db_tenants(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    tenants = ["tenant_a", "tenant_b", "tenant_c"]
+    ctx.db().cur.execute("".join(f"CREATE SCHEMA {t};" for t in tenants))
+    a, b, c = [
+        Context(
+            ctx.config_path,
+            ctx.database_url,
+            FakeUserInterface(),
+            tenant,
+            _repo=ctx.repo(),
+        )
+        for tenant in tenants
+    ]
+    try:
+        migrate.upgrade(a)
+        migrate.upgrade(b, end=ctx.repo().revisions[2].first_index)
+        migrate.upgrade(c)
+        ctx.repo().revisions = squashed_revisions(ctx)
+        # The first tenant to upgrade squashes every tenant that's past the baseline
+        assert migrate.upgrade(a) == 0
+        assert list(ctx.db().get_revisions()) == [2]
+        for tenant in (a, c):
+            assert tenant.db().get_first_audited_revision() == 2
+            latest = tenant.db().get_latest_audit()
+            assert latest is not None
+            assert latest.index == ctx.repo().revisions[2].last_index
+        assert migrate.upgrade(c) == 0
+        # ...and leaves the history of any that's behind it alone
+        assert b.db().get_first_audited_revision() == 1
+        with pytest.raises(squash.SquashError):
+            migrate.upgrade(b)
+    finally:
+        for tenant in (a, b, c):
+            tenant.close()
+        ctx.db().cur.execute("".join(f"DROP SCHEMA {t} CASCADE;" for t in tenants))
+
+
+def test_upgrade_from_baseline(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    ctx.repo().revisions = squashed_revisions(ctx)
+    assert migrate.upgrade(ctx) == 1
+    ctx.db().cur.execute("select u_id, email, mobile from users")
@@ -0,0 +1,112 @@
+import threading
+from typing import Any, List
+
+import psycopg2
+import pytest
+
+from migrator import db
+from migrator.constants import SCHEMA_NAME
+from migrator.commands.revision import format_incantation
+from migrator.logic import Context, init, migrate, text, worker
+from tests.fakes import FakeContext, FakeUserInterface, repo_with_post_deploy
+
+
+def test_workers(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    ran: List[int] = []
+
+    def work(name: str) -> None:
+        other = Context(ctx.config_path, ctx.database_url, FakeUserInterface())
+        other._repo = ctx.repo()
+        ran.append(worker.work(other, worker=name, poll_interval=0.01))
+        other.close_db()
+
+    threads = [threading.Thread(target=work, args=(f"w{i}",)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(ran) == 2
+    assert ctx.db().get_queue_status() == (0, None)
+    ctx.db().cur.execute("SELECT u_id, email, mobile FROM users")
+    # Nothing left to do
+    assert worker.work(ctx) == 0
+
+
+def test_claims(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    worker.publish(ctx)
+    first = db.Database(ctx.database_url)
+    chain = first.claim_chain("first")
+    assert chain is not None and chain.batch == 0
+    # The next chain waits for the first to finish
+    mdb = ctx.db()
+    assert mdb.claim_chain("second") is None
+    # ...unless the first worker dies, in which case its chain can be reclaimed
+    first.close()
+    reclaimed = mdb.claim_chain("second")
+    assert reclaimed == chain
+    mdb.finish_chain(reclaimed, error="oops")
+    assert mdb.get_queue_status() == (2, "oops")
+    # Publishing again replaces the failed plan
+    worker.publish(ctx)
+    assert mdb.get_queue_status() == (2, None)
+
+
+def test_stale_finish(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    worker.publish(ctx)
+    first = db.Database(ctx.database_url)
+    chain = first.claim_chain("first")
+    assert chain is not None
+    # Another worker fails a chain while the first is still running its own
+    mdb = ctx.db()
+    mdb.cur.execute(
+        f"UPDATE {SCHEMA_NAME}.phase_queue SET error = 'oops' WHERE batch = 1"
+    )
+    assert mdb.claim_chain("second") is None
+    # The failed plan isn't replaced while one of its chains is still running...
+    with pytest.raises(worker.QueueError):
+        worker.publish(ctx)
+    # ...but if it were, the first worker finishing wouldn't touch the new plan
+    mdb.publish_chains(worker.plan(mdb.stream, migrate.pending_phases(ctx)))
+    first.finish_chain(chain)
+    assert mdb.get_queue_status() == (2, None)
+    assert mdb.claim_chain("second") == chain
+    first.close()
+
+
+def test_workers_hold_back_post_deploy(ctx: FakeContext, tmp_path: Any) -> None:
+    ctx._repo = repo_with_post_deploy(tmp_path)
+    init.init_db(ctx)
+    client = psycopg2.connect(ctx.database_url)
+    client.set_session(autocommit=True)
+    try:
+        with client.cursor() as cur:
+            cur.execute(format_incantation(ctx.repo().revisions[2]))
+        # Revision #3's post-deploy phase is left out of the plan
+        assert worker.work(ctx) == 2
+        blocking = text.CLIENTS_BLOCKING.split("{")[0]
+        assert any(args[0].startswith(blocking) for args, _ in ctx.ui.outputs)
+        with client.cursor() as cur:
+            cur.execute(format_incantation(ctx.repo().revisions[3]))
+        assert worker.work(ctx) == 1
+    finally:
+        client.close()
+
+
+def test_workers_wait_for_up(ctx: FakeContext) -> None:
+    init.init_db(ctx)
+    other = db.Database(ctx.database_url)
+    ran: List[int] = []
+    work = threading.Thread(target=lambda: ran.append(worker.work(ctx)))
+    try:
+        with other.advisory_lock(migrate.migrate_lock(ctx)):
+            work.start()
+            work.join(0.5)
+            assert work.is_alive()
+            assert other.get_queue_status() == (0, None)
+        work.join()
+    finally:
+        other.close()
+    assert ran == [2]
@@ -0,0 +1,23 @@
+from migrator import blobs
+
+
+def test_delta_round_trip() -> None:
+    base = "".join(f"CREATE TABLE t{i} (id INT);\n" for i in range(100))
+    text = base.replace("t50 (id INT)", "t50 (id BIGINT)") + "CREATE TABLE u ();"
+    blob = blobs.encode(text, base)
+    assert blob.hash == blobs.text_hash(text)
+    assert blob.base_hash == blobs.text_hash(base)
+    assert blob.depth == 1
+    assert blob.size == len(text)
+    assert blobs.decode([blob.data, blobs.encode(base).data]) == text
+
+
+def test_encode_whole() -> None:
+    text = "SELECT 1;\n"
+    # A delta against an unrelated text isn't worth it
+    blob = blobs.encode(text, "".join(f"-- {i}\n" for i in range(100)))
+    assert blob.base_hash is None and blob.depth == 0
+    assert blobs.decode([blob.data]) == text
+    # Chains of deltas are bounded
+    deep = blobs.encode(text + "\n", text, blobs.MAX_DEPTH)
+    assert deep.base_hash is None
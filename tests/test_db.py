@@ -0,0 +1,132 @@
+import datetime
+
+from migrator import db, models
+
+
+def test_prepared_query() -> None:
+    query = db.PreparedQuery.build(
+        "SELECT %(a)s, %(b)s, %(a)s, '100%%' WHERE x = %(b)s"
+    )
+    assert query.text == "SELECT $1, $2, $1, '100%' WHERE x = $2"
+    assert query.bind({"a": 1, "b": 2}) == [1, 2]
+    positional = db.PreparedQuery.build("UPDATE t SET x = %s WHERE id = %s")
+    assert positional.text == "UPDATE t SET x = $1 WHERE id = $2"
+    assert positional.bind(("x", 3)) == ["x", 3]
+    assert db.PreparedQuery.build("SELECT %s") is db.PreparedQuery.build("SELECT %s")
+
+
+def test_prepared_statements(test_db_url: str) -> None:
+    mdb = db.Database(test_db_url)
+    mdb.create_schema()
+    index = models.PhaseIndex(1, b"m", b"s", True, 0, 0)
+    for i in range(3):
+        audit = mdb.audit_phase_start(index)
+        mdb.audit_phase_end(audit)
+        assert mdb.get_latest_audit() == mdb.get_audit(index)
+    # 4 distinct queries, each run 3 times
+    assert len(mdb.prepared) == 4
+    assert mdb.prepared_hits == 8
+
+    unprepared = db.Database(test_db_url, prepare_statements=False)
+    assert unprepared.get_latest_audit() == mdb.get_latest_audit()
+    assert not unprepared.prepared
+    unprepared.close()
+    mdb.close()
+
+
+def test_bulk_upsert_and_lazy_revisions(test_db_url: str) -> None:
+    mdb = db.Database(test_db_url)
+    mdb.create_schema()
+    revs = [
+        models.DbRevision(n, "message: m\n", f"-- 100% schema {n}\n", False)
+        for n in (1, 2, 3)
+    ]
+    mdb.upsert_revision(revs[0])
+    before = mdb.round_trips
+    mdb.upsert_revisions(revs)
+    # Look up what's already recorded and the schema to delta-encode against, then
+    # one INSERT for the rest
+    assert mdb.round_trips - before == 3
+    before = mdb.round_trips
+    mdb.upsert_revisions(revs)
+    assert mdb.round_trips - before == 1
+
+    lazy = mdb.get_revisions(texts=False)
+    assert list(lazy) == [1, 2, 3]
+    rev = lazy[2]
+    assert isinstance(rev, models.LazyDbRevision)
+    assert rev.schema_hash == revs[1].schema_hash
+    before = mdb.round_trips
+    assert rev.schema_text == revs[1].schema_text
+    assert mdb.round_trips > before
+    # The texts are fetched together, once
+    before = mdb.round_trips
+    assert rev.migration_text == revs[1].migration_text
+    assert rev.migration.message == "m"
+    assert mdb.round_trips == before
+    mdb.close()
+
+
+def test_upgrade_schema(test_db_url: str) -> None:
+    mdb = db.Database(test_db_url)
+    with mdb.tx():
+        mdb.cur.execute(db.SCHEMA_DDL)
+    assert mdb.get_schema_version() == 1
+    schema = "".join(f"CREATE TABLE t{i} (id INT);\n" for i in range(100))
+    revs = [
+        models.DbRevision(1, "message: one\n", schema, False),
+        models.DbRevision(2, "message: two\n", schema + "-- two\n", True),
+        models.DbRevision(2, "message: two\n", schema + "-- 2\n", False),
+        models.DbRevision(3, "message: three\n", schema, False),
+    ]
+    for rev in revs:
+        mdb.cur.execute(
+            f"""
+        INSERT INTO {db.SCHEMA_NAME}.revisions
+        VALUES (%s, %s, %s, %s, %s, %s)""",
+            (
+                rev.number,
+                rev.migration_hash,
+                rev.schema_hash,
+                rev.migration_text,
+                rev.schema_text,
+                rev.is_deleted,
+            ),
+        )
+
+    assert mdb.upgrade_schema()
+    assert mdb.get_schema_version() == db.SCHEMA_VERSION
+    assert not mdb.upgrade_schema()
+    assert list(mdb.get_revisions().values()) == [revs[0], revs[2], revs[3]]
+    assert mdb.get_revision(2, revs[1].migration_hash, revs[1].schema_hash) == revs[1]
+    # Revisions 1 and 3 share a blob, and 2's schemas are deltas against it
+    assert mdb._fetch(f"SELECT count(*) FROM {db.SCHEMA_NAME}.blobs")[0][0] == 6
+    stats = mdb.get_storage_stats()
+    assert stats.text_bytes == sum(
+        len(rev.migration_text) + len(rev.schema_text) for rev in revs
+    )
+    assert stats.saved > 0.9
+    mdb.close()
+
+
+def test_template_cache(test_db_url: str) -> None:
+    mdb = db.Database(test_db_url)
+    schema = "CREATE TABLE t (id INT); -- 100%"
+    url = mdb.template_db_url(schema)
+    try:
+        round_trips = mdb.round_trips
+        assert mdb.template_db_url(schema) == url
+        # Just checks it exists and records that it was used
+        assert mdb.round_trips - round_trips == 2
+        other = db.Database(url)
+        assert other._fetch("SELECT count(*) FROM t")[0][0] == 0
+        other.close()
+
+        day = datetime.timedelta(days=1)
+        name = url.rsplit("/", 1)[1]
+        assert name not in mdb.evict_templates(keep=1, max_age=day)
+        assert name in mdb.evict_templates(keep=0, max_age=day)
+        assert not mdb._database_exists(name)
+    finally:
+        mdb.evict_templates(keep=0, max_age=datetime.timedelta())
+        mdb.close()
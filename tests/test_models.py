@@ -1,7 +1,11 @@
+import shutil
 from typing import Any
 
+import pydantic
+import pytest
 import yaml
 from migrator import models
+from migrator.constants import PLAN_CACHE_FILENAME
 
 
 def load_yaml(fname: str) -> Any:
@@ -15,3 +19,153 @@ def test_basic_parse() -> None:
     assert m.post_deploy == []
     [step1] = m.pre_deploy
     assert step1.run_ddl is not None
+
+
+def test_pgbouncer_needs_roles() -> None:
+    def config(shim_roles: str, registration: str = "session") -> models.RepoConfig:
+        return models.RepoConfig.parse_obj(
+            dict(
+                schema_dump_command="",
+                pgbouncer_admin_url="postgres://pgbouncer",
+                shim_roles=shim_roles,
+                registration=registration,
+            )
+        )
+
+    config("always")
+    config("never", registration="transaction")
+    # Clients on a shared role would be invisible to the drain check
+    for shim_roles in ("renames", "never"):
+        with pytest.raises(pydantic.ValidationError):
+            config(shim_roles)
+
+
+def test_revision_parsed_once(monkeypatch: Any) -> None:
+    r = models.Repo.parse("test/migrator.yml")
+    rev = r.revisions[2]
+    calls = []
+    real_load = models.parse_yaml
+
+    def counting_load(text: str) -> Any:
+        calls.append(text)
+        return real_load(text)
+
+    monkeypatch.setattr(models, "parse_yaml", counting_load)
+    for _ in range(3):
+        assert rev.migration is rev.migration
+        assert rev.last_index.revision == 2
+        assert rev.first_index.migration_hash == rev.migration_hash
+    assert len(calls) == 1
+
+
+def test_file_revision_cache_invalidated(tmp_path: Any) -> None:
+    migration = tmp_path / "1-migration.yml"
+    (tmp_path / "1-schema.sql").write_text("")
+    migration.write_text("message: one\n")
+    rev = models.FileRevision(1, str(migration))
+    old_hash = rev.migration_hash
+    assert rev.migration.message == "one"
+
+    migration.write_text("message: second\n")
+    assert rev.migration.message == "second"
+    assert rev.migration_hash != old_hash
+
+
+def test_plan_cache(tmp_path: Any, monkeypatch: Any) -> None:
+    shutil.copytree("test", tmp_path / "test")
+    config_path = str(tmp_path / "test" / "migrator.yml")
+    repo = models.Repo.parse(config_path)
+    expected = [repo.revisions[n].phase_indexes for n in (1, 2)]
+    repo.save_plan_cache()
+    assert (tmp_path / "test" / "migrations" / PLAN_CACHE_FILENAME).exists()
+
+    loaded = []
+    real_load = models.parse_yaml
+
+    def counting_load(text: str) -> Any:
+        loaded.append(text)
+        return real_load(text)
+
+    monkeypatch.setattr(models, "parse_yaml", counting_load)
+    repo = models.Repo.parse(config_path)
+    assert [repo.revisions[n].phase_indexes for n in (1, 2)] == expected
+    assert repo.revisions[2].last_index == expected[1][-1]
+    # only the config file should have been parsed
+    assert len(loaded) == 1
+
+
+def test_revision_list_lazy() -> None:
+    revisions = models.Repo.parse("test/migrator.yml").revisions
+    assert len(revisions) == 2
+    assert not revisions.is_loaded(1) and not revisions.is_loaded(2)
+    slc = models.PhaseSlice(start=revisions[2].first_index)
+    [(index, revision, change, phase)] = revisions.get_phases(slc)
+    assert revision.number == 2
+    assert not revisions.is_loaded(1)
+
+
+def test_revision_list_baseline() -> None:
+    migration = "message: m\npre_deploy:\n- run_ddl: {up: SELECT 1, down: SELECT 1}\n"
+    revisions = models.RevisionList(
+        {n: models.DbRevision(n, migration, "", False) for n in (3, 4)}
+    )
+    assert (revisions.start, revisions.last, len(revisions)) == (3, 4, 2)
+    assert [step[1].number for step in revisions.get_phases(models.PhaseSlice())] == [
+        3,
+        4,
+    ]
+    empty = models.RevisionList({})
+    assert (empty.start, empty.last) == (1, 0)
+
+
+def test_phase_index_ordering() -> None:
+    a = models.PhaseIndex(1, b"a", b"a", True, 1, 0)
+    b = models.PhaseIndex(1, b"b", b"b", False, 0, 0)
+    c = models.PhaseIndex(2, b"c", b"c", True, 0, 0)
+    assert a < b < c and c > b > a and a <= a and not a > a
+    assert sorted([c, a, b]) == [a, b, c]
+    assert len({a, b, c, models.PhaseIndex(1, b"a", b"a", True, 1, 0)}) == 3
+    assert not hasattr(a, "__dict__")
+
+
+def test_phase_slice_bounds() -> None:
+    indexes = [
+        models.PhaseIndex(rev, b"h", b"h", pre_deploy, change, phase)
+        for rev in (1, 2, 3)
+        for pre_deploy in (True, False)
+        for change in (0, 1)
+        for phase in (0, 1)
+    ]
+    table = models.PhaseTable(indexes)
+    other_hash = models.PhaseIndex(2, b"x", b"x", False, 1, 0)
+    for start in [None, indexes[5], indexes[13], other_hash]:
+        for end in [None, indexes[9], indexes[13], other_hash]:
+            for start_inclusive in (True, False):
+                for end_inclusive in (True, False):
+                    slc = models.PhaseSlice(start, start_inclusive, end, end_inclusive)
+                    expected = [i for i in indexes if i in slc]
+                    assert table.select(slc) == expected
+
+
+def test_construct_trusted() -> None:
+    fixture_migrations = [
+        fx["migration"] for fx in load_yaml("fixtures/diff/index.yml")
+    ]
+    repo = models.Repo.parse("test/migrator.yml")
+    for obj in fixture_migrations + [
+        yaml.safe_load(repo.revisions[n].migration_text) for n in (1, 2)
+    ]:
+        trusted = models.Migration.construct_trusted(obj)
+        assert trusted == models.Migration(**obj)
+        assert [i for i, _, _ in trusted.phases(repo.revisions[1].first_index)] == [
+            i
+            for i, _, _ in models.Migration(**obj).phases(repo.revisions[1].first_index)
+        ]
+
+
+def test_trusted_revision() -> None:
+    revisions = models.Repo.parse("test/migrator.yml").revisions
+    revisions.trust([revisions[2].migration_hash])
+    assert not revisions[1].is_trusted
+    assert revisions[2].is_trusted
+    assert revisions[2].migration.pre_deploy[0].run_ddl is not None
@@ -0,0 +1,60 @@
+import contextlib
+import os
+from typing import Any
+from urllib.parse import urlparse
+
+import psycopg2
+import pytest
+
+from migrator import pgbouncer
+from migrator.constants import SHIM_SCHEMA_FORMAT
+from migrator.logic import Context, drain, init
+
+# A trimmed-down SHOW CLIENTS (recent versions have more columns)
+COLUMNS = ["type", "user", "database", "state", "addr", "port", "local_addr"]
+ROWS = [
+    ["C", SHIM_SCHEMA_FORMAT % 2, "app", "active", "10.0.0.2", 5000, "10.0.0.9"],
+    ["C", SHIM_SCHEMA_FORMAT % 1, "app", "idle", "10.0.0.1", 5001, "10.0.0.9"],
+    ["C", SHIM_SCHEMA_FORMAT % 1, "other", "active", "10.0.0.3", 5002, "10.0.0.9"],
+    ["C", "app_user", "app", "active", "10.0.0.4", 5003, "10.0.0.9"],
+    ["C", "migrator", "pgbouncer", "active", "10.0.0.5", 5004, "10.0.0.9"],
+]
+
+
+def test_revision_of() -> None:
+    assert pgbouncer.revision_of(SHIM_SCHEMA_FORMAT % 12) == 12
+    assert pgbouncer.revision_of(SHIM_SCHEMA_FORMAT % 12 + "x") is None
+    assert pgbouncer.revision_of("migrator") is None
+
+
+def test_parse_clients() -> None:
+    assert pgbouncer.parse_clients(COLUMNS, ROWS, "app") == [
+        (1, "10.0.0.1:5001"),
+        (2, "10.0.0.2:5000"),
+    ]
+    assert pgbouncer.parse_clients(COLUMNS, [], "app") == []
+
+
+@pytest.mark.skipif(
+    "PGBOUNCER_URL" not in os.environ or "PGBOUNCER_ADMIN_URL" not in os.environ,
+    reason="needs PGBOUNCER_URL and PGBOUNCER_ADMIN_URL, e.g. docker-pgbouncer's",
+)
+def test_old_clients_through_pgbouncer(ctx: Context) -> None:
+    init.init_db(ctx)
+    ctx.repo().config.pgbouncer_admin_url = os.environ["PGBOUNCER_ADMIN_URL"]
+    ctx.repo().config.pgbouncer_database = urlparse(os.environ["PGBOUNCER_URL"]).path[
+        1:
+    ]
+    ctx.db().create_shim_schema(1)
+    # Connect as revision 1's role
+    url = urlparse(os.environ["PGBOUNCER_URL"])
+    netloc = url.netloc.replace(f"{url.username}:", f"{SHIM_SCHEMA_FORMAT % 1}:", 1)
+    client: Any
+    with contextlib.closing(
+        psycopg2.connect(url._replace(netloc=netloc).geturl())
+    ) as client:
+        with client, client.cursor() as cur:
+            cur.execute("SELECT 1")
+        [(revision, _)] = drain.old_clients(ctx, 2)
+        assert revision == 1
+        assert drain.old_clients(ctx, 1) == []
@@ -65,3 +65,38 @@ def test_incantation(ctx: Context) -> None:
     assert (
         db._fetch("SELECT count(*) FROM migrator_status.connections", args3)[0][0] == 1
     )
+
+
+def test_incantation_registers_in_one_call(ctx: Context) -> None:
+    incantation = revision.format_incantation(ctx.repo().revisions[2])
+    assert incantation.strip().startswith("SELECT") and incantation.count(";") == 1
+    db = ctx.db()
+    db.create_schema()
+    db.cur.execute(incantation)
+    db.cur.execute(incantation)
+    search_path = db._fetch("SHOW search_path")[0][0]
+    # The shim schema is only added once
+    assert search_path.count(SHIM_SCHEMA_FORMAT % 2) == 1
+    [(rev, pid)] = db._fetch("SELECT revision, pid FROM migrator_status.connections")
+    assert (rev, pid) == (2, db.conn.get_backend_pid())
+    # The registry isn't WAL-logged
+    assert db._fetch(
+        "SELECT relpersistence FROM pg_class WHERE oid = %s::regclass",
+        ("migrator_status.connections",),
+    ) == [("u",)]
+
+
+def test_incantation_for_tenant(ctx: Context) -> None:
+    rev = ctx.repo().revisions[2]
+    db = ctx.db()
+    db.create_schema()
+    # A tenant's application has its tenant schema on its search path
+    db.use_tenant("tenant_a")
+    shim_schema = db.shim_schema(2)
+    with db.transaction():
+        incantation = revision.format_incantation(rev, True, "tenant_a")
+        db.cur.execute(incantation.replace("$1", "%s"), ("client",))
+        assert db._fetch("SHOW search_path")[0][0].startswith(f"{shim_schema},")
+    db.cur.execute(revision.format_incantation(rev, tenant="tenant_a"))
+    assert db._fetch("SHOW search_path")[0][0].startswith(f"{shim_schema},")
+    db.use_tenant(None)